@@ -4,29 +4,50 @@ from discord import app_commands
 import random
 import re
 import ast
+import array
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import hashlib
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
 import os
+import psutil
 import glob
 import asyncio
 import shutil
+import sqlite3
+import struct
+import threading
+import time
 import yt_dlp
+import numpy as np
 
 # -----------------------------------------------------------------------------
 # VISÃO GERAL DO BOT (handoff para outro dev)
 #
 # 1) Entradas suportadas:
-#    - Comandos de texto: !luta, !tema, !ban, !desbanir, !adm, !teste
-#    - Comandos slash: /roll, /tema, /ban, /desbanir
+#    - Comandos de texto: !luta, !pular, !ir, !embaralhar, !fila, !parar, !tema, !prob,
+#      !stats, !auditoria, !ffmpeg, !voz, !ban, !desbanir, !adm, !teste
+#    - Comandos slash: /roll, /prob, /tema, /ban, /desbanir
 #    - Mensagens de rolagem: dN e df (ex.: d20+3, 4df atacar)
 #
 # 2) Fluxo principal:
 #    - `on_message` lida com comandos de texto e gatilhos regex.
-#    - `/roll` reutiliza `processar_rolagem_dados` para evitar divergência de regra.
+#    - `/roll` e as mensagens de rolagem usam o mesmo `executar_rolagem` + `renderizar_rolagem`,
+#      para evitar divergência de regra.
 #    - Áudio é centralizado nas funções `tocar_*` e no controle de fila de `!luta`.
 #
 # 3) Pontos críticos:
-#    - Estado de voz por guild fica em dicionários globais (filas/retomada/faixa atual).
-#    - Interrupção por tema/kokusen usa sinalizador para pausar autoavanço da playlist.
-#    - Ao terminar tema/kokusen, a faixa interrompida volta para o início da fila.
+#    - Estado da playlist de cada guild fica num `EstadoLuta` em `estados_luta`.
+#    - Tema/kokusen entram como efeito dentro da faixa do !luta (`FonteFaixaLuta`),
+#      que continua do mesmo ponto quando o efeito acaba.
 #
 # 4) Observação técnica:
 #    - Token do bot deve ser fornecido por variável de ambiente (`DISCORD_BOT_TOKEN`).
@@ -35,11 +56,12 @@ import yt_dlp
 # Mapeamento dos resultados dos dados Fate para símbolos visuais.
 fate_dice = {-1: '-', 0:'0', 1:'+'}
 
-# Listas/estruturas de controle de usuários e permissões.
-usuarios_banidos = [190954369917779968]
+# Conjuntos de controle de usuários e permissões.
+# Valores padrão de um banco novo; o estado real vem de `carregar_estado`.
+usuarios_banidos = {190954369917779968}
 usuarios_teste = set()
 id_jandei = 332954449918165003
-ids_admin = [316323635470270475]
+ids_admin = {316323635470270475}
 
 # Configuração base do cliente Discord e comandos slash.
 intents = discord.Intents.default()
@@ -48,65 +70,151 @@ client = discord.Client(intents=intents)
 tree = app_commands.CommandTree(client)
 comandos_sincronizados = False
 
+# Contexto de todos os processos auxiliares (cálculo `r` e extração do yt-dlp): `spawn`,
+# porque `fork` copiaria um processo que já tem as threads de voz e do `to_thread` rodando.
+contexto_processos = multiprocessing.get_context('spawn')
+
 # URL fixa da playlist do comando !luta.
 luta_playlist_url = 'https://music.youtube.com/playlist?list=PLIEibbGcfrARrAaNARQmPHAT-HwUa8-d8&si=U26AUy2dPYp3gq_C'
 
-# Estado de áudio por servidor (guild) para controle da playlist.
-filas_luta = {}
-faixa_atual_luta = {}
-retomar_faixa_luta = {}
-interromper_auto_avanco_luta = set()
+# Estado da playlist de cada servidor (guild -> `EstadoLuta`); só existe enquanto há playlist.
+# Só é alterado dentro do ator de áudio da guild (ver `AtorAudio`).
+estados_luta = {}
+# Quantas faixas já tocadas cada guild lembra (para o `!fila`).
+limite_historico_luta = 20
+
+# Prefetch do !luta: quantas faixas à frente têm o stream resolvido enquanto a
+# atual toca, e se a próxima já deixa o ffmpeg aberto (buffer inicial pronto).
+profundidade_prefetch_luta = 2
+preabrir_proxima_faixa_luta = True
 
-# Tema personalizado de cada usuário para ativação no ++++.
+# Tema personalizado de cada usuário para ativação no ++++ (persistido, ver `carregar_estado`).
 temas_usuario = {}
 
 
+class FaixaLuta:
+    # Registro compacto de uma faixa da playlist.
+    __slots__ = ('url', 'titulo', 'duracao')
+
+    def __init__(self, url, titulo=None, duracao=None):
+        self.url = url
+        self.titulo = titulo
+        self.duracao = duracao
+
+
+class EstadoLuta:
+    # Playlist de uma guild: fila, faixa atual, retomada, histórico e prefetch.
+    __slots__ = ('fila', 'atual', 'retomar', 'historico', 'prefetch', 'preaberta', 'resolucao')
+
+    def __init__(self, faixas=()):
+        self.fila = collections.deque(faixas)
+        # `FaixaLuta` tocando agora.
+        self.atual = None
+        # (FaixaLuta, posição em segundos) parada por tema/kokusen.
+        self.retomar = None
+        self.historico = collections.deque(maxlen=limite_historico_luta)
+        # URL -> task de prefetch; (url, fonte, título) com o ffmpeg da próxima já aberto.
+        self.prefetch = {}
+        self.preaberta = None
+        # Task que resolve a faixa atual fora do ator (None se não há resolução pendente).
+        self.resolucao = None
+
+    def empurrar_frente(self, faixa):
+        self.fila.appendleft(faixa)
+
+    def proxima(self):
+        # Tira a próxima faixa da frente da fila (None se acabou).
+        return self.fila.popleft() if self.fila else None
+
+    def terminar_atual(self):
+        # A faixa atual vai para o histórico.
+        if self.atual is not None:
+            self.historico.append(self.atual)
+            self.atual = None
+
+    def ir_para(self, indice):
+        # Descarta as faixas antes de `indice` (0 = próxima); a de `indice` passa a ser a próxima.
+        for _ in range(min(indice, len(self.fila))):
+            self.fila.popleft()
+
+    def embaralhar(self):
+        faixas = list(self.fila)
+        random.shuffle(faixas)
+        self.fila = collections.deque(faixas)
+
+    def descartar_preaberta(self):
+        if self.preaberta is not None:
+            self.preaberta[1].cleanup()
+            self.preaberta = None
+
+    def cancelar_resolucao(self):
+        # O resultado de uma resolução cancelada (ou já postada) é descartado pelo ator.
+        if self.resolucao is not None:
+            self.resolucao.cancel()
+            self.resolucao = None
+
+    def encerrar(self):
+        # Cancela prefetch e resolução e fecha o ffmpeg pré-aberto.
+        for tarefa in self.prefetch.values():
+            tarefa.cancel()
+        self.prefetch.clear()
+        self.cancelar_resolucao()
+        self.descartar_preaberta()
+
+
+def estado_luta(guild_id):
+    # Playlist ativa da guild, ou None.
+    return estados_luta.get(guild_id)
+
+
 def cancelar_playlist_luta(guild_id):
-    # Limpa completamente o estado da playlist de luta para uma guild.
-    filas_luta.pop(guild_id, None)
-    faixa_atual_luta.pop(guild_id, None)
-    retomar_faixa_luta.pop(guild_id, None)
-    interromper_auto_avanco_luta.discard(guild_id)
+    # Limpa completamente o estado da playlist de luta para uma guild (e libera o ator dela).
+    estado = estados_luta.pop(guild_id, None)
+    if estado is not None:
+        estado.encerrar()
+    liberar_ator_audio(guild_id)
 
 
 def preparar_interrupcao_playlist(guild_id, voice_client):
-    # Marca a faixa atual para retomada quando tema/kokusen interrompem a playlist.
-    if voice_client is None:
+    # Marca a faixa atual (e a posição) para retomada quando tema/kokusen param a playlist.
+    estado = estado_luta(guild_id)
+    if voice_client is None or estado is None:
         return False
 
-    faixa_atual = faixa_atual_luta.get(guild_id)
-    if faixa_atual and voice_client.is_playing():
-        retomar_faixa_luta[guild_id] = faixa_atual
-        interromper_auto_avanco_luta.add(guild_id)
+    if estado.atual is not None and voice_client.is_playing():
+        if estado.retomar is not None:
+            # Interrupção em cima de interrupção: vale a posição salva na primeira.
+            return True
+        fonte = voice_client.source
+        posicao = fonte.posicao if isinstance(fonte, FonteFaixaLuta) else 0.0
+        estado.retomar = (estado.atual, posicao)
         return True
 
     return False
 
 
 async def retomar_playlist_interrompida(guild_id, canal_texto):
-    # Retoma a faixa interrompida após o término do tema/kokusen.
+    # Retoma a faixa interrompida após o término do tema/kokusen, do ponto em que parou.
     # Remove estado temporário de retomada; se não houver nada salvo, não faz nada.
-    faixa_retomar = retomar_faixa_luta.pop(guild_id, None)
-    interromper_auto_avanco_luta.discard(guild_id)
-    if not faixa_retomar:
+    estado = estado_luta(guild_id)
+    if estado is None or estado.retomar is None:
         return
-
-    fila = filas_luta.setdefault(guild_id, [])
-    fila.insert(0, faixa_retomar)
+    faixa, posicao = estado.retomar
+    estado.retomar = None
 
     guild = canal_texto.guild
-    if guild is None:
-        return
-
-    voice_client = guild.voice_client
+    voice_client = guild.voice_client if guild is not None else None
     if voice_client is None or voice_client.is_playing():
+        # Não dá para retomar agora: a faixa volta para a frente da fila (do começo).
+        estado.empurrar_frente(faixa)
         return
 
-    await tocar_proxima_da_fila(guild_id, canal_texto)
+    await tocar_faixa_luta(guild_id, canal_texto, faixa, posicao)
 
 
+@functools.lru_cache(maxsize=1)
 def obter_ffmpeg_executavel():
-    # Busca o executável do ffmpeg em caminhos comuns do Windows.
+    # Busca o executável do ffmpeg em caminhos comuns do Windows (uma vez só; fica em cache).
     local_app_data = os.environ.get('LOCALAPPDATA', '')
     padrao_winget = os.path.join(
         local_app_data,
@@ -123,47 +231,422 @@ def obter_ffmpeg_executavel():
     for caminho in caminhos:
         if caminho and os.path.isfile(caminho):
             return caminho
-    return 'ffmpeg'
+    caminho = shutil.which('ffmpeg')
+    if caminho is None:
+        print('Aviso: ffmpeg não encontrado; o áudio em voz não vai funcionar.')
+        return 'ffmpeg'
+    return caminho
 
 
-def calcular_expressao(expr):
-    # Avalia expressão matemática de forma segura usando AST.
-    def avaliar(no):
-        if isinstance(no, ast.BinOp):
-            esquerda = avaliar(no.left)
-            direita = avaliar(no.right)
-
-            if isinstance(no.op, ast.Add):
-                return esquerda + direita
-            if isinstance(no.op, ast.Sub):
-                return esquerda - direita
-            if isinstance(no.op, ast.Mult):
-                return esquerda * direita
-            if isinstance(no.op, ast.Div):
-                return esquerda / direita
-            if isinstance(no.op, ast.FloorDiv):
-                return esquerda // direita
-            if isinstance(no.op, ast.Mod):
-                return esquerda % direita
-            if isinstance(no.op, ast.Pow):
-                return esquerda ** direita
+# -----------------------------------------------------------------------------
+# SUPERVISOR DO FFMPEG
+#
+# - O executável é resolvido e validado uma vez só (cache).
+# - Todo processo ffmpeg criado pelo bot (reprodução e cache em disco) passa
+#   por aqui e fica registrado por guild, com horário de início.
+# - Há um teto global de processos simultâneos; acima dele, novas fontes são
+#   recusadas com `LimiteFfmpegAtingido`.
+# - Uma task periódica recolhe processos encerrados e mata órfãos: fontes que
+#   nenhum voice client está tocando (ex.: sobras de corrida com `stop()`).
+# - `!ffmpeg` (admin) mostra processos vivos, tempo de execução e CPU.
+# -----------------------------------------------------------------------------
+
+limite_processos_ffmpeg = 24
+intervalo_supervisao_ffmpeg = 15.0
+# Uma fonte sem uso por mais que isso (segundos) é considerada órfã.
+tolerancia_orfao_ffmpeg = 20.0
+
+# PID -> ProcessoFfmpeg.
+processos_ffmpeg = {}
+
+
+class LimiteFfmpegAtingido(RuntimeError):
+    # Teto global de processos ffmpeg atingido.
+    pass
+
+
+class ProcessoFfmpeg:
+    # Processo ffmpeg supervisionado: a fonte de áudio dona dele (se houver) e metadados.
+    __slots__ = ('processo', 'fonte', 'guild_id', 'descricao', 'inicio')
+
+    def __init__(self, processo, fonte, guild_id, descricao):
+        self.processo = processo
+        self.fonte = fonte
+        self.guild_id = guild_id
+        self.descricao = descricao
+        self.inicio = time.monotonic()
+
+    @property
+    def vivo(self):
+        # Funciona tanto para `subprocess.Popen` quanto para processos do asyncio.
+        if hasattr(self.processo, 'poll'):
+            return self.processo.poll() is None
+        return self.processo.returncode is None
+
+    def encerrar(self):
+        if self.fonte is not None:
+            self.fonte.cleanup()
+        elif self.vivo:
+            self.processo.kill()
+
+
+def fontes_em_uso():
+    # Fontes que algum voice client está tocando, mais as pré-abertas do !luta.
+    em_uso = set()
+    pendentes = [getattr(voice_client, 'source', None) for voice_client in client.voice_clients]
+    for estado in estados_luta.values():
+        if estado.preaberta is not None:
+            pendentes.append(estado.preaberta[1])
+    # Fontes que embrulham outras (volume, mixagem, transmissão) expõem a original em `original`;
+    # a faixa do !luta também guarda o efeito que toca no lugar dela em `efeito`.
+    while pendentes:
+        fonte = pendentes.pop()
+        if fonte is not None:
+            em_uso.add(id(fonte))
+            pendentes.append(getattr(fonte, 'original', None))
+            pendentes.append(getattr(fonte, 'efeito', None))
+    return em_uso
+
+
+def recolher_processos_ffmpeg(encerrar_orfaos=False):
+    # Tira do registro os processos encerrados; opcionalmente mata os órfãos.
+    agora = time.monotonic()
+    em_uso = fontes_em_uso() if encerrar_orfaos else ()
+    for pid, registro in list(processos_ffmpeg.items()):
+        if not registro.vivo:
+            del processos_ffmpeg[pid]
+        elif (
+            encerrar_orfaos and registro.fonte is not None and id(registro.fonte) not in em_uso
+            and agora - registro.inicio > tolerancia_orfao_ffmpeg
+        ):
+            print(f'Encerrando ffmpeg órfão {pid} ({registro.descricao})')
+            registro.encerrar()
+            del processos_ffmpeg[pid]
+
+
+def reservar_vaga_ffmpeg():
+    # Garante espaço para mais um processo ou levanta `LimiteFfmpegAtingido`.
+    if len(processos_ffmpeg) >= limite_processos_ffmpeg:
+        recolher_processos_ffmpeg()
+    if len(processos_ffmpeg) >= limite_processos_ffmpeg:
+        raise LimiteFfmpegAtingido('Muitos áudios tocando ao mesmo tempo; tente de novo em instantes.')
+
+
+def registrar_processo_ffmpeg(processo, guild_id, descricao, fonte=None):
+    # Coloca um processo ffmpeg já iniciado sob supervisão.
+    processos_ffmpeg[processo.pid] = ProcessoFfmpeg(processo, fonte, guild_id, descricao)
+
+
+def criar_fonte_ffmpeg(classe, guild_id, descricao, *args, **kwargs):
+    # Cria uma fonte `FFmpegPCMAudio`/`FFmpegOpusAudio` supervisionada, respeitando o teto global.
+    reservar_vaga_ffmpeg()
+    fonte = classe(*args, executable=obter_ffmpeg_executavel(), **kwargs)
+    # `_process` é o Popen interno das fontes FFmpeg do discord.py.
+    registrar_processo_ffmpeg(fonte._process, guild_id, descricao, fonte)
+    return fonte
+
+
+async def supervisionar_ffmpeg_periodicamente():
+    # Task de fundo: recolhe processos encerrados e mata órfãos.
+    while True:
+        await asyncio.sleep(intervalo_supervisao_ffmpeg)
+        try:
+            recolher_processos_ffmpeg(encerrar_orfaos=True)
+        except Exception as erro:
+            print(f'Erro na supervisão do ffmpeg: {erro}')
+
+
+def estatisticas_ffmpeg():
+    # Uma linha por processo vivo: guild, descrição, tempo de execução e CPU.
+    recolher_processos_ffmpeg()
+    agora = time.monotonic()
+    linhas = []
+    for pid, registro in processos_ffmpeg.items():
+        duracao = agora - registro.inicio
+        try:
+            tempos = psutil.Process(pid).cpu_times()
+            cpu = tempos.user + tempos.system
+            uso = f'CPU {cpu:.1f}s ({cpu / duracao:.0%})' if duracao > 0 else f'CPU {cpu:.1f}s'
+        except psutil.Error:
+            uso = 'CPU ?'
+        linhas.append(
+            f"`{pid}` guild `{registro.guild_id or '-'}` {registro.descricao} · {duracao:.0f}s · {uso}"
+        )
+    return linhas
+
+
+# -----------------------------------------------------------------------------
+# CALCULADORA `r`
+#
+# - A expressão é validada via AST (mais seguro que `eval`) e o resultado da
+#   validação fica em cache LRU: repetir um cálculo não roda `ast.parse` de novo.
+# - Na compilação, estima-se um teto para o tamanho do resultado (em bits):
+#   `a*b` soma os bits, `a**b` multiplica os bits da base pelo maior valor
+#   possível do expoente. Acima do limite, o cálculo é recusado sem rodar.
+# - Na avaliação, cada `*` e `**` entre inteiros checa o tamanho real antes de
+#   calcular, e há orçamento de passos e prazo de parede.
+# - Cálculos com estimativa acima de `limite_bits_local` rodam num pequeno pool
+#   de processos auxiliares reaproveitados (subir um processo com `spawn` custa
+#   mais que o cálculo); o processo que estourar o prazo é encerrado à força e
+#   substituído no próximo uso.
+# -----------------------------------------------------------------------------
+
+# Maior inteiro (em bits) aceito em qualquer etapa do cálculo.
+limite_bits_calculo = 1_000_000
+# Estimativas acima deste valor rodam em processo separado.
+limite_bits_local = 4096
+# Máximo de nós da expressão avaliados.
+limite_passos_calculo = 1000
+# Prazo (segundos) de um cálculo; o processo auxiliar é encerrado depois disso.
+limite_tempo_calculo = 2.0
+# Processos auxiliares de cálculo vivos ao mesmo tempo, e prazo (segundos) para um subir.
+limite_processos_calculo = 2
+limite_tempo_inicio_calculo = 30.0
+# Resultados inteiros com mais dígitos que isso são exibidos em notação científica.
+limite_digitos_exibicao = 1500
+
+
+class CalculoMuitoCaro(ValueError):
+    # Cálculo recusado pelo modelo de custo (resultado ou passos demais).
+    pass
+
+
+def constante_calculo(no):
+    # Valor de uma constante (com sinal unário opcional), ou None se o nó não é constante.
+    if isinstance(no, ast.UnaryOp):
+        valor = constante_calculo(no.operand)
+        if valor is None:
+            return None
+        return -valor if isinstance(no.op, ast.USub) else valor
+    if isinstance(no, ast.Constant):
+        return no.value
+    return None
+
+
+def resulta_float_calculo(no):
+    # True se o nó (já validado) sempre produz float: constante float, `/`, ou operando float.
+    if isinstance(no, ast.Constant):
+        return isinstance(no.value, float)
+    if isinstance(no, ast.UnaryOp):
+        return resulta_float_calculo(no.operand)
+    if isinstance(no.op, ast.Div):
+        return True
+    return resulta_float_calculo(no.left) or resulta_float_calculo(no.right)
+
+
+def estimar_bits_calculo(no):
+    # Teto para o tamanho (em bits) do valor de um nó já validado; floats contam como 64.
+    if isinstance(no, ast.Constant):
+        if isinstance(no.value, float):
+            return 64
+        return max(abs(no.value).bit_length(), 1)
+
+    if isinstance(no, ast.UnaryOp):
+        return estimar_bits_calculo(no.operand)
+
+    esquerda = estimar_bits_calculo(no.left)
+    direita = estimar_bits_calculo(no.right)
+    if isinstance(no.op, (ast.Add, ast.Sub)):
+        return max(esquerda, direita) + 1
+    if isinstance(no.op, ast.Mult):
+        return esquerda + direita
+    if isinstance(no.op, ast.Pow):
+        base = constante_calculo(no.left)
+        if base is not None and abs(base) <= 1:
+            # 0, 1 e -1 elevados a qualquer coisa continuam do mesmo tamanho.
+            return max(1, direita)
+        if resulta_float_calculo(no):
+            # Potência com float dá float: no máximo 64 bits, ou `OverflowError` ao calcular.
+            return max(esquerda, direita, 64)
+        # O expoente inteiro vale no máximo 2**bits; acima de 64 bits o resultado é sempre absurdo.
+        if direita > 64:
+            return float('inf')
+        return esquerda * (2 ** direita)
+    if isinstance(no.op, ast.Mod):
+        return direita
+    return esquerda
+
+
+def validar_no_calculo(no):
+    # Garante que a árvore só tem números e operadores aritméticos permitidos.
+    if isinstance(no, ast.BinOp):
+        if not isinstance(no.op, (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)):
             raise ValueError('Operador não permitido.')
+        validar_no_calculo(no.left)
+        validar_no_calculo(no.right)
+        return
 
-        if isinstance(no, ast.UnaryOp):
-            valor = avaliar(no.operand)
-            if isinstance(no.op, ast.UAdd):
-                return +valor
-            if isinstance(no.op, ast.USub):
-                return -valor
+    if isinstance(no, ast.UnaryOp):
+        if not isinstance(no.op, (ast.UAdd, ast.USub)):
             raise ValueError('Operador unário não permitido.')
+        validar_no_calculo(no.operand)
+        return
 
-        if isinstance(no, ast.Constant) and isinstance(no.value, (int, float)):
-            return no.value
+    if isinstance(no, ast.Constant) and isinstance(no.value, (int, float)) and not isinstance(no.value, bool):
+        return
+
+    raise ValueError('Expressão inválida.')
 
-        raise ValueError('Expressão inválida.')
 
+@functools.lru_cache(maxsize=256)
+def compilar_calculo(expr):
+    # Faz parse + validação uma vez por expressão; devolve (nó raiz, bits estimados).
     arvore = ast.parse(expr, mode='eval')
-    return avaliar(arvore.body)
+    validar_no_calculo(arvore.body)
+    custo = estimar_bits_calculo(arvore.body)
+    if custo > limite_bits_calculo * 4:
+        raise CalculoMuitoCaro('Resultado grande demais.')
+    return arvore.body, custo
+
+
+def avaliar_calculo(raiz, prazo):
+    # Avalia a árvore validada respeitando limite de bits, de passos e o prazo.
+    passos = 0
+
+    def checar_bits(bits):
+        if bits > limite_bits_calculo:
+            raise CalculoMuitoCaro('Resultado grande demais.')
+
+    def avaliar(no):
+        nonlocal passos
+        passos += 1
+        if passos > limite_passos_calculo:
+            raise CalculoMuitoCaro('Expressão longa demais.')
+        if time.monotonic() > prazo:
+            raise TimeoutError('Cálculo demorou demais.')
+
+        if isinstance(no, ast.Constant):
+            return no.value
+
+        if isinstance(no, ast.UnaryOp):
+            valor = avaliar(no.operand)
+            return -valor if isinstance(no.op, ast.USub) else +valor
+
+        esquerda = avaliar(no.left)
+        direita = avaliar(no.right)
+        inteiros = isinstance(esquerda, int) and isinstance(direita, int)
+
+        if isinstance(no.op, ast.Add):
+            return esquerda + direita
+        if isinstance(no.op, ast.Sub):
+            return esquerda - direita
+        if isinstance(no.op, ast.Mult):
+            if inteiros:
+                checar_bits(esquerda.bit_length() + direita.bit_length())
+            return esquerda * direita
+        if isinstance(no.op, ast.Div):
+            return esquerda / direita
+        if isinstance(no.op, ast.FloorDiv):
+            return esquerda // direita
+        if isinstance(no.op, ast.Mod):
+            return esquerda % direita
+        if inteiros and direita > 0 and abs(esquerda) > 1:
+            checar_bits(esquerda.bit_length() * direita)
+        return esquerda ** direita
+
+    return avaliar(raiz)
+
+
+def calcular_expressao(expr):
+    # Avalia expressão matemática de forma segura usando AST, com modelo de custo.
+    raiz, _custo = compilar_calculo(expr)
+    return avaliar_calculo(raiz, time.monotonic() + limite_tempo_calculo)
+
+
+def _servir_calculos(conexao):
+    # Laço do processo auxiliar: recebe expressões e devolve ('ok', valor) ou ('erro', exceção).
+    conexao.send(('pronto', None))
+    while True:
+        try:
+            expr = conexao.recv()
+        except EOFError:
+            return
+        try:
+            conexao.send(('ok', calcular_expressao(expr)))
+        except Exception as erro:
+            conexao.send(('erro', erro))
+
+
+class ProcessoCalculo:
+    # Processo auxiliar de cálculo, reaproveitado entre pedidos.
+    __slots__ = ('processo', 'conexao')
+
+    def __init__(self):
+        self.conexao, filho = contexto_processos.Pipe()
+        self.processo = contexto_processos.Process(target=_servir_calculos, args=(filho,), daemon=True)
+        self.processo.start()
+        filho.close()
+        # Com `spawn` o processo importa o bot antes de atender: isso não conta no prazo do cálculo.
+        if not self.conexao.poll(limite_tempo_inicio_calculo):
+            self.encerrar()
+            raise TimeoutError('O processo de cálculo não iniciou a tempo.')
+        self.conexao.recv()
+
+    def calcular(self, expr):
+        # Devolve (status, valor); TimeoutError se passar do prazo.
+        self.conexao.send(expr)
+        if not self.conexao.poll(limite_tempo_calculo):
+            raise TimeoutError('Cálculo demorou demais.')
+        return self.conexao.recv()
+
+    def encerrar(self):
+        self.conexao.close()
+        if self.processo.is_alive():
+            self.processo.kill()
+        self.processo.join()
+
+
+# Processos auxiliares parados esperando cálculo, e vagas para criar/usar um.
+processos_calculo_livres = []
+trava_processos_calculo = threading.Lock()
+vagas_processos_calculo = threading.BoundedSemaphore(limite_processos_calculo)
+
+
+def calcular_expressao_isolada(expr):
+    # Roda o cálculo num processo auxiliar do pool; se passar do prazo, o processo é encerrado.
+    with vagas_processos_calculo:
+        with trava_processos_calculo:
+            auxiliar = processos_calculo_livres.pop() if processos_calculo_livres else None
+        if auxiliar is None or not auxiliar.processo.is_alive():
+            if auxiliar is not None:
+                auxiliar.encerrar()
+            auxiliar = ProcessoCalculo()
+        try:
+            status, valor = auxiliar.calcular(expr)
+        except (EOFError, ConnectionError):
+            # O processo morreu no meio do cálculo (ou antes de recebê-lo).
+            auxiliar.encerrar()
+            raise CalculoMuitoCaro('O cálculo foi interrompido.')
+        except BaseException:
+            auxiliar.encerrar()
+            raise
+        with trava_processos_calculo:
+            processos_calculo_livres.append(auxiliar)
+
+    if status == 'erro':
+        raise valor
+    return valor
+
+
+async def calcular_expressao_async(expr):
+    # Cálculos baratos rodam direto no loop; caros vão para o processo auxiliar.
+    _raiz, custo = compilar_calculo(expr)
+    if custo <= limite_bits_local:
+        return calcular_expressao(expr)
+    return await asyncio.to_thread(calcular_expressao_isolada, expr)
+
+
+def formatar_resultado_calculo(resultado):
+    # Formata o resultado; inteiros gigantes viram notação científica aproximada.
+    if isinstance(resultado, float) and resultado.is_integer():
+        resultado = int(resultado)
+    if isinstance(resultado, int) and abs(resultado).bit_length() * 0.30103 > limite_digitos_exibicao:
+        logaritmo = math.log10(abs(resultado))
+        expoente = math.floor(logaritmo)
+        mantissa = 10 ** (logaritmo - expoente)
+        sinal = '-' if resultado < 0 else ''
+        return f'≈ {sinal}{mantissa:.4f}e+{expoente}'
+    return resultado
 
 
 def escala_adjetivos_jjk(total):
@@ -197,6 +680,1087 @@ def escala_adjetivos_jjk(total):
     return 'Horrível'
 
 
+# -----------------------------------------------------------------------------
+# MOTOR DE DADOS
+#
+# - Poucos dados: cada valor é sorteado e exibido, como sempre foi.
+# - Muitos dados com poucas faces: sorteia direto a contagem de cada face com um
+#   sorteio multinomial (custo proporcional às faces, não à quantidade de dados).
+# - Muitos dados com muitas faces: sorteio vetorizado do NumPy, com teto.
+# - Acima do limite de listagem, a exibição vira um histograma compacto por face.
+# - O mesmo motor atende `d` (faces 1..N) e `df` (faces -1..1).
+# -----------------------------------------------------------------------------
+
+# Até este número de dados, cada valor é sorteado e listado individualmente.
+limite_dados_listados = 100
+# Dados com até este número de faces são sorteados por contagem (multinomial).
+limite_faces_contagem = 100_000
+# Dados com mais faces que o limite acima são sorteados em vetor até esta quantidade.
+limite_dados_vetorizados = 1_000_000
+# Maior face aceita no sorteio vetorizado (mantém a soma dentro de int64).
+limite_faces_vetorizadas = 10**12
+# Teto absoluto de dados por rolagem (mantém o total dentro de int64).
+limite_dados_total = 10**12
+# Máximo de entradas exibidas no histograma; acima disso as faces são agrupadas em faixas.
+limite_faixas_histograma = 10
+
+gerador_dados = np.random.default_rng()
+
+
+class DadosRolados:
+    # Resultado de um grupo de dados iguais: valores individuais ou contagem por face.
+    __slots__ = ('minimo', 'maximo', 'valores', 'contagens')
+
+    def __init__(self, minimo, maximo, valores=None, contagens=None):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.valores = valores
+        self.contagens = contagens
+
+    @property
+    def quantidade(self):
+        if self.contagens is not None:
+            return int(self.contagens.sum())
+        return len(self.valores)
+
+    @property
+    def listavel(self):
+        # Só exibimos dado a dado quando a lista cabe na mensagem.
+        return isinstance(self.valores, list) and len(self.valores) <= limite_dados_listados
+
+    def contagens_completas(self):
+        # Contagem por face (índice 0 = face mínima), qualquer que seja a representação.
+        if self.contagens is not None:
+            return self.contagens
+        indices = np.asarray(self.valores, dtype=np.int64) - self.minimo
+        return np.bincount(indices, minlength=self.maximo - self.minimo + 1)
+
+    def total(self):
+        if self.contagens is not None:
+            faces = np.arange(self.minimo, self.maximo + 1, dtype=np.int64)
+            return int(np.dot(self.contagens, faces))
+        if isinstance(self.valores, list):
+            return sum(self.valores)
+        return int(self.valores.sum())
+
+    def histograma(self):
+        # Lista de (face_inicial, face_final, contagem), agrupando em faixas se preciso.
+        faces = self.maximo - self.minimo + 1
+        faixas = min(faces, limite_faixas_histograma)
+        if self.contagens is not None and faixas == faces:
+            return [
+                (self.minimo + indice, self.minimo + indice, int(contagem))
+                for indice, contagem in enumerate(self.contagens)
+            ]
+
+        inicios = [self.minimo + (faces * indice) // faixas for indice in range(faixas)]
+        if self.contagens is not None:
+            contagens = np.add.reduceat(self.contagens, [inicio - self.minimo for inicio in inicios])
+        else:
+            indices = ((np.asarray(self.valores, dtype=np.int64) - self.minimo) * faixas) // faces
+            contagens = np.bincount(indices, minlength=faixas)
+
+        fins = [inicio - 1 for inicio in inicios[1:]] + [self.maximo]
+        return [
+            (inicio, fim, int(contagem))
+            for inicio, fim, contagem in zip(inicios, fins, contagens)
+        ]
+
+
+def rolar_dados(quantidade, minimo, maximo):
+    # Sorteia `quantidade` dados uniformes em [minimo, maximo] escolhendo a estratégia mais barata.
+    if maximo < minimo:
+        raise ValueError('o dado precisa ter pelo menos uma face.')
+    if quantidade > limite_dados_total:
+        raise ValueError(f'no máximo {limite_dados_total} dados por rolagem.')
+
+    if quantidade <= limite_dados_listados:
+        # `random.randint` aceita faces arbitrariamente grandes (inteiros do Python).
+        return DadosRolados(minimo, maximo, valores=[random.randint(minimo, maximo) for _ in range(quantidade)])
+
+    faces = maximo - minimo + 1
+    if faces <= limite_faces_contagem:
+        probabilidades = np.full(faces, 1.0 / faces)
+        return DadosRolados(minimo, maximo, contagens=gerador_dados.multinomial(quantidade, probabilidades))
+
+    if quantidade <= limite_dados_vetorizados and maximo <= limite_faces_vetorizadas:
+        valores = gerador_dados.integers(minimo, maximo, size=quantidade, dtype=np.int64, endpoint=True)
+        return DadosRolados(minimo, maximo, valores=valores)
+
+    raise ValueError(
+        f'dados com mais de {limite_faces_contagem} faces aceitam no máximo {limite_dados_vetorizados} dados.'
+    )
+
+
+def formatar_histograma(dados, rotulos=None):
+    # Formata o histograma compacto (`face: contagem`) de uma rolagem grande.
+    partes = []
+    for inicio, fim, contagem in dados.histograma():
+        if inicio == fim:
+            rotulo = rotulos[inicio] if rotulos else str(inicio)
+        else:
+            rotulo = f'{inicio}–{fim}'
+        partes.append(f'{rotulo}: {contagem}')
+    return f"{dados.quantidade} dados {{{' · '.join(partes)}}}"
+
+
+# -----------------------------------------------------------------------------
+# GRAMÁTICA DE ROLAGEM
+#
+# - Expressão: um grupo de dados seguido de termos somados/subtraídos
+#   (`2d6+1d8+3`, `4d6kh3`, `d6!`, `2d20kl1-2`, `4df+1`).
+# - Modificadores por grupo: `khN`/`kN` (mantém N maiores), `klN` (mantém N
+#   menores), `rN` (rerrola uma vez resultados <= N) e `!` (explode no máximo).
+#   Ordem de aplicação fixa: rerrolagem, explosão, depois manter.
+# - `regex_expressao_dados` só separa expressão e texto livre; a expressão
+#   normalizada é compilada uma vez num `PlanoRolagem` e guardada em LRU.
+# - Avaliar um plano não faz nenhum parsing.
+# -----------------------------------------------------------------------------
+
+# Grupo de dados (com modificadores) e termo genérico (grupo ou constante).
+padrao_grupo_dados = r'\d*d(?:f|\d+)(?:kh\d+|kl\d+|k\d+|r\d+|!)*'
+padrao_termo_dados = rf'(?:{padrao_grupo_dados}|\d+)'
+
+# A expressão precisa começar com um grupo de dados; o resto da mensagem é texto livre.
+regex_expressao_dados = re.compile(
+    rf'^({padrao_grupo_dados}(?:\s*[+-]\s*{padrao_termo_dados})*)(?:\s+(.*))?$',
+    re.IGNORECASE
+)
+regex_termo_normalizado = re.compile(r'([+-]?)(?:(\d*)d(f|\d+)((?:kh\d+|kl\d+|k\d+|r\d+|!)*)|(\d+))')
+regex_modificador_dados = re.compile(r'(kh|kl|k|r)(\d+)|!')
+
+# Número máximo de rodadas de explosão por grupo (evita laço infinito com azar).
+limite_explosoes = 100
+
+# Rolagem em lote (`10x d20+5`): teto de repetições e quanto exibir de cada uma.
+limite_repeticoes = 1000
+limite_linhas_lote = 20
+limite_totais_lote = 200
+# Teto de trabalho (faces sorteadas por contagem ou dados sorteados) dos grupos que
+# não vetorizam no lote e rolam uma repetição por vez; ~0,2 s de CPU no pior caso.
+limite_trabalho_lote = 2_000_000
+limite_caracteres_mensagem = 2000
+regex_repeticao_rolagem = re.compile(
+    rf'^(\d+)\s*x\s*({padrao_grupo_dados}(?:\s*[+-]\s*{padrao_termo_dados})*(?:\s+.*)?)$',
+    re.IGNORECASE
+)
+
+
+class TermoDados:
+    # Um grupo de dados iguais dentro do plano, com seus modificadores.
+    __slots__ = ('sinal', 'quantidade', 'minimo', 'maximo', 'fate', 'manter', 'manter_maiores', 'rerrolar_ate', 'explodir')
+
+    def __init__(self, sinal, quantidade, minimo, maximo, fate=False):
+        self.sinal = sinal
+        self.quantidade = quantidade
+        self.minimo = minimo
+        self.maximo = maximo
+        self.fate = fate
+        self.manter = None
+        self.manter_maiores = True
+        self.rerrolar_ate = None
+        self.explodir = False
+
+
+class TermoRolado:
+    # Resultado de um `TermoDados`: dados mantidos e, se listáveis, os descartados.
+    __slots__ = ('termo', 'dados', 'descartados')
+
+    def __init__(self, termo, dados, descartados=None):
+        self.termo = termo
+        self.dados = dados
+        self.descartados = descartados
+
+    def subtotal(self):
+        return self.termo.sinal * self.dados.total()
+
+
+class PlanoRolagem:
+    # Expressão de rolagem já compilada; reutilizável entre mensagens.
+    __slots__ = ('termos', 'bonus', 'mod_display', 'fate')
+
+    def __init__(self, termos, bonus, mod_display):
+        self.termos = termos
+        self.bonus = bonus
+        self.mod_display = mod_display
+        self.fate = termos[0].fate
+
+    @property
+    def quantidade_fate(self):
+        # Número de dados Fate da rolagem (0 se não for Fate).
+        return self.termos[0].quantidade if self.fate else 0
+
+    def rolar(self):
+        # Executa o plano e devolve (termos rolados, total com bônus).
+        rolados = [rolar_termo(termo) for termo in self.termos]
+        return rolados, sum(rolado.subtotal() for rolado in rolados) + self.bonus
+
+    def rolar_lote(self, repeticoes):
+        # Executa o plano `repeticoes` vezes de forma vetorizada; devolve (totais, matrizes por termo).
+        totais = np.full(repeticoes, self.bonus, dtype=np.int64)
+        matrizes = []
+        for termo in self.termos:
+            subtotais, matriz = rolar_termo_em_lote(termo, repeticoes)
+            totais = totais + termo.sinal * subtotais
+            matrizes.append(matriz)
+        return totais, matrizes
+
+
+def normalizar_expressao_dados(expressao):
+    # Chave canônica do cache: sem espaços e em minúsculas.
+    return ''.join(expressao.split()).lower()
+
+
+@functools.lru_cache(maxsize=256)
+def compilar_expressao_dados(expressao_normalizada):
+    # Compila a expressão normalizada em um `PlanoRolagem` (ValueError se inválida).
+    termos = []
+    bonus = 0
+    mod_display = ''
+    posicao = 0
+    while posicao < len(expressao_normalizada):
+        match_termo = regex_termo_normalizado.match(expressao_normalizada, posicao)
+        if not match_termo or match_termo.end() == posicao:
+            raise ValueError('expressão de dados inválida.')
+        posicao = match_termo.end()
+        sinal_texto, quantidade, faces, modificadores, constante = match_termo.groups()
+
+        if constante is not None:
+            sinal_texto = sinal_texto or '+'
+            bonus += int(constante) if sinal_texto == '+' else -int(constante)
+            mod_display += f'{sinal_texto}{constante}'
+            continue
+
+        sinal = -1 if sinal_texto == '-' else 1
+        quantidade = int(quantidade) if quantidade else 1
+        if faces == 'f':
+            if modificadores:
+                raise ValueError('dados Fate não aceitam modificadores.')
+            termos.append(TermoDados(sinal, quantidade, -1, 1, fate=True))
+            continue
+
+        if int(faces) < 1:
+            raise ValueError('um dado precisa ter pelo menos 1 face.')
+        termo = TermoDados(sinal, quantidade, 1, int(faces))
+        for match_mod in regex_modificador_dados.finditer(modificadores):
+            nome, valor = match_mod.groups()
+            if nome is None:
+                if termo.maximo < 2:
+                    raise ValueError('só dá para explodir dados com 2 faces ou mais.')
+                termo.explodir = True
+            elif nome == 'r':
+                if int(valor) >= termo.maximo:
+                    raise ValueError(f'`r{valor}` rerrolaria todas as faces do d{termo.maximo}.')
+                termo.rerrolar_ate = int(valor)
+            else:
+                termo.manter = int(valor)
+                termo.manter_maiores = nome != 'kl'
+        termos.append(termo)
+
+    if any(termo.fate for termo in termos):
+        if len(termos) > 1 or termos[0].sinal < 0:
+            raise ValueError('rolagens Fate aceitam um único grupo `df` mais constantes.')
+
+    return PlanoRolagem(tuple(termos), bonus, mod_display)
+
+
+def rerrolar_dados(dados, limite):
+    # Rerrola uma única vez todo dado com resultado <= limite.
+    if dados.contagens is not None:
+        contagens = dados.contagens.copy()
+        indice_limite = limite - dados.minimo + 1
+        rerrolagens = int(contagens[:indice_limite].sum())
+        contagens[:indice_limite] = 0
+        contagens += rolar_dados(rerrolagens, dados.minimo, dados.maximo).contagens_completas()
+        return DadosRolados(dados.minimo, dados.maximo, contagens=contagens)
+
+    if isinstance(dados.valores, list):
+        valores = [
+            random.randint(dados.minimo, dados.maximo) if valor <= limite else valor
+            for valor in dados.valores
+        ]
+        return DadosRolados(dados.minimo, dados.maximo, valores=valores)
+
+    valores = dados.valores.copy()
+    mascara = valores <= limite
+    valores[mascara] = gerador_dados.integers(dados.minimo, dados.maximo, size=int(mascara.sum()), endpoint=True)
+    return DadosRolados(dados.minimo, dados.maximo, valores=valores)
+
+
+def explodir_dados(dados):
+    # Cada dado no valor máximo gera um dado extra (que também pode explodir).
+    if dados.contagens is not None:
+        contagens = dados.contagens.copy()
+        novos = int(contagens[-1])
+        for _ in range(limite_explosoes):
+            if not novos:
+                break
+            extras = rolar_dados(novos, dados.minimo, dados.maximo).contagens_completas()
+            contagens += extras
+            novos = int(extras[-1])
+        return DadosRolados(dados.minimo, dados.maximo, contagens=contagens)
+
+    if isinstance(dados.valores, list):
+        valores = list(dados.valores)
+        novos = valores.count(dados.maximo)
+        for _ in range(limite_explosoes):
+            if not novos:
+                break
+            extras = [random.randint(dados.minimo, dados.maximo) for _ in range(novos)]
+            valores.extend(extras)
+            novos = extras.count(dados.maximo)
+        return DadosRolados(dados.minimo, dados.maximo, valores=valores)
+
+    partes = [dados.valores]
+    novos = int((dados.valores == dados.maximo).sum())
+    for _ in range(limite_explosoes):
+        if not novos:
+            break
+        extras = gerador_dados.integers(dados.minimo, dados.maximo, size=novos, endpoint=True)
+        partes.append(extras)
+        novos = int((extras == dados.maximo).sum())
+    return DadosRolados(dados.minimo, dados.maximo, valores=np.concatenate(partes))
+
+
+def manter_dados(dados, quantidade, maiores):
+    # Mantém os `quantidade` maiores (ou menores); devolve (mantidos, descartados listáveis).
+    if dados.contagens is not None:
+        contagens = dados.contagens[::-1] if maiores else dados.contagens
+        antes = np.cumsum(contagens) - contagens
+        mantidas = np.minimum(contagens, np.maximum(quantidade - antes, 0))
+        if maiores:
+            mantidas = mantidas[::-1]
+        if quantidade <= limite_dados_listados:
+            # Poucos dados mantidos voltam a ser listados, do maior para o menor (ou o contrário).
+            faces = np.arange(dados.minimo, dados.maximo + 1)
+            valores = np.repeat(faces, mantidas).tolist()
+            return DadosRolados(dados.minimo, dados.maximo, valores=valores[::-1] if maiores else valores), None
+        return DadosRolados(dados.minimo, dados.maximo, contagens=mantidas), None
+
+    if isinstance(dados.valores, list):
+        ordem = sorted(range(len(dados.valores)), key=dados.valores.__getitem__, reverse=maiores)
+        indices_mantidos = set(ordem[:quantidade])
+        mantidos = [valor for indice, valor in enumerate(dados.valores) if indice in indices_mantidos]
+        descartados = [valor for indice, valor in enumerate(dados.valores) if indice not in indices_mantidos]
+        return DadosRolados(dados.minimo, dados.maximo, valores=mantidos), descartados
+
+    ordenados = np.sort(dados.valores)
+    mantidos = ordenados[len(ordenados) - quantidade:] if maiores else ordenados[:quantidade]
+    if quantidade <= limite_dados_listados:
+        mantidos = mantidos[::-1].tolist() if maiores else mantidos.tolist()
+    return DadosRolados(dados.minimo, dados.maximo, valores=mantidos), None
+
+
+def rolar_termo(termo):
+    # Rola um grupo de dados aplicando rerrolagem, explosão e manter, nessa ordem.
+    dados = rolar_dados(termo.quantidade, termo.minimo, termo.maximo)
+    if termo.rerrolar_ate is not None:
+        dados = rerrolar_dados(dados, termo.rerrolar_ate)
+    if termo.explodir:
+        dados = explodir_dados(dados)
+    descartados = None
+    if termo.manter is not None:
+        dados, descartados = manter_dados(dados, termo.manter, termo.manter_maiores)
+    return TermoRolado(termo, dados, descartados)
+
+
+def rolar_termo_em_lote(termo, repeticoes):
+    # Subtotais (sem sinal) de `repeticoes` rolagens do termo e, se vetorizado, a matriz de dados.
+    vetorizavel = (
+        termo.quantidade <= limite_dados_listados
+        and termo.maximo <= limite_faces_vetorizadas
+        and not (termo.manter is not None and termo.explodir)
+    )
+    if not vetorizavel:
+        # Grupos enormes já são O(faces) por rolagem; manter+explodir tem pool de tamanho variável.
+        # Mas repetidos mil vezes voltariam a travar o loop: o total de trabalho tem teto.
+        faces = termo.maximo - termo.minimo + 1
+        if termo.quantidade <= limite_dados_listados or faces > limite_faces_contagem:
+            custo = termo.quantidade
+        else:
+            custo = faces
+        if repeticoes * custo > limite_trabalho_lote:
+            raise ValueError(
+                f'esse grupo aceita no máximo {max(1, limite_trabalho_lote // custo)} repetições.'
+            )
+        return np.array([rolar_termo(termo).dados.total() for _ in range(repeticoes)]), None
+
+    matriz = gerador_dados.integers(
+        termo.minimo, termo.maximo, size=(repeticoes, termo.quantidade), dtype=np.int64, endpoint=True
+    )
+    if termo.rerrolar_ate is not None:
+        mascara = matriz <= termo.rerrolar_ate
+        matriz[mascara] = gerador_dados.integers(
+            termo.minimo, termo.maximo, size=int(mascara.sum()), dtype=np.int64, endpoint=True
+        )
+
+    if termo.manter is not None:
+        if termo.manter == 0:
+            return np.zeros(repeticoes, dtype=np.int64), matriz
+        ordenada = np.sort(matriz, axis=1)
+        mantidos = ordenada[:, -termo.manter:] if termo.manter_maiores else ordenada[:, :termo.manter]
+        return mantidos.sum(axis=1), matriz
+
+    subtotais = matriz.sum(axis=1)
+    if termo.explodir:
+        # Explosões de todas as repetições são sorteadas juntas e somadas por linha.
+        novos = (matriz == termo.maximo).sum(axis=1)
+        for _ in range(limite_explosoes):
+            quantos = int(novos.sum())
+            if not quantos:
+                break
+            extras = gerador_dados.integers(termo.minimo, termo.maximo, size=quantos, dtype=np.int64, endpoint=True)
+            linhas = np.repeat(np.arange(repeticoes), novos)
+            subtotais += np.bincount(linhas, weights=extras, minlength=repeticoes).astype(np.int64)
+            novos = np.bincount(linhas, weights=extras == termo.maximo, minlength=repeticoes).astype(np.int64)
+    return subtotais, matriz
+
+
+def formatar_termos_rolados(rolados):
+    # Formata os dados de cada grupo (`[3, 5] + [7]`), com descartados riscados.
+    partes = []
+    for indice, rolado in enumerate(rolados):
+        dados = rolado.dados
+        texto = str(dados.valores) if dados.listavel else formatar_histograma(dados)
+        if rolado.descartados:
+            texto += f' ~~{rolado.descartados}~~'
+        if indice > 0 or rolado.termo.sinal < 0:
+            texto = f"{'-' if rolado.termo.sinal < 0 else '+'} {texto}"
+        partes.append(texto)
+    return ' '.join(partes)
+
+
+# -----------------------------------------------------------------------------
+# PROBABILIDADES EXATAS (`!prob` e `/prob`)
+#
+# - Usa o mesmo plano compilado das rolagens (`compilar_expressao_dados`).
+# - Distribuição de um dado (com rerrolagem/explosão) é memoizada por tipo de dado.
+# - Soma de N dados sai de convoluções por quadrados sucessivos, também
+#   memoizadas: `4df` com qualquer modificador responde direto do cache.
+# - Convoluções grandes usam FFT; pequenas usam convolução direta.
+# - `kh`/`kl` não entram (a distribuição deixa de ser uma soma simples).
+# -----------------------------------------------------------------------------
+
+# Maior suporte (valores possíveis do total) calculado para uma expressão.
+limite_suporte_probabilidade = 1_000_000
+# Abaixo deste tamanho de saída a convolução direta é mais rápida que a FFT.
+limite_convolucao_direta = 4096
+# Profundidade cuja probabilidade residual é desprezada na explosão de dados.
+precisao_explosao = 1e-15
+# Memória máxima (bytes de arrays) que cada cache de distribuições pode segurar.
+limite_bytes_cache_distribuicoes = 64 * 1024 * 1024
+
+
+def memorizar_distribuicao(funcao):
+    # Como `lru_cache`, mas limitado pelos bytes das distribuições guardadas, não
+    # pelo número de entradas. Com trava: `!prob` roda em threads.
+    cache = collections.OrderedDict()
+    trava = threading.Lock()
+    total_bytes = 0
+
+    @functools.wraps(funcao)
+    def envoltorio(*args):
+        nonlocal total_bytes
+        with trava:
+            if args in cache:
+                cache.move_to_end(args)
+                return cache[args]
+        resultado = funcao(*args)
+        tamanho = resultado[1].nbytes
+        # Distribuições enormes não entram: expulsariam todo o resto.
+        if tamanho <= limite_bytes_cache_distribuicoes // 4:
+            with trava:
+                if args not in cache:
+                    cache[args] = resultado
+                    total_bytes += tamanho
+                while total_bytes > limite_bytes_cache_distribuicoes:
+                    _args, (_offset, probs) = cache.popitem(last=False)
+                    total_bytes -= probs.nbytes
+        return resultado
+
+    return envoltorio
+
+# Alvo no fim do texto depois da expressão: `>= 3`, `≥ 3`, ou só `3` quando não há mais nada
+# (texto de ação antes do comparador, como em `4df atacar >= 2`, é aceito).
+regex_alvo_probabilidade = re.compile(r'(?:^|>=|≥)\s*([+-]?\d+)$')
+
+
+def convoluir_distribuicoes(primeira, segunda):
+    # Convolução de duas distribuições (offset, probabilidades); FFT quando compensa.
+    offset_primeira, probs_primeira = primeira
+    offset_segunda, probs_segunda = segunda
+    tamanho = len(probs_primeira) + len(probs_segunda) - 1
+    if tamanho <= limite_convolucao_direta or min(len(probs_primeira), len(probs_segunda)) <= 32:
+        probs = np.convolve(probs_primeira, probs_segunda)
+    else:
+        tamanho_fft = 1 << (tamanho - 1).bit_length()
+        probs = np.fft.irfft(
+            np.fft.rfft(probs_primeira, tamanho_fft) * np.fft.rfft(probs_segunda, tamanho_fft),
+            tamanho_fft
+        )[:tamanho]
+        np.clip(probs, 0.0, None, out=probs)
+    return offset_primeira + offset_segunda, probs
+
+
+def profundidade_explosao(faces):
+    # Quantas explosões em cadeia entram na distribuição antes de a massa ficar desprezível.
+    return min(limite_explosoes, math.ceil(-math.log(precisao_explosao) / math.log(faces)))
+
+
+def tamanho_distribuicao_dado(minimo, maximo, explodir):
+    # len(distribuicao_dado(...)[1]) sem montar o array: cada nível de explosão soma `faces` valores.
+    faces = maximo - minimo + 1
+    return faces * (profundidade_explosao(faces) + 2) if explodir else faces
+
+
+@memorizar_distribuicao
+def distribuicao_dado(minimo, maximo, rerrolar_ate=None, explodir=False):
+    # Distribuição de um único dado com os modificadores de rerrolagem e explosão.
+    faces = maximo - minimo + 1
+    uniforme = np.full(faces, 1.0 / faces)
+    probs = uniforme.copy()
+    if rerrolar_ate is not None:
+        # Rerrolagem única: a massa das faces <= N é redistribuída uniformemente.
+        corte = rerrolar_ate - minimo + 1
+        massa = probs[:corte].sum()
+        probs[:corte] = 0.0
+        probs += massa * uniforme
+
+    if explodir:
+        # Cada máximo soma outro dado (que também explode); trunca quando a massa é desprezível.
+        profundidade = profundidade_explosao(faces)
+        cadeia = uniforme
+        # Índice i vale minimo + i; "máximo + cadeia" desloca a cadeia em `faces` posições.
+        for _ in range(profundidade):
+            proxima = np.zeros(len(cadeia) + faces)
+            proxima[:faces - 1] = uniforme[:-1]
+            proxima[faces:] = cadeia / faces
+            cadeia = proxima
+        explodida = np.zeros(len(cadeia) + faces)
+        explodida[:faces - 1] = probs[:-1]
+        explodida[faces:] = probs[-1] * cadeia
+        probs = explodida
+
+    probs.flags.writeable = False
+    return minimo, probs
+
+
+@memorizar_distribuicao
+def distribuicao_soma_dados(minimo, maximo, rerrolar_ate, explodir, quantidade):
+    # Distribuição da soma de `quantidade` dados iguais, por quadrados sucessivos memoizados.
+    if quantidade == 0:
+        return 0, np.ones(1)
+    if quantidade == 1:
+        return distribuicao_dado(minimo, maximo, rerrolar_ate, explodir)
+    metade = distribuicao_soma_dados(minimo, maximo, rerrolar_ate, explodir, quantidade // 2)
+    resultado = convoluir_distribuicoes(metade, metade)
+    if quantidade % 2:
+        resultado = convoluir_distribuicoes(resultado, distribuicao_dado(minimo, maximo, rerrolar_ate, explodir))
+    resultado[1].flags.writeable = False
+    return resultado
+
+
+def distribuicao_plano(plano):
+    # Distribuição exata do total de um `PlanoRolagem` (ValueError se não suportado).
+    distribuicao = (plano.bonus, np.ones(1))
+    for termo in plano.termos:
+        if termo.manter is not None:
+            raise ValueError('`prob` não calcula `kh`/`kl`.')
+        # Suporte real do grupo: cada dado explodido chega a bem mais que o dobro das faces.
+        suporte = termo.quantidade * (tamanho_distribuicao_dado(termo.minimo, termo.maximo, termo.explodir) - 1) + 1
+        if len(distribuicao[1]) + suporte > limite_suporte_probabilidade:
+            raise ValueError('expressão grande demais para calcular exatamente.')
+
+        offset, probs = distribuicao_soma_dados(
+            termo.minimo, termo.maximo, termo.rerrolar_ate, termo.explodir, termo.quantidade
+        )
+        if termo.sinal < 0:
+            offset, probs = -(offset + len(probs) - 1), probs[::-1]
+        distribuicao = convoluir_distribuicoes(distribuicao, (offset, probs))
+    return distribuicao
+
+
+def formatar_porcentagem(probabilidade):
+    # Porcentagem curta, sem mostrar 0% para eventos raros porém possíveis.
+    if 0 < probabilidade < 0.0001:
+        return '<0.01%'
+    return f'{probabilidade * 100:.2f}%'
+
+
+def calcular_probabilidades(expressao, alvo=None):
+    # Monta o texto de `!prob`/`/prob`: P(total >= alvo), média e escala Fate.
+    match = regex_expressao_dados.match(expressao.strip())
+    if not match:
+        raise ValueError('expressão inválida. Exemplos: `4df+2 >= 3`, `3d10-1 >= 12`.')
+    plano = compilar_expressao_dados(normalizar_expressao_dados(match.group(1)))
+
+    if alvo is None and match.group(2):
+        texto = match.group(2).strip()
+        match_alvo = regex_alvo_probabilidade.search(texto)
+        if match_alvo:
+            alvo = int(match_alvo.group(1))
+        elif '>' in texto or '≥' in texto:
+            raise ValueError('não entendi o alvo; use `>= N` no fim, ex.: `4df atacar >= 2`.')
+
+    offset, probs = distribuicao_plano(plano)
+    valores = np.arange(offset, offset + len(probs))
+    total_probs = probs.sum()
+    media = round(float(np.dot(valores, probs) / total_probs), 2) + 0.0
+
+    linhas = [f'Probabilidades de `{match.group(1)}` (de {offset} a {offset + len(probs) - 1}, média {media:.2f}):']
+    if alvo is not None:
+        indice_alvo = min(max(alvo - offset, 0), len(probs))
+        linhas.append(f'P(total ≥ {alvo}): **{formatar_porcentagem(probs[indice_alvo:].sum() / total_probs)}**')
+
+    if plano.fate:
+        # Escala JJK: extremos são faixas abertas (>= 9 e <= -4).
+        linhas.append('Escala:')
+        for total_escala in range(9, -5, -1):
+            if total_escala == 9:
+                probabilidade = probs[max(9 - offset, 0):].sum()
+            elif total_escala == -4:
+                probabilidade = probs[:max(-4 - offset + 1, 0)].sum()
+            elif offset <= total_escala < offset + len(probs):
+                probabilidade = probs[total_escala - offset]
+            else:
+                probabilidade = 0.0
+            if probabilidade > 0:
+                linhas.append(f'- {escala_adjetivos_jjk(total_escala)}: {formatar_porcentagem(probabilidade / total_probs)}')
+    return '\n'.join(linhas)
+
+
+# -----------------------------------------------------------------------------
+# HISTÓRICO DE ROLAGENS POR CANAL
+#
+# - Cada canal guarda as últimas `capacidade_historico_canal` rolagens em um
+#   buffer circular de arrays compactos (usuário, total, marcadores, horário).
+# - Agregados do canal e de cada usuário no canal são atualizados a cada
+#   rolagem, então `!stats` responde em O(1), sem varrer o histórico.
+# - Memória limitada: buffer de tamanho fixo, usuários e canais em LRU.
+# -----------------------------------------------------------------------------
+
+capacidade_historico_canal = 256
+limite_usuarios_historico_canal = 200
+limite_canais_historico = 1000
+
+# Marcadores (bits) gravados junto de cada rolagem.
+marcador_mais_quatro = 1
+marcador_menos_quatro = 2
+marcador_black_flash = 4
+marcador_forcado = 8
+
+# Totais fora do int64 são saturados no buffer (os agregados usam int do Python).
+limite_total_historico = 2**63 - 1
+
+
+class EstatisticasRolagem:
+    # Agregados incrementais de rolagens: contagem, soma, ++++, ---- e Black Flash.
+    __slots__ = ('rolagens', 'soma_totais', 'mais_quatro', 'menos_quatro', 'black_flash')
+
+    def __init__(self):
+        self.rolagens = 0
+        self.soma_totais = 0
+        self.mais_quatro = 0
+        self.menos_quatro = 0
+        self.black_flash = 0
+
+    def registrar(self, total, marcadores):
+        self.rolagens += 1
+        self.soma_totais += total
+        if marcadores & marcador_mais_quatro:
+            self.mais_quatro += 1
+        if marcadores & marcador_menos_quatro:
+            self.menos_quatro += 1
+        if marcadores & marcador_black_flash:
+            self.black_flash += 1
+
+    @property
+    def media(self):
+        return self.soma_totais / self.rolagens if self.rolagens else 0.0
+
+
+class HistoricoCanal:
+    # Buffer circular de rolagens de um canal + agregados do canal e por usuário.
+    __slots__ = ('usuarios', 'totais', 'marcadores', 'momentos', 'proximo', 'preenchidos', 'estatisticas', 'estatisticas_usuarios')
+
+    def __init__(self, capacidade=capacidade_historico_canal):
+        self.usuarios = array.array('Q', bytes(8 * capacidade))
+        self.totais = array.array('q', bytes(8 * capacidade))
+        self.marcadores = array.array('B', bytes(capacidade))
+        self.momentos = array.array('d', bytes(8 * capacidade))
+        self.proximo = 0
+        self.preenchidos = 0
+        self.estatisticas = EstatisticasRolagem()
+        self.estatisticas_usuarios = collections.OrderedDict()
+
+    def registrar(self, usuario_id, total, marcadores):
+        capacidade = len(self.totais)
+        posicao = self.proximo
+        self.usuarios[posicao] = usuario_id
+        self.totais[posicao] = max(-limite_total_historico, min(total, limite_total_historico))
+        self.marcadores[posicao] = marcadores
+        self.momentos[posicao] = time.time()
+        self.proximo = (posicao + 1) % capacidade
+        self.preenchidos = min(self.preenchidos + 1, capacidade)
+
+        self.estatisticas.registrar(total, marcadores)
+        estatisticas_usuario = self.estatisticas_usuarios.get(usuario_id)
+        if estatisticas_usuario is None:
+            estatisticas_usuario = self.estatisticas_usuarios[usuario_id] = EstatisticasRolagem()
+            if len(self.estatisticas_usuarios) > limite_usuarios_historico_canal:
+                self.estatisticas_usuarios.popitem(last=False)
+        else:
+            self.estatisticas_usuarios.move_to_end(usuario_id)
+        estatisticas_usuario.registrar(total, marcadores)
+
+
+historicos_canais = collections.OrderedDict()
+
+
+def registrar_rolagem(canal_id, usuario_id, total, marcadores=0, guild_id=None, expressao='', grupos=()):
+    # Registra uma rolagem no log de auditoria e no histórico do canal (canais menos ativos saem por LRU).
+    registrar_auditoria(guild_id, usuario_id, expressao, grupos, total, marcadores)
+    if canal_id is None:
+        return
+    historico = historicos_canais.get(canal_id)
+    if historico is None:
+        historico = historicos_canais[canal_id] = HistoricoCanal()
+        if len(historicos_canais) > limite_canais_historico:
+            historicos_canais.popitem(last=False)
+    else:
+        historicos_canais.move_to_end(canal_id)
+    historico.registrar(usuario_id, total, marcadores)
+
+
+def marcadores_fate(rolls_fate, acao_fate, forcagem_teste=None):
+    # Calcula os marcadores de uma rolagem Fate já resolvida.
+    marcadores = 0
+    if rolls_fate == ['+','+','+','+']:
+        marcadores |= marcador_mais_quatro
+        if acao_fate == 'Atacar':
+            marcadores |= marcador_black_flash
+    elif rolls_fate == ['-','-','-','-']:
+        marcadores |= marcador_menos_quatro
+    if forcagem_teste:
+        marcadores |= marcador_forcado
+    return marcadores
+
+
+def formatar_estatisticas(estatisticas):
+    # Linha de resumo de um `EstatisticasRolagem`.
+    if not estatisticas.rolagens:
+        return 'nenhuma rolagem ainda'
+    return (
+        f'**{estatisticas.rolagens}** rolagens · média **{estatisticas.media:.2f}** · '
+        f'++++: **{estatisticas.mais_quatro}** · ----: **{estatisticas.menos_quatro}** · '
+        f'Black Flash: **{estatisticas.black_flash}**'
+    )
+
+
+# -----------------------------------------------------------------------------
+# AUDITORIA DE ROLAGENS
+#
+# - Toda rolagem vira um registro binário de largura fixa, anexado ao arquivo
+#   `auditoria_rolagens.bin` (horário, guild, usuário, hash da expressão,
+#   quantidade/faces, até 8 primeiros dados, total e marcadores, incluindo
+#   o de resultado forçado por `max`/`min`).
+# - Registros são acumulados em memória e gravados em lote por uma task em
+#   segundo plano (a escrita roda em thread), nunca no handler do comando.
+# - Consultas mapeiam o arquivo com `mmap` e filtram com NumPy direto sobre o
+#   mapeamento, sem carregar o arquivo para a memória do processo.
+# -----------------------------------------------------------------------------
+
+caminho_auditoria = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'auditoria_rolagens.bin')
+intervalo_gravacao_auditoria = 2.0
+# Quantidade de dados individuais guardados por registro.
+dados_por_registro_auditoria = 8
+# Valor gravado nas posições sem dado (ou com valor fora do int16).
+dado_ausente_auditoria = -32768
+
+formato_auditoria = struct.Struct(f'<dQQQqIi{dados_por_registro_auditoria}hB3x')
+tipo_registro_auditoria = np.dtype([
+    ('momento', '<f8'),
+    ('guild', '<u8'),
+    ('usuario', '<u8'),
+    ('expressao', '<u8'),
+    ('total', '<i8'),
+    ('quantidade', '<u4'),
+    ('faces', '<i4'),
+    ('dados', '<i2', (dados_por_registro_auditoria,)),
+    ('marcadores', 'u1'),
+    ('_reservado', 'V3'),
+])
+
+registros_auditoria_pendentes = []
+trava_auditoria = threading.Lock()
+# Hash -> expressão original, para exibir consultas recentes de forma legível.
+expressoes_auditoria = collections.OrderedDict()
+limite_expressoes_auditoria = 4096
+gravacao_auditoria_iniciada = False
+
+
+def hash_expressao_auditoria(expressao):
+    # Hash estável de 64 bits da expressão normalizada.
+    expressao = normalizar_expressao_dados(expressao or '')
+    valor = int.from_bytes(hashlib.blake2b(expressao.encode('utf-8'), digest_size=8).digest(), 'little')
+    expressoes_auditoria[valor] = expressao
+    expressoes_auditoria.move_to_end(valor)
+    if len(expressoes_auditoria) > limite_expressoes_auditoria:
+        expressoes_auditoria.popitem(last=False)
+    return valor
+
+
+def resumir_dados_auditoria(grupos):
+    # Quantidade total, faces (0 = Fate, -1 = faces mistas) e primeiros valores dos grupos de dados.
+    quantidade = 0
+    faces = None
+    primeiros = []
+    for dados in grupos:
+        quantidade += dados.quantidade
+        faces_grupo = 0 if dados.minimo == -1 and dados.maximo == 1 else dados.maximo
+        faces = faces_grupo if faces in (None, faces_grupo) else -1
+        if dados.listavel and len(primeiros) < dados_por_registro_auditoria:
+            primeiros.extend(dados.valores[:dados_por_registro_auditoria - len(primeiros)])
+    primeiros = [valor if -32768 < valor < 32768 else dado_ausente_auditoria for valor in primeiros]
+    primeiros += [dado_ausente_auditoria] * (dados_por_registro_auditoria - len(primeiros))
+    return min(quantidade, 2**32 - 1), max(-2**31, min(faces or 0, 2**31 - 1)), primeiros
+
+
+def registrar_auditoria(guild_id, usuario_id, expressao, grupos, total, marcadores):
+    # Empacota o registro e o deixa na fila de gravação (sem I/O aqui).
+    quantidade, faces, primeiros = resumir_dados_auditoria(grupos)
+    registros_auditoria_pendentes.append(formato_auditoria.pack(
+        time.time(),
+        guild_id or 0,
+        usuario_id,
+        hash_expressao_auditoria(expressao),
+        max(-limite_total_historico, min(total, limite_total_historico)),
+        quantidade,
+        faces,
+        *primeiros,
+        marcadores,
+    ))
+
+
+def _anexar_auditoria(blocos):
+    # Grava os registros no fim do arquivo (roda fora do loop de eventos).
+    with trava_auditoria, open(caminho_auditoria, 'ab') as arquivo:
+        arquivo.write(b''.join(blocos))
+
+
+def descarregar_auditoria():
+    # Grava de forma síncrona o que estiver pendente (usado no encerramento).
+    global registros_auditoria_pendentes
+    blocos, registros_auditoria_pendentes = registros_auditoria_pendentes, []
+    if blocos:
+        _anexar_auditoria(blocos)
+
+
+async def descarregar_auditoria_async():
+    # Grava em thread, num único lote, os registros acumulados até agora.
+    global registros_auditoria_pendentes
+    blocos, registros_auditoria_pendentes = registros_auditoria_pendentes, []
+    if not blocos:
+        return
+    try:
+        await asyncio.to_thread(_anexar_auditoria, blocos)
+    except OSError as erro:
+        print(f'Erro ao gravar auditoria: {erro}')
+        registros_auditoria_pendentes = blocos + registros_auditoria_pendentes
+
+
+async def gravar_auditoria_periodicamente():
+    # Task de fundo: a cada intervalo, grava em lote os registros acumulados.
+    while True:
+        await asyncio.sleep(intervalo_gravacao_auditoria)
+        await descarregar_auditoria_async()
+
+
+atexit.register(descarregar_auditoria)
+
+
+def consultar_auditoria(usuario_id=None, guild_id=None, desde=None, apenas_forcadas=False, limite=20):
+    # Varre o log via mmap; devolve (total de ocorrências, últimos `limite` registros).
+    try:
+        arquivo = open(caminho_auditoria, 'rb')
+    except FileNotFoundError:
+        return 0, []
+
+    with arquivo:
+        tamanho = os.fstat(arquivo.fileno()).st_size
+        quantidade = tamanho // tipo_registro_auditoria.itemsize
+        if not quantidade:
+            return 0, []
+        with mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ) as mapa:
+            registros = np.frombuffer(mapa, dtype=tipo_registro_auditoria, count=quantidade)
+            mascara = np.ones(quantidade, dtype=bool)
+            if usuario_id is not None:
+                mascara &= registros['usuario'] == usuario_id
+            if guild_id is not None:
+                mascara &= registros['guild'] == guild_id
+            if desde is not None:
+                mascara &= registros['momento'] >= desde
+            if apenas_forcadas:
+                mascara &= (registros['marcadores'] & marcador_forcado) != 0
+            indices = np.flatnonzero(mascara)
+            # Copia só os registros que vão ser exibidos, antes de fechar o mapeamento.
+            selecionados = registros[indices[-limite:]].copy() if limite else registros[:0].copy()
+            del registros
+    return len(indices), selecionados
+
+
+def formatar_registro_auditoria(registro):
+    # Linha legível de um registro de auditoria.
+    momento = datetime.datetime.fromtimestamp(float(registro['momento'])).strftime('%d/%m %H:%M:%S')
+    expressao = expressoes_auditoria.get(int(registro['expressao']), f"#{int(registro['expressao']):016x}")
+    dados = [int(valor) for valor in registro['dados'] if valor != dado_ausente_auditoria]
+    if int(registro['faces']) == 0:
+        dados_texto = ', '.join(fate_dice.get(valor, str(valor)) for valor in dados)
+    else:
+        dados_texto = ', '.join(str(valor) for valor in dados)
+    marcadores = int(registro['marcadores'])
+    extras = []
+    if marcadores & marcador_forcado:
+        extras.append('**FORÇADA**')
+    if marcadores & marcador_black_flash:
+        extras.append('Black Flash')
+    elif marcadores & marcador_mais_quatro:
+        extras.append('++++')
+    if marcadores & marcador_menos_quatro:
+        extras.append('----')
+    return (
+        f"`{momento}` <@{int(registro['usuario'])}> `{expressao}` [{dados_texto}] "
+        f"= **{int(registro['total'])}** {' '.join(extras)}"
+    ).rstrip()
+
+
+# -----------------------------------------------------------------------------
+# ESTADO PERSISTENTE (banidos, admins, usuários de teste e temas)
+#
+# - Guardado em SQLite no modo WAL (`estado_bot.db`), indexado pela chave
+#   primária de cada tabela.
+# - Na inicialização tudo é carregado para sets/dicts; os handlers só
+#   consultam e alteram a memória (lookup O(1) no caminho quente).
+# - Cada alteração entra numa fila coalescida por chave (a última vence) e é
+#   gravada em lote por uma task em segundo plano, com a escrita em thread.
+# -----------------------------------------------------------------------------
+
+caminho_estado = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'estado_bot.db')
+intervalo_gravacao_estado = 1.0
+
+# Papéis da tabela `membros` e o set em memória correspondente.
+papeis_estado = {'banido': usuarios_banidos, 'admin': ids_admin, 'teste': usuarios_teste}
+
+# (tabela, papel, usuário) -> novo valor; None/False remove a linha.
+alteracoes_estado_pendentes = {}
+trava_estado = threading.Lock()
+
+
+def abrir_estado():
+    # Abre o banco em modo WAL, criando as tabelas na primeira vez.
+    conexao = sqlite3.connect(caminho_estado)
+    conexao.execute('PRAGMA journal_mode=WAL')
+    conexao.execute('PRAGMA synchronous=NORMAL')
+    conexao.executescript('''
+        CREATE TABLE IF NOT EXISTS membros (
+            papel TEXT NOT NULL,
+            usuario_id INTEGER NOT NULL,
+            PRIMARY KEY (papel, usuario_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS temas (
+            usuario_id INTEGER PRIMARY KEY,
+            link TEXT NOT NULL
+        );
+    ''')
+    return conexao
+
+
+def carregar_estado():
+    # Carrega o banco para memória (uma vez, na inicialização).
+    # Num banco novo, grava antes os banidos/admins definidos no código.
+    with trava_estado, contextlib.closing(abrir_estado()) as conexao:
+        with conexao:
+            if conexao.execute('PRAGMA user_version').fetchone()[0] == 0:
+                conexao.executemany(
+                    'INSERT OR IGNORE INTO membros (papel, usuario_id) VALUES (?, ?)',
+                    [(papel, usuario_id) for papel, conjunto in papeis_estado.items() for usuario_id in conjunto]
+                )
+                conexao.execute('PRAGMA user_version = 1')
+        membros = conexao.execute('SELECT papel, usuario_id FROM membros').fetchall()
+        temas = conexao.execute('SELECT usuario_id, link FROM temas').fetchall()
+
+    # Atualiza no lugar: o resto do módulo guarda referências a esses objetos.
+    for conjunto in papeis_estado.values():
+        conjunto.clear()
+    for papel, usuario_id in membros:
+        if papel in papeis_estado:
+            papeis_estado[papel].add(usuario_id)
+    temas_usuario.clear()
+    temas_usuario.update(temas)
+
+
+def definir_papel_usuario(papel, usuario_id, ativo):
+    # Liga/desliga um papel em memória e agenda a gravação (sem I/O aqui).
+    if ativo:
+        papeis_estado[papel].add(usuario_id)
+    else:
+        papeis_estado[papel].discard(usuario_id)
+    alteracoes_estado_pendentes[('membros', papel, usuario_id)] = ativo
+
+
+def definir_tema_usuario(usuario_id, link):
+    # Salva o tema em memória e agenda a gravação (sem I/O aqui).
+    temas_usuario[usuario_id] = link
+    alteracoes_estado_pendentes[('temas', None, usuario_id)] = link
+
+
+def _gravar_estado(alteracoes):
+    # Aplica um lote de alterações numa única transação (roda fora do loop de eventos).
+    with trava_estado, contextlib.closing(abrir_estado()) as conexao, conexao:
+        for (tabela, papel, usuario_id), valor in alteracoes.items():
+            if tabela == 'membros' and valor:
+                conexao.execute('INSERT OR IGNORE INTO membros (papel, usuario_id) VALUES (?, ?)', (papel, usuario_id))
+            elif tabela == 'membros':
+                conexao.execute('DELETE FROM membros WHERE papel = ? AND usuario_id = ?', (papel, usuario_id))
+            elif valor:
+                conexao.execute('INSERT OR REPLACE INTO temas (usuario_id, link) VALUES (?, ?)', (usuario_id, valor))
+            else:
+                conexao.execute('DELETE FROM temas WHERE usuario_id = ?', (usuario_id,))
+
+
+def descarregar_estado():
+    # Grava de forma síncrona o que estiver pendente (usado no encerramento).
+    global alteracoes_estado_pendentes
+    alteracoes, alteracoes_estado_pendentes = alteracoes_estado_pendentes, {}
+    if alteracoes:
+        _gravar_estado(alteracoes)
+
+
+async def descarregar_estado_async():
+    # Grava em thread, numa única transação, as alterações acumuladas até agora.
+    global alteracoes_estado_pendentes
+    alteracoes, alteracoes_estado_pendentes = alteracoes_estado_pendentes, {}
+    if not alteracoes:
+        return
+    try:
+        await asyncio.to_thread(_gravar_estado, alteracoes)
+    except sqlite3.Error as erro:
+        print(f'Erro ao gravar estado: {erro}')
+        # Devolve à fila sem sobrescrever alterações mais novas da mesma chave.
+        alteracoes.update(alteracoes_estado_pendentes)
+        alteracoes_estado_pendentes = alteracoes
+
+
+async def gravar_estado_periodicamente():
+    # Task de fundo: a cada intervalo, grava em lote as alterações acumuladas.
+    while True:
+        await asyncio.sleep(intervalo_gravacao_estado)
+        await descarregar_estado_async()
+
+
+atexit.register(descarregar_estado)
+
+
 def normalizar_acao_fate(texto):
     # Normaliza ações Fate aceitas para um formato padronizado.
     if not texto:
@@ -232,6 +1796,15 @@ def extrair_acao_e_complemento_fate(texto):
     return acao_fate, complemento
 
 
+def extrair_texto_fate(texto, usuario_id):
+    # Texto depois de um `4df`: (ação, complemento, forçado); o token max/min só vale no modo de teste.
+    acao, complemento = extrair_acao_e_complemento_fate(texto)
+    forcado = None
+    if acao and usuario_id in usuarios_teste:
+        forcado, complemento = extrair_forcagem_teste(complemento)
+    return acao, complemento, forcado
+
+
 def extrair_forcagem_teste(texto):
     # Extrai token de teste (max/min) e devolve o restante da mensagem.
     if not texto:
@@ -281,204 +1854,1705 @@ def eh_admin(usuario_id):
     return usuario_id in ids_admin
 
 
-async def tocar_kokusen_no_voz(usuario, canal_texto):
-    # Toca kokusen.ogg no canal de voz do usuário e retoma playlist se necessário.
-    try:
-        guild = canal_texto.guild
-        if guild is None:
-            return
+# -----------------------------------------------------------------------------
+# EFEITOS SONOROS EM MEMÓRIA
+#
+# - Efeitos locais (ex.: `kokusen.ogg`) são registrados por nome e, na
+#   inicialização, o Ogg é demultiplexado em Python puro: os pacotes Opus ficam
+#   em memória, prontos para enviar ao Discord sem ffmpeg e sem re-encode.
+# - Só dá para enviar direto Opus estéreo em quadros de 20 ms (o que o Discord
+#   espera a cada leitura); outros arquivos caem no ffmpeg normalmente.
+# - Novo efeito = `registrar_efeito_sonoro('nome', 'arquivo.ogg')` + `criar_fonte_efeito('nome')`.
+# -----------------------------------------------------------------------------
 
-        if isinstance(usuario, discord.Member):
-            membro = usuario
-        else:
-            membro = guild.get_member(usuario.id)
-            if membro is None:
-                return
+# Nome -> {'caminho': arquivo, 'pacotes': lista de pacotes Opus ou None (usa ffmpeg)}.
+efeitos_sonoros = {}
+efeitos_sonoros_carregados = False
 
-        if membro.voice is None or membro.voice.channel is None:
-            return
+# Duração (ms) de um quadro Opus por `config` do byte TOC (RFC 6716, seção 3.1).
+duracoes_quadro_opus = (
+    [10, 20, 40, 60] * 3        # SILK (0-11)
+    + [10, 20] * 2              # híbrido (12-15)
+    + [2.5, 5, 10, 20] * 4      # CELT (16-31)
+)
 
-        canal_voz = membro.voice.channel
-        voice_client = guild.voice_client
 
-        # Se a playlist estiver tocando, prepara retomada depois que o kokusen terminar.
-        interrompeu_playlist = preparar_interrupcao_playlist(guild.id, voice_client)
+class FontePacotesOpus(discord.AudioSource):
+    # Fonte de áudio que entrega pacotes Opus já prontos, um por leitura (20 ms).
+    __slots__ = ('pacotes', 'posicao')
 
-        if voice_client is None:
-            voice_client = await canal_voz.connect()
-        elif voice_client.channel != canal_voz:
-            await voice_client.move_to(canal_voz)
+    def __init__(self, pacotes):
+        self.pacotes = pacotes
+        self.posicao = 0
 
-        caminho_audio = os.path.join(os.path.dirname(__file__), 'kokusen.ogg')
-        if not os.path.isfile(caminho_audio):
-            await canal_texto.send('Arquivo `kokusen.ogg` não encontrado.')
-            return
+    def read(self):
+        if self.posicao >= len(self.pacotes):
+            return b''
+        pacote = self.pacotes[self.posicao]
+        self.posicao += 1
+        return pacote
 
-        if voice_client.is_playing():
-            # Stop dispara o `after` da faixa atual; o bloqueio de autoavanço evita conflito.
-            voice_client.stop()
+    def is_opus(self):
+        return True
 
-        def ao_terminar(erro):
-            if erro:
-                print(f'Erro ao tocar kokusen.ogg: {erro}')
-            if interrompeu_playlist:
-                client.loop.call_soon_threadsafe(asyncio.create_task, retomar_playlist_interrompida(guild.id, canal_texto))
 
-        voice_client.play(
-            discord.FFmpegPCMAudio(caminho_audio, executable=obter_ffmpeg_executavel()),
-            after=ao_terminar
-        )
-    except Exception as erro:
-        await canal_texto.send(f'Não consegui tocar `kokusen.ogg` no canal de voz. Erro: `{erro}`')
+def ler_pacotes_ogg(dados):
+    # Demultiplexa um arquivo Ogg: devolve a lista de pacotes do primeiro stream lógico.
+    pacotes = []
+    atual = bytearray()
+    posicao = 0
+    serial = None
+    while posicao < len(dados):
+        if dados[posicao:posicao + 4] != b'OggS' or posicao + 27 > len(dados):
+            raise ValueError('Arquivo Ogg inválido.')
+        serial_pagina = struct.unpack_from('<I', dados, posicao + 14)[0]
+        quantidade_segmentos = dados[posicao + 26]
+        tabela = dados[posicao + 27:posicao + 27 + quantidade_segmentos]
+        posicao += 27 + quantidade_segmentos
+        if serial is None:
+            serial = serial_pagina
+        for tamanho in tabela:
+            if serial_pagina == serial:
+                atual += dados[posicao:posicao + tamanho]
+                # Segmento com menos de 255 bytes fecha o pacote.
+                if tamanho < 255:
+                    pacotes.append(bytes(atual))
+                    atual.clear()
+            posicao += tamanho
+    return pacotes
+
+
+def duracao_pacote_opus(pacote):
+    # Duração (ms) de um pacote Opus a partir do byte TOC.
+    if not pacote:
+        return 0
+    toc = pacote[0]
+    codigo = toc & 3
+    if codigo == 0:
+        quadros = 1
+    elif codigo in (1, 2):
+        quadros = 2
+    else:
+        quadros = pacote[1] & 0x3F if len(pacote) > 1 else 0
+    return duracoes_quadro_opus[toc >> 3] * quadros
+
+
+def extrair_pacotes_opus(caminho):
+    # Pacotes de áudio de um Ogg Opus enviável direto, ou None se precisar do ffmpeg.
+    with open(caminho, 'rb') as arquivo:
+        pacotes = ler_pacotes_ogg(arquivo.read())
+    if len(pacotes) < 3 or not pacotes[0].startswith(b'OpusHead') or not pacotes[1].startswith(b'OpusTags'):
+        return None
+    if pacotes[0][9] != 2:
+        return None
+    audio = pacotes[2:]
+    if any(duracao_pacote_opus(pacote) != 20 for pacote in audio):
+        return None
+    return audio
 
 
-async def tocar_audio_url_no_voz(usuario, canal_texto, audio_url):
-    # Toca um áudio de URL (tema do usuário) no canal de voz do usuário.
-    try:
-        guild = canal_texto.guild
-        if guild is None:
-            return
+def registrar_efeito_sonoro(nome, arquivo):
+    # Registra um efeito local (caminho relativo à pasta do bot).
+    caminho = os.path.join(os.path.dirname(os.path.abspath(__file__)), arquivo)
+    efeitos_sonoros[nome] = {'caminho': caminho, 'pacotes': None}
 
-        if isinstance(usuario, discord.Member):
-            membro = usuario
-        else:
-            membro = guild.get_member(usuario.id)
-            if membro is None:
-                return
 
-        if membro.voice is None or membro.voice.channel is None:
-            return
+def carregar_efeitos_sonoros():
+    # Lê e demultiplexa todos os efeitos registrados (uma vez, na inicialização).
+    global efeitos_sonoros_carregados
+    efeitos_sonoros_carregados = True
+    for nome, efeito in efeitos_sonoros.items():
+        try:
+            efeito['pacotes'] = extrair_pacotes_opus(efeito['caminho'])
+        except FileNotFoundError:
+            efeito['pacotes'] = None
+        except (OSError, ValueError, IndexError) as erro:
+            print(f'Efeito `{nome}` vai usar ffmpeg: {erro}')
+            efeito['pacotes'] = None
+
+
+def criar_fonte_efeito(nome, guild_id=None):
+    # Fonte de áudio do efeito: pacotes em memória, ou ffmpeg no arquivo; None se não existe.
+    if not efeitos_sonoros_carregados:
+        carregar_efeitos_sonoros()
+    efeito = efeitos_sonoros.get(nome)
+    if efeito is None:
+        return None
+    if efeito['pacotes'] is not None:
+        return FontePacotesOpus(efeito['pacotes'])
+    if os.path.isfile(efeito['caminho']):
+        return criar_fonte_local(efeito['caminho'], guild_id=guild_id)
+    return None
 
-        canal_voz = membro.voice.channel
-        voice_client = guild.voice_client
 
-        # Mesmo comportamento do kokusen: interrompe e agenda retomada da playlist.
-        interrompeu_playlist = preparar_interrupcao_playlist(guild.id, voice_client)
+registrar_efeito_sonoro('kokusen', 'kokusen.ogg')
 
-        if voice_client is None:
-            voice_client = await canal_voz.connect()
-        elif voice_client.channel != canal_voz:
-            await voice_client.move_to(canal_voz)
 
-        stream_url, _titulo = await asyncio.to_thread(_extrair_stream_audio, audio_url)
-        if not stream_url:
-            await canal_texto.send('Não consegui obter o áudio do tema configurado.')
-            return
+# -----------------------------------------------------------------------------
+# FAIXA DO !LUTA COM POSIÇÃO E EFEITOS
+#
+# - Toda faixa do !luta toca embrulhada em `FonteFaixaLuta`, que conta os
+#   quadros de 20 ms lidos: a posição tocada é `inicio + quadros * 0,02 s`.
+# - Tema/kokusen não param a faixa: entram como efeito dentro da própria fonte.
+#   Enquanto o efeito toca, a faixa só deixa de ser lida (o ffmpeg e o stream
+#   já resolvido continuam abertos); no fim do efeito a leitura segue do mesmo
+#   quadro, sem extrair nem reabrir nada.
+# - Com `mixar_efeitos_luta`, o efeito toca por cima da música abaixada para
+#   `volume_fundo_mixagem`. Mixar exige PCM: a faixa é decodificada com a
+#   libopus e o discord.py volta a codificar, o que custa CPU; por isso é opcional.
+# - Se o efeito não puder entrar na fonte (libopus indisponível para converter
+#   o formato), a faixa é parada e a retomada reabre o cache/stream com `-ss`
+#   na posição salva.
+# -----------------------------------------------------------------------------
 
-        if voice_client.is_playing():
-            # Interrompe o que estiver tocando para priorizar o tema do usuário.
-            voice_client.stop()
+mixar_efeitos_luta = False
+volume_fundo_mixagem = 0.25
 
-        def ao_terminar(erro):
-            if erro:
-                print(f'Erro ao tocar tema: {erro}')
-            if interrompeu_playlist:
-                client.loop.call_soon_threadsafe(asyncio.create_task, retomar_playlist_interrompida(guild.id, canal_texto))
-
-        voice_client.play(
-            discord.FFmpegPCMAudio(
-                stream_url,
-                executable=obter_ffmpeg_executavel(),
-                before_options='-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-                options='-vn'
-            ),
-            after=ao_terminar
-        )
-    except Exception as erro:
-        await canal_texto.send(f'Não consegui tocar o tema no canal de voz. Erro: `{erro}`')
+# Um quadro de áudio do Discord: 20 ms de PCM s16le estéreo a 48 kHz.
+duracao_quadro_audio = discord.opus.Encoder.FRAME_LENGTH / 1000
+quadro_pcm_silencio = bytes(discord.opus.Encoder.FRAME_SIZE)
 
 
-async def tocar_audio_ao_mais_quatro(usuario, canal_texto, acao_fate):
-    # No ++++, toca tema do usuário; sem tema, toca kokusen apenas em Atacar.
-    tema_link = temas_usuario.get(usuario.id)
-    if tema_link:
-        await tocar_audio_url_no_voz(usuario, canal_texto, tema_link)
-        return
+class FonteOpusParaPcm(discord.AudioSource):
+    # Decodifica uma fonte Opus para PCM (necessário para mixar).
+    __slots__ = ('original', 'decodificador')
 
-    if acao_fate == 'Atacar':
-        await tocar_kokusen_no_voz(usuario, canal_texto)
+    def __init__(self, original):
+        self.original = original
+        self.decodificador = discord.opus.Decoder()
 
+    def read(self):
+        pacote = self.original.read()
+        return self.decodificador.decode(pacote) if pacote else b''
 
-def _extrair_itens_playlist(url):
-    # Extrai URLs das faixas de uma playlist usando yt-dlp.
-    class _YDLLogger:
-        @staticmethod
-        def debug(msg):
-            return
+    def cleanup(self):
+        self.original.cleanup()
 
-        @staticmethod
-        def warning(msg):
-            if 'No supported JavaScript runtime could be found' in msg:
-                return
-            print(f'[yt-dlp] {msg}')
 
-        @staticmethod
-        def error(msg):
-            print(f'[yt-dlp] {msg}')
+class FontePcmParaOpus(discord.AudioSource):
+    # Codifica uma fonte PCM para Opus (para entrar numa faixa que envia Opus direto).
+    __slots__ = ('original', 'codificador')
 
-    player_client = ['android', 'web'] if shutil.which('node') else ['web']
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'logger': _YDLLogger(),
-        'extractor_args': {'youtube': {'player_client': player_client}},
-        'extract_flat': True,
-        'skip_download': True,
-        'noplaylist': False,
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+    def __init__(self, original):
+        self.original = original
+        self.codificador = discord.opus.Encoder()
 
-    entradas = []
-    for entrada in info.get('entries', []):
-        if not entrada:
-            continue
-        if entrada.get('url'):
-            entradas.append(entrada.get('url'))
-        elif entrada.get('id'):
-            entradas.append(f"https://www.youtube.com/watch?v={entrada['id']}")
-    return entradas
+    def read(self):
+        quadro = self.original.read()
+        if not quadro:
+            return b''
+        quadro = quadro.ljust(discord.opus.Encoder.FRAME_SIZE, b'\0')
+        return self.codificador.encode(quadro, discord.opus.Encoder.SAMPLES_PER_FRAME)
 
+    def is_opus(self):
+        return True
 
-def _extrair_stream_audio(url):
-    # Extrai URL direta de stream de áudio para reprodução no Discord.
-    class _YDLLogger:
-        @staticmethod
-        def debug(msg):
-            return
+    def cleanup(self):
+        self.original.cleanup()
 
-        @staticmethod
-        def warning(msg):
-            if 'No supported JavaScript runtime could be found' in msg:
-                return
-            print(f'[yt-dlp] {msg}')
 
-        @staticmethod
-        def error(msg):
-            print(f'[yt-dlp] {msg}')
+def adaptar_formato_fonte(fonte, opus):
+    # Devolve `fonte` entregando Opus (`opus=True`) ou PCM; levanta `OpusNotLoaded` sem libopus.
+    if fonte.is_opus() == opus:
+        return fonte
+    return FontePcmParaOpus(fonte) if opus else FonteOpusParaPcm(fonte)
 
-    player_client = ['android', 'web'] if shutil.which('node') else ['web']
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'logger': _YDLLogger(),
-        'extractor_args': {'youtube': {'player_client': player_client}},
-        'format': 'bestaudio/best',
-        'noplaylist': True,
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-    return info.get('url'), info.get('title', 'Faixa')
 
+def misturar_pcm(fundo, efeito, volume_fundo):
+    # Soma dois quadros PCM s16le, com o fundo abaixado; satura em vez de estourar.
+    amostras_fundo = np.frombuffer(fundo, dtype=np.int16)
+    amostras_efeito = np.frombuffer(efeito, dtype=np.int16)
+    tamanho = max(len(amostras_fundo), len(amostras_efeito))
+    mistura = np.zeros(tamanho, dtype=np.float32)
+    mistura[:len(amostras_fundo)] += amostras_fundo * volume_fundo
+    mistura[:len(amostras_efeito)] += amostras_efeito
+    return np.clip(mistura, -32768, 32767).astype(np.int16).tobytes()
 
-async def tocar_proxima_da_fila(guild_id, canal_texto):
-    # Toca a próxima faixa da fila de !luta e agenda avanço automático.
-    fila = filas_luta.get(guild_id)
-    if not fila:
+
+class FonteFaixaLuta(discord.AudioSource):
+    # Faixa do !luta: conta a posição tocada e recebe efeitos no lugar dela ou por cima.
+    __slots__ = ('original', 'inicio', 'quadros', 'misturar', 'efeito', 'trava')
+
+    def __init__(self, original, inicio=0.0, misturar=False):
+        if misturar:
+            try:
+                original = adaptar_formato_fonte(original, opus=False)
+            except discord.opus.OpusNotLoaded:
+                misturar = False
+        self.original = original
+        self.inicio = inicio
+        self.quadros = 0
+        self.misturar = misturar
+        self.efeito = None
+        # `read` roda na thread de voz; a troca de efeito vem do loop.
+        self.trava = threading.Lock()
+
+    @property
+    def posicao(self):
+        # Segundos da faixa já tocados (contando o ponto de partida).
+        return self.inicio + self.quadros * duracao_quadro_audio
+
+    def inserir_efeito(self, fonte):
+        # Passa a tocar `fonte` no lugar da faixa (ou por cima); substitui o efeito anterior.
+        fonte = adaptar_formato_fonte(fonte, self.is_opus())
+        with self.trava:
+            anterior, self.efeito = self.efeito, fonte
+        if anterior is not None:
+            anterior.cleanup()
+
+    def _ler_faixa(self):
+        quadro = self.original.read()
+        if quadro:
+            self.quadros += 1
+        return quadro
+
+    def read(self):
+        with self.trava:
+            efeito = self.efeito
+            if efeito is not None:
+                quadro = efeito.read()
+                if quadro:
+                    if not self.misturar:
+                        return quadro
+                    # Se a faixa acabar durante o efeito, o fundo vira silêncio.
+                    fundo = self._ler_faixa() or quadro_pcm_silencio
+                    return misturar_pcm(fundo, quadro, volume_fundo_mixagem)
+                self.efeito = None
+                efeito.cleanup()
+            return self._ler_faixa()
+
+    def is_opus(self):
+        return not self.misturar and self.original.is_opus()
+
+    def cleanup(self):
+        with self.trava:
+            efeito, self.efeito = self.efeito, None
+        if efeito is not None:
+            efeito.cleanup()
+        self.original.cleanup()
+
+
+def faixa_luta_tocando(voice_client):
+    # `FonteFaixaLuta` que o voice client está tocando agora, ou None.
+    if voice_client is None or not voice_client.is_playing():
+        return None
+    fonte = voice_client.source
+    return fonte if isinstance(fonte, FonteFaixaLuta) else None
+
+
+# -----------------------------------------------------------------------------
+# ATOR DE ÁUDIO POR GUILD
+#
+# - Toda operação de voz de uma guild (tocar a playlist, interromper com
+#   tema/kokusen, retomar, pular, parar) vira um comando na caixa de entrada
+#   do ator da guild; uma única task executa os comandos em ordem.
+# - O estado da playlist só é alterado dentro dessa task, então não há corrida
+#   entre um ++++ e uma troca de faixa.
+# - Nada lento roda dentro do ator: a conexão de voz (`conectar_voz`) é feita
+#   por quem posta o comando, o stream das faixas é resolvido numa task à parte
+#   (`_resolver_faixa_luta`) e os avisos no canal saem por `avisar`.
+# - O ator de uma guild sem playlist é liberado (task e caixa somem) quando a
+#   playlist acaba/é parada ou a conexão ociosa é desfeita; o próximo comando cria outro.
+# - Os callbacks `after` do discord.py (thread de voz) só postam um evento na
+#   caixa. Cada reprodução tem um número de geração; o fim de uma reprodução
+#   substituída (ex.: disparado por `stop()`) chega com geração velha e é ignorado.
+# -----------------------------------------------------------------------------
+
+# guild -> AtorAudio. O ator é liberado quando a guild fica sem playlist (ou desconecta).
+atores_audio = {}
+# Gerações são únicas entre atores: um evento velho nunca casa com um ator recriado.
+contador_geracoes_audio = itertools.count(1)
+
+
+class AtorAudio:
+    # Task única de áudio de uma guild, com caixa de entrada de comandos.
+    __slots__ = ('guild_id', 'caixa', 'geracao', 'tarefa', 'liberar')
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.caixa = asyncio.Queue()
+        self.geracao = next(contador_geracoes_audio)
+        self.liberar = False
+        self.tarefa = asyncio.ensure_future(self._processar())
+        self.tarefa.add_done_callback(self._encerrado)
+
+    async def _processar(self):
+        # Executa os comandos da caixa, um de cada vez, na ordem de chegada.
+        while True:
+            funcao, args, futuro = await self.caixa.get()
+            try:
+                resultado = await funcao(*args)
+            except asyncio.CancelledError:
+                # Cancelamento vindo de dentro do comando (ex.: um `await` numa task cancelada)
+                # derruba só esse comando; o da própria task do ator (desligamento) sobe.
+                if futuro is not None:
+                    futuro.cancel()
+                if getattr(self.tarefa, 'cancelling', lambda: 0)():
+                    raise
+                print(f'Comando de áudio cancelado na guild {self.guild_id}: {funcao.__name__}')
+            except Exception as erro:
+                if futuro is None:
+                    print(f'Erro no áudio da guild {self.guild_id}: {erro}')
+                elif not futuro.done():
+                    futuro.set_exception(erro)
+            else:
+                if futuro is not None and not futuro.done():
+                    futuro.set_result(resultado)
+            # Sem nada na caixa e sem playlist, a task e a caixa deixam de existir.
+            if self.liberar and self.caixa.empty() and self.guild_id not in estados_luta:
+                if atores_audio.get(self.guild_id) is self:
+                    del atores_audio[self.guild_id]
+                return
+
+    def _encerrado(self, _tarefa):
+        # A task terminou (liberada ou cancelada): sai do registro, e quem esperava
+        # um comando que ficou na caixa recebe cancelamento em vez de esperar para sempre.
+        if atores_audio.get(self.guild_id) is self:
+            del atores_audio[self.guild_id]
+        while not self.caixa.empty():
+            _funcao, _args, futuro = self.caixa.get_nowait()
+            if futuro is not None:
+                futuro.cancel()
+
+    def postar(self, funcao, *args):
+        # Enfileira um comando sem esperar o resultado (no ator atual da guild, se este já foi liberado).
+        if atores_audio.get(self.guild_id) is not self:
+            ator_audio(self.guild_id).postar(funcao, *args)
+            return
+        self.caixa.put_nowait((funcao, args, None))
+
+    async def executar(self, funcao, *args):
+        # Enfileira um comando e espera o resultado (ou a exceção) dele.
+        # Nunca chamar de dentro de um comando do próprio ator: chame a função direto.
+        if atores_audio.get(self.guild_id) is not self:
+            return await ator_audio(self.guild_id).executar(funcao, *args)
+        futuro = asyncio.get_running_loop().create_future()
+        self.caixa.put_nowait((funcao, args, futuro))
+        return await futuro
+
+    def parar_reproducao(self, voice_client):
+        # Para o que estiver tocando; o `after` da reprodução parada vira evento velho.
+        self.geracao = next(contador_geracoes_audio)
+        if voice_client is not None and (voice_client.is_playing() or voice_client.is_paused()):
+            voice_client.stop()
+
+    def tocar(self, voice_client, fonte, ao_terminar, *args):
+        # Toca `fonte`; no fim, posta `ao_terminar(ator, geração, erro, *args)` no ator da guild.
+        self.geracao = geracao = next(contador_geracoes_audio)
+        marcar_atividade_voz(self.guild_id)
+        guild_id = self.guild_id
+
+        def depois(erro):
+            # Roda na thread de voz: só entrega o evento para o loop.
+            client.loop.call_soon_threadsafe(postar_evento_audio, guild_id, ao_terminar, geracao, erro, args)
+
+        voice_client.play(fonte, after=depois)
+
+
+def ator_audio(guild_id):
+    # Ator de áudio da guild, criado no primeiro uso.
+    ator = atores_audio.get(guild_id)
+    if ator is None:
+        ator = atores_audio[guild_id] = AtorAudio(guild_id)
+    return ator
+
+
+def liberar_ator_audio(guild_id):
+    # Marca o ator para sair ao fim do comando atual, se a guild ficar sem playlist e sem comandos.
+    # Só é chamada de dentro de comandos do ator.
+    ator = atores_audio.get(guild_id)
+    if ator is not None:
+        ator.liberar = True
+
+
+def postar_evento_audio(guild_id, ao_terminar, geracao, erro, args):
+    # Entrega o fim de uma reprodução ao ator atual da guild. Se ele já foi liberado,
+    # um ator temporário recebe o evento (velho, mas com erro a registrar) e sai em seguida.
+    ator = atores_audio.get(guild_id)
+    if ator is None:
+        ator = ator_audio(guild_id)
+        ator.liberar = True
+    ator.postar(ao_terminar, ator, geracao, erro, *args)
+
+
+# Canal de texto -> último envio pendente. Os comandos do ator não esperam o
+# Discord responder; os avisos de um canal saem em ordem, um depois do outro.
+envios_pendentes = {}
+
+
+def avisar(canal_texto, texto):
+    # Envia `texto` em segundo plano, na ordem dos avisos anteriores do mesmo canal.
+    anterior = envios_pendentes.get(canal_texto.id)
+
+    async def enviar():
+        if anterior is not None:
+            await asyncio.wait([anterior])
+        try:
+            await canal_texto.send(texto)
+        except discord.HTTPException as erro:
+            print(f'Erro ao enviar aviso de áudio: {erro}')
+        finally:
+            if envios_pendentes.get(canal_texto.id) is tarefa:
+                del envios_pendentes[canal_texto.id]
+
+    tarefa = asyncio.ensure_future(enviar())
+    envios_pendentes[canal_texto.id] = tarefa
+
+
+def canal_voz_do_usuario(usuario, guild):
+    # Canal de voz em que o usuário está na guild, ou None.
+    membro = usuario if isinstance(usuario, discord.Member) else guild.get_member(usuario.id)
+    if membro is None or membro.voice is None:
+        return None
+    return membro.voice.channel
+
+
+# guild -> trava de conexão: conectar/mover/desconectar de uma guild não se cruzam.
+travas_conexao_voz = collections.defaultdict(asyncio.Lock)
+
+
+async def conectar_voz(guild, canal_voz):
+    # Conecta (ou move) o bot para `canal_voz`; devolve o voice client.
+    # Roda fora do ator: a conexão pode levar segundos e não deve segurar a caixa.
+    async with travas_conexao_voz[guild.id]:
+        voice_client = guild.voice_client
+        if voice_client is None:
+            voice_client = await canal_voz.connect()
+        elif voice_client.channel != canal_voz:
+            await voice_client.move_to(canal_voz)
+        marcar_atividade_voz(guild.id)
+        return voice_client
+
+
+async def _iniciar_luta(guild, canal_texto, itens):
+    # Comando do ator: troca a fila da guild pela playlist e começa a tocar.
+    # O bot já foi conectado ao canal de voz por quem postou o comando.
+    voice_client = guild.voice_client
+    if voice_client is None:
+        avisar(canal_texto, 'Perdi a conexão de voz antes de começar a playlist.')
+        return
+    # Reinicia completamente o estado anterior de luta da guild antes da nova fila.
+    cancelar_playlist_luta(guild.id)
+    estados_luta[guild.id] = EstadoLuta(
+        FaixaLuta(item['url'], item.get('titulo'), item.get('duracao')) for item in itens
+    )
+    # A primeira faixa (e as seguintes) começam a resolver já, em paralelo.
+    agendar_prefetch_luta(guild.id)
+    ator_audio(guild.id).parar_reproducao(voice_client)
+    avisar(canal_texto, f'Playlist de luta carregada com **{len(itens)}** faixas.')
+    await tocar_proxima_da_fila(guild.id, canal_texto)
+
+
+async def _interromper_com_fonte(guild, canal_texto, fonte, descricao, url=None):
+    # Comando do ator: toca um efeito/tema por cima de tudo, guardando a faixa do !luta para retomar.
+    # O bot já foi conectado ao canal de voz por quem postou o comando.
+    voice_client = guild.voice_client
+    if voice_client is None:
+        fonte.cleanup()
+        return
+    faixa = faixa_luta_tocando(voice_client)
+    if faixa is not None:
+        try:
+            # A faixa continua aberta e retoma sozinha, do mesmo quadro, quando o efeito acabar.
+            faixa.inserir_efeito(fonte)
+            return
+        except discord.opus.OpusNotLoaded:
+            print(f'Sem libopus para converter {descricao}; a faixa vai parar e retomar com seek.')
+    preparar_interrupcao_playlist(guild.id, voice_client)
+    ator = ator_audio(guild.id)
+    ator.parar_reproducao(voice_client)
+    ator.tocar(voice_client, fonte, _fim_interrupcao, canal_texto, descricao, url)
+
+
+async def _fim_interrupcao(ator, geracao, erro, canal_texto, descricao, url):
+    # Evento: efeito/tema terminou; se nada o substituiu, retoma a faixa do !luta que esperava
+    # (interrompida por ele, ou que terminou de resolver enquanto ele tocava).
+    if erro:
+        print(f'Erro ao tocar {descricao}: {erro}')
+        if url:
+            # A URL de stream pode ter sido revogada antes do `expire`.
+            cache_streams.pop(url, None)
+    if geracao != ator.geracao:
+        return
+    if estado_luta(ator.guild_id) is None:
+        # Efeito avulso, sem playlist: nada a retomar e o ator pode sair.
+        liberar_ator_audio(ator.guild_id)
+        return
+    await retomar_playlist_interrompida(ator.guild_id, canal_texto)
+
+
+async def _fim_faixa_luta(ator, geracao, erro, canal_texto, url):
+    # Evento: faixa do !luta terminou; se ainda é a reprodução atual, avança a fila.
+    if erro:
+        print(f'Erro ao tocar faixa: {erro}')
+        cache_streams.pop(url, None)
+    if geracao != ator.geracao:
+        return
+    estado = estado_luta(ator.guild_id)
+    if estado is None:
+        return
+    estado.terminar_atual()
+    if estado.fila:
+        await tocar_proxima_da_fila(ator.guild_id, canal_texto)
+    else:
+        # Playlist acabou: o estado da guild (e o ator) são liberados.
+        cancelar_playlist_luta(ator.guild_id)
+
+
+async def _pular_faixa(guild, canal_texto, indice=0):
+    # Comando do ator: pula a faixa atual do !luta e toca a de posição `indice` na fila.
+    estado = estado_luta(guild.id)
+    if estado is None or (estado.atual is None and not estado.fila):
+        avisar(canal_texto, 'Nenhuma playlist tocando.')
+        return
+    if indice and indice >= len(estado.fila):
+        avisar(canal_texto, f'A fila só tem **{len(estado.fila)}** faixas.')
+        return
+    ator_audio(guild.id).parar_reproducao(guild.voice_client)
+    estado.retomar = None
+    estado.cancelar_resolucao()
+    estado.terminar_atual()
+    estado.ir_para(indice)
+    if estado.fila:
+        await tocar_proxima_da_fila(guild.id, canal_texto)
+    else:
+        cancelar_playlist_luta(guild.id)
+        avisar(canal_texto, 'Fim da playlist.')
+
+
+def formatar_duracao_faixa(segundos):
+    # Duração em m:ss (ou ?:?? quando a playlist não informou).
+    if not segundos:
+        return '?:??'
+    minutos, segundos = divmod(int(segundos), 60)
+    return f'{minutos}:{segundos:02d}'
+
+
+def formatar_fila_luta(estado, limite=10):
+    # Texto do `!fila`: atual, as próximas `limite` faixas numeradas e o tamanho do histórico.
+    if estado is None or (estado.atual is None and not estado.fila):
+        return 'Nenhuma playlist tocando.'
+    linhas = []
+    if estado.atual is not None:
+        linhas.append(f'Tocando: **{estado.atual.titulo or estado.atual.url}**')
+    for numero, faixa in enumerate(itertools.islice(estado.fila, limite), start=1):
+        linhas.append(f'`{numero}.` {faixa.titulo or faixa.url} ({formatar_duracao_faixa(faixa.duracao)})')
+    if len(estado.fila) > limite:
+        linhas.append(f'... e mais **{len(estado.fila) - limite}** faixas.')
+    if estado.historico:
+        linhas.append(f'Já tocadas: **{len(estado.historico)}**')
+    return '\n'.join(linhas)
+
+
+async def _embaralhar_fila(guild, canal_texto):
+    # Comando do ator: embaralha as próximas faixas do !luta.
+    estado = estado_luta(guild.id)
+    if estado is None or not estado.fila:
+        avisar(canal_texto, 'Nenhuma faixa na fila.')
+        return
+    estado.embaralhar()
+    # O ffmpeg pré-aberto era da antiga próxima faixa.
+    estado.descartar_preaberta()
+    agendar_prefetch_luta(guild.id)
+    avisar(canal_texto, f'Fila embaralhada (**{len(estado.fila)}** faixas).')
+
+
+async def _parar_audio(guild, canal_texto):
+    # Comando do ator: para tudo e limpa a playlist da guild.
+    ator_audio(guild.id).parar_reproducao(guild.voice_client)
+    cancelar_playlist_luta(guild.id)
+    avisar(canal_texto, 'Áudio parado.')
+
+
+# -----------------------------------------------------------------------------
+# CICLO DE VIDA DAS CONEXÕES DE VOZ
+#
+# - Cada conexão de voz mantém socket UDP, heartbeat e thread de envio abertos;
+#   conexões sem nada tocando e sem playlist há `tempo_ocioso_voz` segundos são
+#   desconectadas (pelo ator da guild, para não cruzar com um ++++).
+# - Guilds com `4df` recente (`tempo_aquecimento_voz`) ficam conectadas mesmo
+#   ociosas: o áudio do ++++/Black Flash sai sem esperar reconexão.
+# - `!voz` (admin) mostra quantas conexões estão abertas e há quanto tempo cada
+#   uma está ociosa.
+# -----------------------------------------------------------------------------
+
+tempo_ocioso_voz = 300.0
+tempo_aquecimento_voz = 1800.0
+intervalo_verificacao_voz = 30.0
+
+# guild -> instante (monotônico) da última reprodução/conexão e do último 4df.
+atividade_voz = {}
+atividade_fate = {}
+
+
+def marcar_atividade_voz(guild_id):
+    atividade_voz[guild_id] = time.monotonic()
+
+
+def registrar_atividade_fate(guild_id):
+    # Chamado a cada 4df: mantém a conexão de voz da guild aquecida.
+    if guild_id is not None:
+        atividade_fate[guild_id] = time.monotonic()
+
+
+def voz_em_uso(voice_client):
+    # True se a conexão está tocando ou ainda tem playlist pela frente.
+    if voice_client.is_playing() or voice_client.is_paused():
+        return True
+    estado = estado_luta(voice_client.guild.id)
+    return estado is not None and (estado.atual is not None or bool(estado.fila))
+
+
+def tempo_ocioso_conexao(voice_client, agora):
+    # Segundos sem uso da conexão (0 se está em uso agora).
+    guild_id = voice_client.guild.id
+    if voz_em_uso(voice_client):
+        atividade_voz[guild_id] = agora
+        return 0.0
+    return agora - atividade_voz.setdefault(guild_id, agora)
+
+
+def conexao_aquecida(guild_id, agora):
+    return agora - atividade_fate.get(guild_id, -math.inf) < tempo_aquecimento_voz
+
+
+def conexao_ociosa(voice_client, agora):
+    # True se a conexão pode ser fechada: ociosa há tempo demais e sem 4df recente.
+    return (
+        tempo_ocioso_conexao(voice_client, agora) >= tempo_ocioso_voz
+        and not conexao_aquecida(voice_client.guild.id, agora)
+    )
+
+
+async def _desconectar_se_ociosa(guild):
+    # Comando do ator: confere de novo (algo pode ter começado a tocar) e desconecta.
+    # Sob a trava de conexão: um ++++ que chegue agora espera e reconecta depois.
+    async with travas_conexao_voz[guild.id]:
+        voice_client = guild.voice_client
+        if voice_client is None or not conexao_ociosa(voice_client, time.monotonic()):
+            return
+        ator_audio(guild.id).parar_reproducao(voice_client)
+        cancelar_playlist_luta(guild.id)
+        atividade_voz.pop(guild.id, None)
+        await voice_client.disconnect()
+    liberar_ator_audio(guild.id)
+
+
+async def recolher_conexoes_ociosas_periodicamente():
+    # Fecha conexões de voz ociosas e esquece marcações velhas.
+    while True:
+        await asyncio.sleep(intervalo_verificacao_voz)
+        agora = time.monotonic()
+        conectadas = set()
+        for voice_client in list(client.voice_clients):
+            conectadas.add(voice_client.guild.id)
+            if conexao_ociosa(voice_client, agora):
+                ator_audio(voice_client.guild.id).postar(_desconectar_se_ociosa, voice_client.guild)
+        for guild_id in list(atividade_voz):
+            if guild_id not in conectadas:
+                del atividade_voz[guild_id]
+        for guild_id, instante in list(atividade_fate.items()):
+            if agora - instante >= tempo_aquecimento_voz:
+                del atividade_fate[guild_id]
+
+
+def estatisticas_voz():
+    # Uma linha por conexão de voz aberta: guild, canal e estado (tocando/ociosa/aquecida).
+    agora = time.monotonic()
+    linhas = []
+    for voice_client in client.voice_clients:
+        guild = voice_client.guild
+        ocioso = tempo_ocioso_conexao(voice_client, agora)
+        if not ocioso:
+            situacao = 'em uso'
+        elif conexao_aquecida(guild.id, agora):
+            situacao = f'ociosa há {ocioso:.0f}s (aquecida por 4df)'
+        else:
+            situacao = f'ociosa há {ocioso:.0f}s'
+        linhas.append(f'`{guild.id}` {guild.name} · {voice_client.channel} · {situacao}')
+    return linhas
+
+
+async def tocar_kokusen_no_voz(usuario, canal_texto):
+    # Toca kokusen.ogg no canal de voz do usuário e retoma playlist se necessário.
+    try:
+        guild = canal_texto.guild
+        if guild is None:
+            return
+
+        canal_voz = canal_voz_do_usuario(usuario, guild)
+        if canal_voz is None:
+            return
+
+        # Conecta antes de abrir o ffmpeg: a fonte vai direto para o ator, sem esperar nada.
+        await conectar_voz(guild, canal_voz)
+        fonte = criar_fonte_efeito('kokusen', guild.id)
+        if fonte is None:
+            await canal_texto.send('Arquivo `kokusen.ogg` não encontrado.')
+            return
+
+        await ator_audio(guild.id).executar(_interromper_com_fonte, guild, canal_texto, fonte, 'kokusen.ogg')
+    except Exception as erro:
+        await canal_texto.send(f'Não consegui tocar `kokusen.ogg` no canal de voz. Erro: `{erro}`')
+
+
+async def tocar_audio_url_no_voz(usuario, canal_texto, audio_url):
+    # Toca um áudio de URL (tema do usuário) no canal de voz do usuário.
+    try:
+        guild = canal_texto.guild
+        if guild is None:
+            return
+
+        canal_voz = canal_voz_do_usuario(usuario, guild)
+        if canal_voz is None:
+            return
+
+        # A fonte é resolvida fora do ator, para não travar a fila de comandos da guild.
+        fonte, _titulo = await abrir_fonte_url(audio_url, guild.id, duracao_clipe_tema)
+        if fonte is None:
+            await canal_texto.send('Não consegui obter o áudio do tema configurado.')
+            return
+
+        try:
+            await conectar_voz(guild, canal_voz)
+        except BaseException:
+            fonte.cleanup()
+            raise
+        # Mesmo comportamento do kokusen: interrompe e agenda retomada da playlist.
+        await ator_audio(guild.id).executar(_interromper_com_fonte, guild, canal_texto, fonte, 'tema', audio_url)
+        agendar_cache_audio(audio_url, guild.id, duracao_clipe_tema)
+    except Exception as erro:
+        await canal_texto.send(f'Não consegui tocar o tema no canal de voz. Erro: `{erro}`')
+
+
+async def tocar_audio_ao_mais_quatro(usuario, canal_texto, acao_fate):
+    # No ++++, toca tema do usuário; sem tema, toca kokusen apenas em Atacar.
+    tema_link = temas_usuario.get(usuario.id)
+    if tema_link:
+        await tocar_audio_url_no_voz(usuario, canal_texto, tema_link)
+        return
+
+    if acao_fate == 'Atacar':
+        await tocar_kokusen_no_voz(usuario, canal_texto)
+
+
+def _extrair_itens_playlist(url):
+    # Extrai as faixas de uma playlist (URL, título e duração) usando yt-dlp.
+    class _YDLLogger:
+        @staticmethod
+        def debug(msg):
+            return
+
+        @staticmethod
+        def warning(msg):
+            if 'No supported JavaScript runtime could be found' in msg:
+                return
+            print(f'[yt-dlp] {msg}')
+
+        @staticmethod
+        def error(msg):
+            print(f'[yt-dlp] {msg}')
+
+    player_client = ['android', 'web'] if shutil.which('node') else ['web']
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'logger': _YDLLogger(),
+        'extractor_args': {'youtube': {'player_client': player_client}},
+        'extract_flat': True,
+        'skip_download': True,
+        'noplaylist': False,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+
+    entradas = []
+    for entrada in info.get('entries', []):
+        if not entrada:
+            continue
+        if entrada.get('url'):
+            url_faixa = entrada.get('url')
+        elif entrada.get('id'):
+            url_faixa = f"https://www.youtube.com/watch?v={entrada['id']}"
+        else:
+            continue
+        entradas.append({'url': url_faixa, 'titulo': entrada.get('title'), 'duracao': entrada.get('duration')})
+    return entradas
+
+
+def _extrair_stream_audio(url):
+    # Extrai URL direta de stream de áudio (com título e codec) para reprodução no Discord.
+    class _YDLLogger:
+        @staticmethod
+        def debug(msg):
+            return
+
+        @staticmethod
+        def warning(msg):
+            if 'No supported JavaScript runtime could be found' in msg:
+                return
+            print(f'[yt-dlp] {msg}')
+
+        @staticmethod
+        def error(msg):
+            print(f'[yt-dlp] {msg}')
+
+    player_client = ['android', 'web'] if shutil.which('node') else ['web']
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'logger': _YDLLogger(),
+        'extractor_args': {'youtube': {'player_client': player_client}},
+        'format': 'bestaudio/best',
+        'noplaylist': True,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    return info.get('url'), info.get('title', 'Faixa'), info.get('acodec')
+
+
+# -----------------------------------------------------------------------------
+# SERVIÇO DE EXTRAÇÃO (yt-dlp)
+#
+# - Toda extração roda num pool de processos próprio, fora do executor padrão
+#   e longe do GIL do processo do bot (a thread de voz do discord.py não
+#   disputa CPU com o parsing do yt-dlp).
+# - Cada guild tem um limite de extrações simultâneas e cada pedido tem prazo.
+# - Pedidos iguais ao mesmo tempo (ex.: vários ++++ com o mesmo tema) viram
+#   um único trabalho (single-flight); todos recebem o mesmo resultado.
+# -----------------------------------------------------------------------------
+
+limite_processos_extracao = 2
+limite_extracoes_por_guild = 2
+# Prazo (segundos) de uma extração, contando a espera pela vaga da guild.
+# Estourado o prazo, o pedido falha; o processo termina o trabalho e o resultado é descartado.
+limite_tempo_extracao = 45.0
+
+# Criado no primeiro uso; recriado se algum processo do pool morrer.
+executor_extracao = None
+# (função, URL) -> task do trabalho em andamento.
+extracoes_em_andamento = {}
+# guild -> semáforo de extrações simultâneas.
+semaforos_extracao = {}
+
+
+def obter_executor_extracao():
+    # Pool de processos da extração, no mesmo contexto `spawn` dos outros processos auxiliares.
+    global executor_extracao
+    if executor_extracao is None:
+        executor_extracao = concurrent.futures.ProcessPoolExecutor(
+            max_workers=limite_processos_extracao,
+            mp_context=contexto_processos
+        )
+    return executor_extracao
+
+
+async def _executar_extracao(funcao, url, guild_id):
+    # Roda `funcao(url)` no pool, respeitando a vaga da guild e o prazo.
+    global executor_extracao
+    semaforo = semaforos_extracao.get(guild_id)
+    if semaforo is None:
+        semaforo = semaforos_extracao[guild_id] = asyncio.Semaphore(limite_extracoes_por_guild)
+
+    async def executar():
+        async with semaforo:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(obter_executor_extracao(), funcao, url)
+
+    try:
+        return await asyncio.wait_for(executar(), limite_tempo_extracao)
+    except asyncio.TimeoutError:
+        raise TimeoutError('A extração do áudio demorou demais.')
+    except concurrent.futures.process.BrokenProcessPool:
+        # Um processo morreu: descarta o pool para o próximo pedido criar outro.
+        executor_extracao = None
+        raise
+
+
+async def extrair_em_servico(funcao, url, guild_id=None):
+    # Ponto único de extração: junta pedidos iguais em andamento num só trabalho.
+    chave = (funcao.__name__, url)
+    tarefa = extracoes_em_andamento.get(chave)
+    if tarefa is None:
+        tarefa = asyncio.ensure_future(_executar_extracao(funcao, url, guild_id))
+        extracoes_em_andamento[chave] = tarefa
+        tarefa.add_done_callback(lambda _tarefa: extracoes_em_andamento.pop(chave, None))
+    # `shield`: um chamador cancelado não cancela o trabalho dos outros.
+    return await asyncio.shield(tarefa)
+
+
+# -----------------------------------------------------------------------------
+# CACHE DE STREAMS DE ÁUDIO
+#
+# - URL de origem (faixa do !luta, tema do usuário) -> (URL de stream, título, codec).
+# - A validade vem do próprio parâmetro `expire` da URL de stream (YouTube e
+#   afins), com uma margem para a faixa não vencer no meio da reprodução.
+# - Tamanho limitado, com descarte LRU. Só o loop de eventos mexe no cache.
+# -----------------------------------------------------------------------------
+
+capacidade_cache_streams = 256
+# Entradas são tratadas como vencidas esta quantidade de segundos antes do `expire`.
+margem_expiracao_stream = 600
+# Validade (segundos) quando a URL de stream não informa `expire`.
+validade_padrao_stream = 1800
+# `expire=123` na query ou `/expire/123/` no caminho (URLs do googlevideo).
+regex_expiracao_stream = re.compile(r'[?&/]expire[=/](\d+)')
+
+# URL de origem -> (expira_em, URL de stream, título, codec), em ordem de uso.
+cache_streams = collections.OrderedDict()
+
+
+def expiracao_stream(stream_url, agora):
+    # Momento (epoch) a partir do qual a URL de stream não deve mais ser usada.
+    match = regex_expiracao_stream.search(stream_url)
+    if match:
+        return int(match.group(1)) - margem_expiracao_stream
+    return agora + validade_padrao_stream
+
+
+def consultar_cache_stream(url):
+    # Devolve (URL de stream, título, codec) ainda válidos, ou None.
+    entrada = cache_streams.get(url)
+    if entrada is None:
+        return None
+    if time.time() >= entrada[0]:
+        del cache_streams[url]
+        return None
+    cache_streams.move_to_end(url)
+    return entrada[1:]
+
+
+def guardar_cache_stream(url, stream_url, titulo, codec):
+    # Guarda a resolução da URL, descartando as menos usadas acima da capacidade.
+    agora = time.time()
+    expira_em = expiracao_stream(stream_url, agora)
+    if expira_em <= agora:
+        return
+    cache_streams[url] = (expira_em, stream_url, titulo, codec)
+    cache_streams.move_to_end(url)
+    while len(cache_streams) > capacidade_cache_streams:
+        cache_streams.popitem(last=False)
+
+
+async def obter_stream_audio(url, guild_id=None):
+    # Resolve a URL de stream de `url`, indo ao yt-dlp só quando não há cache válido.
+    em_cache = consultar_cache_stream(url)
+    if em_cache is not None:
+        return em_cache
+    stream_url, titulo, codec = await extrair_em_servico(_extrair_stream_audio, url, guild_id)
+    if stream_url:
+        guardar_cache_stream(url, stream_url, titulo, codec)
+    return stream_url, titulo, codec
+
+
+def eh_opus(codec):
+    # True se o codec informado pelo yt-dlp é Opus (pode ser copiado sem re-encode).
+    return bool(codec) and codec.split('.')[0].lower() == 'opus'
+
+
+# -----------------------------------------------------------------------------
+# CACHE DE PLAYLISTS
+#
+# - Faixas de cada playlist (URL, título, duração) ficam em memória e em
+#   `cache_playlists.json`, então sobrevivem a reinícios.
+# - O cache responde na hora (stale-while-revalidate): se a cópia passou da
+#   validade, ela é servida assim mesmo e uma revalidação roda em segundo plano.
+# - A revalidação só regrava o disco quando a playlist mudou.
+# -----------------------------------------------------------------------------
+
+caminho_cache_playlists = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache_playlists.json')
+# Idade (segundos) a partir da qual a cópia em cache é revalidada.
+validade_cache_playlist = 6 * 3600
+
+# URL da playlist -> {'atualizado': epoch, 'itens': [{'url', 'titulo', 'duracao'}, ...]}
+playlists_em_cache = {}
+# URL da playlist -> task de revalidação em andamento.
+revalidacoes_playlist = {}
+
+
+def carregar_cache_playlists():
+    # Lê a cópia em disco (uma vez, na inicialização); arquivo ausente ou corrompido é ignorado.
+    try:
+        with open(caminho_cache_playlists, encoding='utf-8') as arquivo:
+            dados = json.load(arquivo)
+    except (OSError, ValueError):
+        return
+    if isinstance(dados, dict):
+        playlists_em_cache.update(dados)
+
+
+def _gravar_cache_playlists(dados):
+    # Grava o cache de forma atômica (arquivo temporário + rename).
+    temporario = f'{caminho_cache_playlists}.tmp'
+    with open(temporario, 'w', encoding='utf-8') as arquivo:
+        json.dump(dados, arquivo, ensure_ascii=False)
+    os.replace(temporario, caminho_cache_playlists)
+
+
+async def atualizar_cache_playlist(url, guild_id=None):
+    # Busca a playlist no yt-dlp e atualiza memória/disco; devolve as faixas.
+    itens = await extrair_em_servico(_extrair_itens_playlist, url, guild_id)
+    if not itens:
+        return itens
+
+    anterior = playlists_em_cache.get(url)
+    playlists_em_cache[url] = {'atualizado': time.time(), 'itens': itens}
+    if anterior is not None and anterior['itens'] == itens:
+        # Nada mudou: só renova a validade em memória, sem reescrever o disco.
+        return itens
+    try:
+        await asyncio.to_thread(_gravar_cache_playlists, dict(playlists_em_cache))
+    except OSError as erro:
+        print(f'Erro ao gravar cache de playlists: {erro}')
+    return itens
+
+
+async def _revalidar_playlist(url):
+    # Revalidação em segundo plano; falhas mantêm a cópia antiga.
+    try:
+        await atualizar_cache_playlist(url)
+    except Exception as erro:
+        print(f'Erro ao revalidar playlist: {erro}')
+    finally:
+        revalidacoes_playlist.pop(url, None)
+
+
+async def obter_itens_playlist(url, guild_id=None):
+    # Faixas da playlist: do cache na hora (revalidando se velho) ou, sem cache, do yt-dlp.
+    entrada = playlists_em_cache.get(url)
+    if entrada is None:
+        return await atualizar_cache_playlist(url, guild_id)
+    if time.time() - entrada['atualizado'] > validade_cache_playlist and url not in revalidacoes_playlist:
+        revalidacoes_playlist[url] = asyncio.create_task(_revalidar_playlist(url))
+    return entrada['itens']
+
+
+# -----------------------------------------------------------------------------
+# CACHE DE ÁUDIO EM DISCO
+#
+# - Faixas do !luta e temas ficam transcodificados em Opus/Ogg na pasta
+#   `cache_audio`, com nome derivado da URL de origem (e do recorte, se houver).
+# - Temas são preparados assim que definidos (`/tema`, `!tema`), já recortados.
+# - O arquivo é gerado em segundo plano depois da primeira reprodução, num
+#   temporário renomeado só no fim (nunca existe arquivo pela metade).
+# - Orçamento total em bytes com descarte LRU; o índice (URL, título, tamanho)
+#   fica em `cache_audio/indice.json`.
+# - Acerto no cache toca do disco local, como o `kokusen.ogg`.
+# -----------------------------------------------------------------------------
+
+pasta_cache_audio = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache_audio')
+caminho_indice_cache_audio = os.path.join(pasta_cache_audio, 'indice.json')
+limite_bytes_cache_audio = 512 * 1024 * 1024
+# Faixas maiores que isso (lives, mixes de horas) não entram no cache.
+limite_bytes_faixa_cache_audio = limite_bytes_cache_audio // 8
+taxa_bits_cache_audio = '96k'
+limite_preenchimentos_cache_audio = 2
+# Temas tocam só o começo da música; a cópia local é recortada nessa duração (segundos).
+duracao_clipe_tema = 60
+# Tentativas (e espera entre elas, em segundos) de preparar um tema quando o ffmpeg está sem vaga.
+tentativas_preparo_tema = 3
+intervalo_preparo_tema = 5.0
+
+# Chave (URL de origem + recorte) -> {'arquivo', 'titulo', 'bytes'} (+ 'loudness' e 'ganho'
+# depois da análise de volume, ou 'pendente' enquanto a versão com ganho espera a troca),
+# da menos para a mais usada.
+indice_cache_audio = collections.OrderedDict()
+bytes_cache_audio = 0
+# Caminho -> bytes de arquivos descartados que não puderam ser apagados (em uso no Windows).
+# Continuam contando no orçamento até sumirem do disco.
+arquivos_descartados_cache_audio = {}
+# Chave -> task que está gerando o arquivo.
+preenchimentos_cache_audio = {}
+semaforo_preenchimento_cache_audio = asyncio.Semaphore(limite_preenchimentos_cache_audio)
+
+
+def chave_cache_audio(url, duracao=None):
+    # Chave do cache: a URL de origem, marcada com o recorte quando só o começo é guardado.
+    return url if duracao is None else f'{url}#0-{duracao}s'
+
+
+def nome_arquivo_cache_audio(chave):
+    # Nome estável do arquivo em cache para uma chave.
+    return hashlib.blake2b(chave.encode('utf-8'), digest_size=16).hexdigest() + '.ogg'
+
+
+def carregar_cache_audio():
+    # Lê o índice (uma vez, na inicialização) e remove sobras: temporários e arquivos fora do índice.
+    global bytes_cache_audio
+    try:
+        with open(caminho_indice_cache_audio, encoding='utf-8') as arquivo:
+            entradas = json.load(arquivo)
+    except (OSError, ValueError):
+        entradas = []
+
+    for chave, entrada in entradas:
+        if os.path.isfile(os.path.join(pasta_cache_audio, entrada['arquivo'])):
+            indice_cache_audio[chave] = entrada
+    bytes_cache_audio = sum(entrada['bytes'] for entrada in indice_cache_audio.values())
+
+    conhecidos = {entrada['arquivo'] for entrada in indice_cache_audio.values()}
+    conhecidos.update(
+        entrada['pendente']['arquivo'] for entrada in indice_cache_audio.values() if 'pendente' in entrada
+    )
+    for caminho in glob.glob(os.path.join(pasta_cache_audio, '*.ogg*')):
+        if os.path.basename(caminho) not in conhecidos:
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+    descartar_excesso_cache_audio()
+
+
+def salvar_indice_cache_audio():
+    # Grava o índice de forma atômica (temporário + rename).
+    if not indice_cache_audio:
+        return
+    os.makedirs(pasta_cache_audio, exist_ok=True)
+    temporario = f'{caminho_indice_cache_audio}.tmp'
+    with open(temporario, 'w', encoding='utf-8') as arquivo:
+        json.dump(list(indice_cache_audio.items()), arquivo, ensure_ascii=False)
+    os.replace(temporario, caminho_indice_cache_audio)
+
+
+atexit.register(salvar_indice_cache_audio)
+
+
+def apagar_arquivo_cache_audio(caminho, tamanho):
+    # Apaga um arquivo do cache e tira os bytes dele do orçamento. Se ele está aberto
+    # por um ffmpeg (Windows não apaga arquivo em uso), fica anotado para outra tentativa.
+    global bytes_cache_audio
+    try:
+        os.remove(caminho)
+    except FileNotFoundError:
+        pass
+    except OSError as erro:
+        if caminho not in arquivos_descartados_cache_audio:
+            print(f'Arquivo do cache em uso; apago depois: {os.path.basename(caminho)} ({erro})')
+        arquivos_descartados_cache_audio[caminho] = tamanho
+        return
+    arquivos_descartados_cache_audio.pop(caminho, None)
+    bytes_cache_audio -= tamanho
+
+
+def descartar_excesso_cache_audio():
+    # Remove as faixas menos usadas até o cache caber no orçamento.
+    for caminho, tamanho in list(arquivos_descartados_cache_audio.items()):
+        apagar_arquivo_cache_audio(caminho, tamanho)
+    while bytes_cache_audio > limite_bytes_cache_audio and indice_cache_audio:
+        _chave, entrada = indice_cache_audio.popitem(last=False)
+        if 'pendente' in entrada:
+            try:
+                os.remove(os.path.join(pasta_cache_audio, entrada['pendente']['arquivo']))
+            except OSError:
+                pass
+        apagar_arquivo_cache_audio(os.path.join(pasta_cache_audio, entrada['arquivo']), entrada['bytes'])
+
+
+def consultar_cache_audio(chave):
+    # Devolve (caminho local, título) se a chave está em cache, ou None.
+    global bytes_cache_audio
+    entrada = indice_cache_audio.get(chave)
+    if entrada is None:
+        return None
+    caminho = os.path.join(pasta_cache_audio, entrada['arquivo'])
+    if not os.path.isfile(caminho):
+        del indice_cache_audio[chave]
+        bytes_cache_audio -= entrada['bytes']
+        return None
+    indice_cache_audio.move_to_end(chave)
+    return caminho, entrada['titulo']
+
+
+async def _preencher_cache_audio(chave, url, guild_id, duracao):
+    # Baixa e transcodifica a faixa (ou o começo dela) para Opus/Ogg num temporário e publica no fim.
+    # Devolve True quando o teto de processos do ffmpeg recusou o trabalho (o link não foi testado).
+    global bytes_cache_audio
+    temporario = None
+    try:
+        async with semaforo_preenchimento_cache_audio:
+            stream_url, titulo, codec = await obter_stream_audio(url, guild_id)
+            if not stream_url:
+                return
+            os.makedirs(pasta_cache_audio, exist_ok=True)
+            arquivo = nome_arquivo_cache_audio(chave)
+            destino = os.path.join(pasta_cache_audio, arquivo)
+            temporario = f'{destino}.tmp'
+            recorte = ['-t', str(duracao)] if duracao is not None else []
+            # Opus na origem só troca de contêiner (WebM -> Ogg); o resto é transcodificado.
+            argumentos_codec = ['-c:a', 'copy'] if eh_opus(codec) else ['-c:a', 'libopus', '-b:a', taxa_bits_cache_audio]
+            # Cache é opcional: sem vaga no teto de processos, fica para a próxima reprodução.
+            reservar_vaga_ffmpeg()
+            processo = await asyncio.create_subprocess_exec(
+                obter_ffmpeg_executavel(), '-nostdin', '-loglevel', 'error', '-y',
+                '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+                '-i', stream_url, *recorte, '-vn', *argumentos_codec,
+                '-f', 'ogg', temporario,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+            registrar_processo_ffmpeg(processo, guild_id, f'cache: {titulo or url}')
+            try:
+                _saida, erros = await processo.communicate()
+            except asyncio.CancelledError:
+                processo.kill()
+                raise
+            finally:
+                processos_ffmpeg.pop(processo.pid, None)
+            if processo.returncode != 0:
+                print(f'Erro ao gerar cache de áudio: {erros.decode(errors="replace").strip()}')
+                return
+            tamanho = os.path.getsize(temporario)
+            if tamanho > limite_bytes_faixa_cache_audio:
+                return
+            os.replace(temporario, destino)
+            temporario = None
+
+        indice_cache_audio[chave] = {'arquivo': arquivo, 'titulo': titulo, 'bytes': tamanho}
+        bytes_cache_audio += tamanho
+        descartar_excesso_cache_audio()
+        await asyncio.to_thread(salvar_indice_cache_audio)
+        agendar_analise_volume(chave)
+    except asyncio.CancelledError:
+        raise
+    except LimiteFfmpegAtingido:
+        print(f'Cache de áudio adiado, sem vaga no ffmpeg: {url}')
+        return True
+    except Exception as erro:
+        print(f'Erro ao gerar cache de áudio: {erro}')
+    finally:
+        if temporario and os.path.exists(temporario):
+            os.remove(temporario)
+        preenchimentos_cache_audio.pop(chave, None)
+
+
+def agendar_cache_audio(url, guild_id=None, duracao=None):
+    # Agenda a geração do arquivo em cache da faixa, se ainda não existe.
+    # Devolve a task (nova ou já em andamento), ou None se o arquivo já está pronto.
+    chave = chave_cache_audio(url, duracao)
+    if chave in indice_cache_audio:
+        return None
+    tarefa = preenchimentos_cache_audio.get(chave)
+    if tarefa is None:
+        tarefa = asyncio.ensure_future(_preencher_cache_audio(chave, url, guild_id, duracao))
+        preenchimentos_cache_audio[chave] = tarefa
+    return tarefa
+
+
+# -----------------------------------------------------------------------------
+# VOLUME PADRONIZADO DO CACHE DE ÁUDIO
+#
+# - Temas e faixas vêm de uploads com volumes muito diferentes. Rodar `loudnorm`
+#   a cada reprodução multiplicaria a CPU, então cada arquivo do cache é medido
+#   uma única vez, em segundo plano (filtro `ebur128`: loudness integrada e pico).
+# - O ganho até `alvo_volume_lufs` (limitado para não clipar nem amplificar
+#   silêncio) é aplicado numa re-codificação única do próprio arquivo; o índice
+#   guarda a medida e o ganho. Do disco a faixa continua sendo copiada para o
+#   Discord sem nenhum trabalho extra por reprodução.
+# - A primeira reprodução (ainda do stream) sai com o volume original.
+# -----------------------------------------------------------------------------
+
+alvo_volume_lufs = -16.0
+limite_ganho_volume = 12.0
+# Pico máximo (dBTP) depois do ganho, e ganhos menores que isso nem re-codificam.
+teto_pico_volume = -1.0
+ganho_minimo_volume = 1.0
+# Espera (segundos) entre tentativas de trocar um arquivo que estava aberto por um ffmpeg.
+intervalo_troca_volume = 60
+# Abaixo disso a faixa é praticamente silêncio: não há o que padronizar.
+loudness_silencio = -60.0
+
+regex_loudness_integrada = re.compile(r'^\s*I:\s+(-?[\d.]+|-?inf) LUFS', re.MULTILINE)
+regex_pico_real = re.compile(r'^\s*Peak:\s+(-?[\d.]+|-?inf) dBFS', re.MULTILINE)
+# Chave -> task de análise em andamento.
+analises_volume = {}
+
+
+def calcular_ganho_volume(loudness, pico):
+    # Ganho (dB) que leva a faixa ao alvo sem passar do teto de pico.
+    if loudness <= loudness_silencio:
+        return 0.0
+    ganho = alvo_volume_lufs - loudness
+    ganho = min(ganho, teto_pico_volume - pico)
+    return max(-limite_ganho_volume, min(limite_ganho_volume, ganho))
+
+
+async def _executar_ffmpeg_cache(descricao, *argumentos):
+    # Roda um ffmpeg supervisionado sobre arquivos do cache; devolve (código, stderr).
+    reservar_vaga_ffmpeg()
+    processo = await asyncio.create_subprocess_exec(
+        obter_ffmpeg_executavel(), '-nostdin', '-hide_banner', '-nostats', '-y', *argumentos,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    registrar_processo_ffmpeg(processo, None, descricao)
+    try:
+        _saida, erros = await processo.communicate()
+    except asyncio.CancelledError:
+        processo.kill()
+        raise
+    finally:
+        processos_ffmpeg.pop(processo.pid, None)
+    return processo.returncode, erros.decode(errors='replace')
+
+
+async def _analisar_volume_cache_audio(chave):
+    # Mede a loudness do arquivo em cache e, se preciso, grava a versão com o ganho aplicado.
+    temporario = None
+    try:
+        async with semaforo_preenchimento_cache_audio:
+            entrada = indice_cache_audio.get(chave)
+            if entrada is None or 'ganho' in entrada:
+                return
+            # Com 'pendente', medida e re-codificação já foram feitas: falta só a troca.
+            if 'pendente' not in entrada:
+                caminho = os.path.join(pasta_cache_audio, entrada['arquivo'])
+                codigo, saida = await _executar_ffmpeg_cache(
+                    f"volume: {entrada['titulo'] or chave}",
+                    '-i', caminho, '-vn', '-af', 'ebur128=framelog=quiet:peak=true', '-f', 'null', '-'
+                )
+                loudness = regex_loudness_integrada.findall(saida)
+                pico = regex_pico_real.findall(saida)
+                if codigo != 0 or not loudness or not pico:
+                    print(f'Não consegui medir o volume de {chave}.')
+                    return
+                loudness, pico = float(loudness[-1]), float(pico[-1])
+                ganho = calcular_ganho_volume(loudness, pico)
+
+                if abs(ganho) >= ganho_minimo_volume:
+                    temporario = f'{caminho}.tmp'
+                    codigo, saida = await _executar_ffmpeg_cache(
+                        f"volume {ganho:+.1f} dB: {entrada['titulo'] or chave}",
+                        '-loglevel', 'error', '-i', caminho, '-vn', '-af', f'volume={ganho:.2f}dB',
+                        '-c:a', 'libopus', '-b:a', taxa_bits_cache_audio, '-f', 'ogg', temporario
+                    )
+                    if codigo != 0:
+                        print(f'Erro ao aplicar ganho no cache de áudio: {saida.strip()}')
+                        return
+                    # A entrada pode ter sido descartada (LRU) enquanto o ffmpeg rodava.
+                    if indice_cache_audio.get(chave) is not entrada:
+                        return
+                    entrada['pendente'] = {
+                        'arquivo': os.path.basename(temporario),
+                        'bytes': os.path.getsize(temporario),
+                        'loudness': loudness,
+                        'ganho': ganho,
+                    }
+                    temporario = None
+                else:
+                    entrada['loudness'] = loudness
+                    entrada['ganho'] = 0.0
+
+            if 'pendente' in entrada:
+                trocar_arquivo_volume(chave, entrada)
+        await asyncio.to_thread(salvar_indice_cache_audio)
+    except asyncio.CancelledError:
+        raise
+    except Exception as erro:
+        print(f'Erro ao analisar volume do cache de áudio: {erro}')
+    finally:
+        if temporario and os.path.exists(temporario):
+            os.remove(temporario)
+        analises_volume.pop(chave, None)
+
+
+def trocar_arquivo_volume(chave, entrada):
+    # Põe a versão com ganho ('pendente') no lugar do arquivo da entrada; True se trocou.
+    # No Linux quem está tocando continua lendo o arquivo antigo; no Windows a troca
+    # falha enquanto algum ffmpeg tem o arquivo aberto e é tentada de novo mais tarde.
+    global bytes_cache_audio
+    pendente = entrada['pendente']
+    try:
+        os.replace(
+            os.path.join(pasta_cache_audio, pendente['arquivo']),
+            os.path.join(pasta_cache_audio, entrada['arquivo'])
+        )
+    except FileNotFoundError:
+        # A versão com ganho sumiu do disco: a próxima análise refaz do zero.
+        del entrada['pendente']
+        return False
+    except PermissionError:
+        print(
+            f"Arquivo em uso; o ganho de volume de {entrada['titulo'] or chave} "
+            f'fica para daqui a {intervalo_troca_volume}s.'
+        )
+        asyncio.get_running_loop().call_later(intervalo_troca_volume, agendar_analise_volume, chave)
+        return False
+    del entrada['pendente']
+    bytes_cache_audio += pendente['bytes'] - entrada['bytes']
+    entrada['bytes'] = pendente['bytes']
+    entrada['loudness'] = pendente['loudness']
+    entrada['ganho'] = pendente['ganho']
+    return True
+
+
+def agendar_analise_volume(chave):
+    # Agenda a medição/padronização de volume de uma entrada do cache que ainda não tem ganho.
+    entrada = indice_cache_audio.get(chave)
+    if entrada is None or 'ganho' in entrada or chave in analises_volume:
+        return
+    analises_volume[chave] = asyncio.ensure_future(_analisar_volume_cache_audio(chave))
+
+
+def agendar_analises_volume_pendentes():
+    # Na inicialização: entradas gravadas antes da padronização (ou com análise interrompida).
+    for chave in list(indice_cache_audio):
+        agendar_analise_volume(chave)
+
+
+async def preparar_tema(link):
+    # Valida o link e gera a cópia local recortada do tema; True quando ela fica pronta.
+    # Sem vaga no teto do ffmpeg, tenta de novo algumas vezes e então levanta
+    # `LimiteFfmpegAtingido`: o link pode estar bom, só não deu para baixar agora.
+    for tentativa in range(tentativas_preparo_tema):
+        if tentativa:
+            await asyncio.sleep(intervalo_preparo_tema)
+        tarefa = agendar_cache_audio(link, duracao=duracao_clipe_tema)
+        sem_vaga = await asyncio.shield(tarefa) if tarefa is not None else False
+        if not sem_vaga:
+            return consultar_cache_audio(chave_cache_audio(link, duracao_clipe_tema)) is not None
+    raise LimiteFfmpegAtingido('Muitos áudios tocando ao mesmo tempo.')
+
+
+def opcao_seek_ffmpeg(inicio):
+    # Opção de entrada do ffmpeg para começar em `inicio` segundos (vazia no começo).
+    return f'-ss {inicio:.3f} ' if inicio else ''
+
+
+def criar_fonte_local(caminho, opus=False, guild_id=None, inicio=0.0):
+    # Fonte de áudio do ffmpeg para um arquivo local; arquivos Opus são enviados sem re-encode.
+    descricao = os.path.basename(caminho)
+    before_options = opcao_seek_ffmpeg(inicio).strip() or None
+    if opus:
+        return criar_fonte_ffmpeg(
+            discord.FFmpegOpusAudio, guild_id, descricao, caminho, codec='copy', before_options=before_options
+        )
+    return criar_fonte_ffmpeg(discord.FFmpegPCMAudio, guild_id, descricao, caminho, before_options=before_options)
+
+
+async def abrir_fonte_url(url, guild_id=None, duracao=None, inicio=0.0):
+    # Fonte de áudio de uma URL de origem: do disco se estiver em cache, senão do stream.
+    # Com `duracao`, toca só o começo; com `inicio`, começa nesse ponto (seek do ffmpeg).
+    # Devolve (fonte, título) ou (None, None).
+    em_disco = consultar_cache_audio(chave_cache_audio(url, duracao))
+    if em_disco is not None:
+        caminho, titulo = em_disco
+        # O cache em disco é sempre Opus/Ogg.
+        return criar_fonte_local(caminho, opus=True, guild_id=guild_id, inicio=inicio), titulo
+    stream_url, titulo, codec = await obter_stream_audio(url, guild_id)
+    if not stream_url:
+        return None, None
+    return criar_fonte_stream(stream_url, duracao, codec, guild_id, titulo, inicio), titulo
+
+
+def criar_fonte_stream(stream_url, duracao=None, codec=None, guild_id=None, titulo=None, inicio=0.0):
+    # Fonte de áudio do ffmpeg para uma URL de stream remota (só o começo, com `duracao`).
+    # O ffmpeg já entrega Opus: se a origem é Opus, os pacotes são só copiados;
+    # senão o ffmpeg codifica. Em nenhum caso o discord.py re-codifica PCM.
+    copiar = eh_opus(codec)
+    return criar_fonte_ffmpeg(
+        discord.FFmpegOpusAudio, guild_id,
+        f"{'cópia' if copiar else 'transcodificação'}: {titulo or 'stream'}",
+        stream_url,
+        codec='copy' if copiar else None,
+        before_options=opcao_seek_ffmpeg(inicio) + '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+        options='-vn' if duracao is None else f'-vn -t {duracao}'
+    )
+
+
+# -----------------------------------------------------------------------------
+# TRANSMISSÃO COMPARTILHADA ENTRE GUILDS
+#
+# - A playlist do !luta é a mesma em todo servidor. Quando várias guilds tocam
+#   a mesma faixa, um único ffmpeg (e um único stream baixado) produz os
+#   pacotes Opus, guardados numa lista compartilhada (`TransmissaoAudio`).
+# - Cada guild lê com o próprio cursor (`FonteAssinante`): quem entra depois
+#   começa do início, lendo da memória o que já foi produzido, e alcança o ffmpeg.
+# - O primeiro assinante que precisa de um pacote novo lê do ffmpeg (sob a trava);
+#   os outros só leem a lista. Quando o último assinante sai, o ffmpeg é
+#   fechado e os pacotes liberados.
+# - A lista guarda no máximo `limite_quadros_transmissao` pacotes. Ao encher
+#   (faixas muito longas), descarta o que o assinante mais atrasado já leu (ou,
+#   se ele estiver parado, a metade mais antiga) e para de aceitar assinantes
+#   novos, que abrem a própria fonte.
+# - Retomada com seek (`inicio`) sempre usa fonte própria.
+# -----------------------------------------------------------------------------
+
+# 30 minutos em quadros de 20 ms (~20 MB de Opus a 96 kbps).
+limite_quadros_transmissao = 30 * 60 * 50
+
+# URL de origem -> TransmissaoAudio aberta.
+transmissoes_audio = {}
+
+
+class TransmissaoAudio:
+    # Uma fonte Opus lida uma vez só e repartida entre vários assinantes.
+    __slots__ = ('url', 'fonte', 'titulo', 'janela', 'terminou', 'leitores', 'trava')
+
+    def __init__(self, url, fonte, titulo):
+        self.url = url
+        self.fonte = fonte
+        self.titulo = titulo
+        # (índice do primeiro pacote guardado, pacotes). Trocada inteira de uma vez,
+        # para quem lê sem a trava nunca ver base e lista desencontradas.
+        self.janela = (0, [])
+        self.terminou = False
+        # Assinantes ativos (os cursores deles dizem o que ainda precisa ficar guardado).
+        self.leitores = set()
+        self.trava = threading.Lock()
+
+    @property
+    def aceita_assinantes(self):
+        # Só enquanto nada foi descartado: quem entra começa do início.
+        base, quadros = self.janela
+        return self.fonte is not None and base == 0 and len(quadros) < limite_quadros_transmissao
+
+    def assinar(self):
+        # Novo cursor no início; None se a transmissão já fechou ou descartou o começo.
+        with self.trava:
+            if not self.aceita_assinantes:
+                return None
+            assinante = FonteAssinante(self)
+            self.leitores.add(assinante)
+            return assinante
+
+    def _descartar_antigos(self):
+        # Chamado sob a trava quando a janela enche: tira o que o assinante mais
+        # atrasado já leu; se ele estiver parado lá atrás, perde a metade mais antiga.
+        base, quadros = self.janela
+        mais_atrasado = min((leitor.posicao for leitor in self.leitores), default=base + len(quadros))
+        corte = max(mais_atrasado - base, limite_quadros_transmissao // 2)
+        self.janela = (base + corte, quadros[corte:])
+
+    def ler(self, indice):
+        # (pacote, próximo índice) a partir de `indice`, lendo do ffmpeg se ninguém o
+        # produziu ainda; pacote b'' no fim. Cursor que ficou antes da janela pula para ela.
+        base, quadros = self.janela
+        if base <= indice < base + len(quadros):
+            return quadros[indice - base], indice + 1
+        with self.trava:
+            # Outro assinante pode ter lido enquanto este esperava a trava.
+            base, quadros = self.janela
+            indice = max(indice, base)
+            while indice >= base + len(quadros) and not self.terminou:
+                try:
+                    pacote = self.fonte.read()
+                except Exception as erro:
+                    print(f'Erro na transmissão de {self.url}: {erro}')
+                    pacote = b''
+                if not pacote:
+                    self.terminou = True
+                    break
+                quadros.append(pacote)
+                if len(quadros) >= limite_quadros_transmissao:
+                    self._descartar_antigos()
+                    base, quadros = self.janela
+            if indice < base + len(quadros):
+                return quadros[indice - base], indice + 1
+            return b'', indice
+
+    def sair(self, assinante):
+        # Um assinante a menos; o último fecha o ffmpeg e libera os pacotes.
+        with self.trava:
+            self.leitores.discard(assinante)
+            if self.leitores or self.fonte is None:
+                return
+            fonte, self.fonte = self.fonte, None
+            self.janela = (0, [])
+            self.terminou = True
+        if transmissoes_audio.get(self.url) is self:
+            del transmissoes_audio[self.url]
+        fonte.cleanup()
+
+
+class FonteAssinante(discord.AudioSource):
+    # Leitura de uma `TransmissaoAudio` com cursor próprio.
+    __slots__ = ('transmissao', 'posicao', 'ativa')
+
+    def __init__(self, transmissao):
+        self.transmissao = transmissao
+        self.posicao = 0
+        self.ativa = True
+
+    @property
+    def original(self):
+        # A fonte ffmpeg compartilhada (para o supervisor saber que está em uso).
+        return self.transmissao.fonte
+
+    def read(self):
+        pacote, self.posicao = self.transmissao.ler(self.posicao)
+        return pacote
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        # Idempotente: o discord.py e o `__del__` podem chamar mais de uma vez.
+        if self.ativa:
+            self.ativa = False
+            self.transmissao.sair(self)
+
+
+async def abrir_fonte_compartilhada(url, guild_id=None):
+    # Como `abrir_fonte_url`, mas assinando a transmissão da URL (aberta aqui se não houver).
+    transmissao = transmissoes_audio.get(url)
+    assinante = transmissao.assinar() if transmissao is not None else None
+    if assinante is None:
+        fonte, titulo = await abrir_fonte_url(url, guild_id)
+        if fonte is None:
+            return None, None
+        # Outra guild pode ter aberto a mesma transmissão durante o `await`.
+        transmissao = transmissoes_audio.get(url)
+        assinante = transmissao.assinar() if transmissao is not None else None
+        if assinante is not None:
+            fonte.cleanup()
+        else:
+            transmissao = transmissoes_audio[url] = TransmissaoAudio(url, fonte, titulo)
+            assinante = transmissao.assinar()
+    return assinante, transmissao.titulo
+
+
+def eh_proxima_faixa(estado, url):
+    # True se `url` é a próxima faixa da fila e ainda não tem ffmpeg pré-aberto.
+    return bool(estado.fila) and estado.fila[0].url == url and estado.preaberta is None
+
+
+async def _prefetch_faixa_luta(estado, guild_id, url):
+    # Resolve o stream de uma faixa da fila; se ela for a próxima, já abre o ffmpeg.
+    try:
+        if consultar_cache_audio(chave_cache_audio(url)) is None:
+            stream_url, _titulo, _codec = await obter_stream_audio(url, guild_id)
+            if not stream_url:
+                return
+        if preabrir_proxima_faixa_luta and eh_proxima_faixa(estado, url):
+            fonte, titulo = await abrir_fonte_compartilhada(url, guild_id)
+            if fonte is None:
+                return
+            # A fila pode ter mudado (ou a playlist acabado) enquanto o ffmpeg abria.
+            if estados_luta.get(guild_id) is estado and eh_proxima_faixa(estado, url):
+                estado.preaberta = (url, fonte, titulo)
+            else:
+                fonte.cleanup()
+    except asyncio.CancelledError:
+        raise
+    except Exception as erro:
+        print(f'Erro no prefetch da faixa {url}: {erro}')
+    finally:
+        estado.prefetch.pop(url, None)
+
+
+def agendar_prefetch_luta(guild_id):
+    # Dispara em segundo plano o prefetch das próximas faixas da fila.
+    estado = estado_luta(guild_id)
+    if estado is None:
         return
+    for faixa in itertools.islice(estado.fila, profundidade_prefetch_luta):
+        if faixa.url not in estado.prefetch:
+            estado.prefetch[faixa.url] = asyncio.ensure_future(_prefetch_faixa_luta(estado, guild_id, faixa.url))
 
-    # Enquanto tema/kokusen estiver ativo, não avança automaticamente a playlist.
-    if guild_id in interromper_auto_avanco_luta:
+
+async def tocar_proxima_da_fila(guild_id, canal_texto):
+    # Toca a próxima faixa da fila de !luta e agenda avanço automático.
+    # Roda sempre dentro do ator de áudio da guild.
+    estado = estado_luta(guild_id)
+    if estado is None or not estado.fila:
         return
 
     voice_client = canal_texto.guild.voice_client
@@ -488,142 +3562,369 @@ async def tocar_proxima_da_fila(guild_id, canal_texto):
     if voice_client.is_playing():
         return
 
-    proxima_url = fila.pop(0)
+    await tocar_faixa_luta(guild_id, canal_texto, estado.proxima())
+
+
+async def tocar_faixa_luta(guild_id, canal_texto, faixa, inicio=0.0):
+    # Toca uma faixa do !luta a partir de `inicio` segundos e agenda avanço automático.
+    # Roda sempre dentro do ator de áudio da guild. Sem ffmpeg pré-aberto, o stream é
+    # resolvido fora do ator e só o resultado volta para a caixa (`_faixa_resolvida`).
+    estado = estado_luta(guild_id)
+    if estado is None:
+        return
     # Guarda referência da faixa atual para permitir retomada após interrupção.
-    faixa_atual_luta[guild_id] = proxima_url
+    estado.atual = faixa
+    preaberta, estado.preaberta = estado.preaberta, None
+    if preaberta and preaberta[0] == faixa.url and not inicio:
+        # O prefetch já resolveu o stream e abriu o ffmpeg desta faixa.
+        _url, fonte, titulo = preaberta
+        iniciar_faixa_luta(estado, guild_id, canal_texto, faixa, inicio, fonte, titulo)
+        return
+    if preaberta:
+        preaberta[1].cleanup()
+    estado.cancelar_resolucao()
+    estado.resolucao = asyncio.ensure_future(_resolver_faixa_luta(guild_id, canal_texto, faixa, inicio))
+
+
+async def _resolver_faixa_luta(guild_id, canal_texto, faixa, inicio):
+    # Fora do ator: resolve o stream (até `limite_tempo_extracao`) e abre o ffmpeg da faixa.
+    # Efeitos e comandos continuam sendo atendidos enquanto isso.
+    fonte = titulo = erro = None
     try:
-        stream_url, titulo = await asyncio.to_thread(_extrair_stream_audio, proxima_url)
-        if not stream_url:
-            await canal_texto.send('Não consegui obter o áudio da próxima faixa.')
-            faixa_atual_luta.pop(guild_id, None)
-            if fila:
-                await tocar_proxima_da_fila(guild_id, canal_texto)
-            return
+        if inicio:
+            # Na retomada o stream já está no cache: só o ffmpeg reabre, com seek.
+            fonte, titulo = await abrir_fonte_url(faixa.url, guild_id, inicio=inicio)
+        else:
+            fonte, titulo = await abrir_fonte_compartilhada(faixa.url, guild_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception as excecao:
+        erro = excecao
+    ator_audio(guild_id).postar(
+        _faixa_resolvida, guild_id, canal_texto, faixa, inicio, fonte, titulo, erro, asyncio.current_task()
+    )
 
-        def ao_terminar(erro):
-            if erro:
-                print(f'Erro ao tocar faixa: {erro}')
-            # Se houver interrupção intencional, não autoavança aqui.
-            if guild_id in interromper_auto_avanco_luta:
-                return
-            faixa_atual_luta.pop(guild_id, None)
-            if filas_luta.get(guild_id):
-                client.loop.call_soon_threadsafe(asyncio.create_task, tocar_proxima_da_fila(guild_id, canal_texto))
-
-        voice_client.play(
-            discord.FFmpegPCMAudio(
-                stream_url,
-                executable=obter_ffmpeg_executavel(),
-                before_options='-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-                options='-vn'
-            ),
-            after=ao_terminar
-        )
-        await canal_texto.send(f'Tocando agora: **{titulo}**')
-    except Exception as erro:
-        await canal_texto.send(f'Falha ao tocar faixa da playlist: `{erro}`')
-        faixa_atual_luta.pop(guild_id, None)
-        if filas_luta.get(guild_id) and not voice_client.is_playing():
+
+async def _faixa_resolvida(guild_id, canal_texto, faixa, inicio, fonte, titulo, erro, resolucao):
+    # Comando do ator: chegou o resultado de `_resolver_faixa_luta`.
+    estado = estado_luta(guild_id)
+    if estado is None or estado.resolucao is not resolucao:
+        # A faixa foi pulada ou a playlist parada/trocada enquanto resolvia.
+        if fonte is not None:
+            fonte.cleanup()
+        return
+    estado.resolucao = None
+    if isinstance(erro, LimiteFfmpegAtingido):
+        # Sem vaga agora: a faixa volta para a frente da fila em vez de pular as seguintes.
+        avisar(canal_texto, f'Playlist pausada: {erro}')
+        estado.atual = None
+        estado.empurrar_frente(faixa)
+        return
+    if erro is not None or fonte is None:
+        if erro is not None:
+            avisar(canal_texto, f'Falha ao tocar faixa da playlist: `{erro}`')
+        else:
+            avisar(canal_texto, 'Não consegui obter o áudio da próxima faixa.')
+        estado.atual = None
+        if estado.fila:
             await tocar_proxima_da_fila(guild_id, canal_texto)
+        else:
+            cancelar_playlist_luta(guild_id)
+        return
+
+    voice_client = canal_texto.guild.voice_client
+    if voice_client is not None and voice_client.is_playing():
+        # Um tema/kokusen começou enquanto resolvia: a faixa espera ele acabar.
+        estado.retomar = (faixa, inicio)
+        if inicio:
+            fonte.cleanup()
+        else:
+            estado.preaberta = (faixa.url, fonte, titulo)
+        return
+    iniciar_faixa_luta(estado, guild_id, canal_texto, faixa, inicio, fonte, titulo)
 
 
-def processar_rolagem_dados(conteudo, usuario_id, usuario_mention):
-    # Processa expressões de rolagem d/df e retorna mensagens prontas para envio.
-    # `match` cobre dados comuns (d20, 2d6+3 etc.).
-    match = re.match(r'^(\d*)d(\d+)((?:\s*[+-]\s*\d+)*)(?:\s+(.*))?$', conteudo, re.IGNORECASE)
-    # `match2` cobre Fate (df), incluindo ação obrigatória no caso de 4df.
-    match2 = re.match(r'^(\d*)df((?:\s*[+-]\s*\d+)*)(?:\s+(.*))?$', conteudo, re.IGNORECASE)
+def iniciar_faixa_luta(estado, guild_id, canal_texto, faixa, inicio, fonte, titulo):
+    # Toca a fonte já aberta de uma faixa do !luta; o aviso sai sem segurar o ator.
+    voice_client = canal_texto.guild.voice_client
+    fonte = FonteFaixaLuta(fonte, inicio, mixar_efeitos_luta)
+    try:
+        if voice_client is None:
+            raise discord.ClientException('o bot não está mais no canal de voz.')
+        ator_audio(guild_id).tocar(voice_client, fonte, _fim_faixa_luta, canal_texto, faixa.url)
+    except discord.ClientException as erro:
+        fonte.cleanup()
+        estado.atual = None
+        avisar(canal_texto, f'Falha ao tocar faixa da playlist: `{erro}`')
+        return
+    faixa.titulo = titulo or faixa.titulo
+    agendar_cache_audio(faixa.url, guild_id)
+    # Enquanto esta toca, as próximas já vão sendo resolvidas.
+    agendar_prefetch_luta(guild_id)
+    if inicio:
+        avisar(canal_texto, f'Retomando: **{faixa.titulo}**')
+    else:
+        avisar(canal_texto, f'Tocando agora: **{faixa.titulo}**')
 
-    if match:
-        if usuario_id in usuarios_banidos:
-            return [
-                f'Desculpe {usuario_mention}, eu não escuto furries',
-                'mas caso queira falar comigo, resolva esta simples questao de matemática:',
-                'https://media.discordapp.net/attachments/1190477143763853393/1471694458629128266/image.png?ex=698fddc5&is=698e8c45&hm=f441a1748e0751a108d3d4adf454c036d63e1f650be231bdf31d4db38340f084&=&format=webp&quality=lossless'
-            ]
 
-        num_dice = int(match.group(1)) if match.group(1) else 1
-        sides = int(match.group(2))
-        mods = match.group(3) if match.group(3) else ''
-        bonus = 0
-        mod_display = ''
-        mods_encontrados = re.findall(r'([+-])\s*(\d+)', mods)
-        if mods_encontrados:
-            bonus = sum(int(valor) if sinal == '+' else -int(valor) for sinal, valor in mods_encontrados)
-            mod_display = ''.join(f'{sinal}{valor}' for sinal, valor in mods_encontrados)
-
-        texto_adicional = match.group(4) if match.group(4) else ''
-        rolls = [random.randint(1, sides) for _ in range(num_dice)]
-        return [f'{usuario_mention} rolled: {rolls} {mod_display} (**Total: {sum(rolls) + bonus}**) {texto_adicional}']
-
-    if match2:
-        if usuario_id in usuarios_banidos:
-            return [
-                f'Desculpe {usuario_mention}, eu não escuto furries',
-                'mas caso queira falar comigo, resolva esta simples questao de matemática:',
-                'https://media.discordapp.net/attachments/1190477143763853393/1471694458629128266/image.png?ex=698fddc5&is=698e8c45&hm=f441a1748e0751a108d3d4adf454c036d63e1f650be231bdf31d4db38340f084&=&format=webp&quality=lossless'
-            ]
+mensagem_acao_obrigatoria = "{mention} em `4df` você precisa escolher uma ação: `Atacar`, `Defender`, `Criar Vantagem` ou `Superar`."
 
-        num_dice = int(match2.group(1)) if match2.group(1) else 1
-        mods = match2.group(2) if match2.group(2) else ''
-        bonus = 0
-        mod_display = ''
-        mods_encontrados = re.findall(r'([+-])\s*(\d+)', mods)
-        if mods_encontrados:
-            bonus = sum(int(valor) if sinal == '+' else -int(valor) for sinal, valor in mods_encontrados)
-            mod_display = ''.join(f'{sinal}{valor}' for sinal, valor in mods_encontrados)
-
-        texto_adicional_bruto = match2.group(3)
-        acao_fate = None
-        complemento_fate = None
-        forcagem_teste = None
-        if num_dice == 4:
-            acao_fate, complemento_fate = extrair_acao_e_complemento_fate(texto_adicional_bruto)
-            if not acao_fate:
-                return [
-                    f"{usuario_mention} em `4df` você precisa escolher uma ação: `Atacar`, `Defender`, `Criar Vantagem` ou `Superar`."
-                ]
-            if usuario_id in usuarios_teste:
-                forcagem_teste, complemento_fate = extrair_forcagem_teste(complemento_fate)
-
-        texto_adicional = None
-        if num_dice == 4:
-            if complemento_fate:
-                texto_adicional = f"→ '{complemento_fate}'"
-        elif texto_adicional_bruto:
-            texto_adicional = f"→ '{texto_adicional_bruto}'"
-
-        if num_dice == 4 and forcagem_teste == 'max':
-            rolls = [1, 1, 1, 1]
-        elif num_dice == 4 and forcagem_teste == 'min':
-            rolls = [-1, -1, -1, -1]
-        else:
-            rolls = [random.randint(-1, 1) for _ in range(num_dice)]
-        rolls_fate = [fate_dice[i] for i in rolls]
-        dados_organizados = ', '.join(rolls_fate)
-        total_fate = sum(rolls) + bonus
-        escala = escala_adjetivos_jjk(total_fate)
-
-        mensagens = []
-        if rolls_fate == ['+','+','+','+'] and acao_fate == 'Atacar':
-            mensagens.append('Black Flash!')
-            mensagens.append('https://tenor.com/view/jjk-jjk-s2-jjk-season-2-jujutsu-kaisen-jujutsu-kaisen-s2-gif-7964484372484357392')
-            mensagens.append(f"{usuario_mention} rolled: [**{dados_organizados}**]{mod_display} (**Total: {total_fate}**) | Escala: **{escala}** {f'| Ação: **{acao_fate}** ' if acao_fate else ''}{texto_adicional if texto_adicional else ''}")
-            return mensagens
-
-        if rolls_fate == ['-','-','-','-']:
-            mensagens.append(f"{usuario_mention} rolled: [**{dados_organizados}**]{mod_display} (**Total: {total_fate}**) | Escala: **{escala}** {f'| Ação: **{acao_fate}** ' if acao_fate else ''}{texto_adicional if texto_adicional else ''} ")
-            mensagens.append('https://cdn.discordapp.com/attachments/1264409229150785609/1451361408028639316/a5z6jq.gif?ex=698f1064&is=698dbee4&hm=a1ecc438a4c2434f9ea70349dd156d6ac2d7c5197ce7dc0b801974d462b55fb5')
-            return mensagens
-
-        return [f"{usuario_mention} rolled: [{dados_organizados}]{mod_display} (**Total: {total_fate}**) | Escala: **{escala}** {f'| Ação: **{acao_fate}** ' if acao_fate else ''}{texto_adicional if texto_adicional else ''} "]
 
-    return None
+def mensagens_usuario_banido(usuario_mention):
+    # Resposta padrão para usuário banido tentando rolar/calcular.
+    return [
+        f'Desculpe {usuario_mention}, eu não escuto furries',
+        'mas caso queira falar comigo, resolva esta simples questao de matemática:',
+        'https://media.discordapp.net/attachments/1190477143763853393/1471694458629128266/image.png?ex=698fddc5&is=698e8c45&hm=f441a1748e0751a108d3d4adf454c036d63e1f650be231bdf31d4db38340f084&=&format=webp&quality=lossless'
+    ]
+
+
+class ResultadoRolagem:
+    # Resultado estruturado de uma rolagem, antes de qualquer formatação.
+    # `status` é 'ok', 'banido', 'sem_acao' (4df sem ação) ou 'erro' (com `erro`).
+    __slots__ = (
+        'expressao', 'status', 'erro', 'plano', 'rolados', 'total', 'bonus',
+        'acao', 'complemento', 'forcado', 'marcadores'
+    )
+
+    def __init__(self, expressao, status='ok', erro=None):
+        self.expressao = expressao
+        self.status = status
+        self.erro = erro
+        self.plano = None
+        self.rolados = []
+        self.total = 0
+        self.bonus = 0
+        self.acao = None
+        self.complemento = None
+        self.forcado = None
+        self.marcadores = 0
+
+    @property
+    def fate(self):
+        return self.plano is not None and self.plano.fate
+
+    @property
+    def mais_quatro(self):
+        return bool(self.marcadores & marcador_mais_quatro)
+
+    @property
+    def menos_quatro(self):
+        return bool(self.marcadores & marcador_menos_quatro)
+
+    @property
+    def black_flash(self):
+        return bool(self.marcadores & marcador_black_flash)
+
+    @property
+    def toca_audio(self):
+        # Única regra do áudio: ++++ numa 4df com ação (a ação já é obrigatória).
+        return self.status == 'ok' and self.mais_quatro and self.acao is not None
+
+
+def executar_rolagem(conteudo, usuario_id, canal_id=None, guild_id=None, match=None):
+    # Pipeline único de rolagem (texto e slash): valida, rola e registra.
+    # Recebe o `match` do roteador quando já existe, para não casar a regex de novo.
+    # Retorna None se `conteudo` não é uma rolagem.
+    if match is None:
+        match = regex_expressao_dados.match(conteudo)
+        if not match:
+            return None
+
+    resultado = ResultadoRolagem(match.group(1))
+    if usuario_id in usuarios_banidos:
+        resultado.status = 'banido'
+        return resultado
+
+    try:
+        plano = compilar_expressao_dados(normalizar_expressao_dados(match.group(1)))
+    except ValueError as erro:
+        resultado.status, resultado.erro = 'erro', str(erro)
+        return resultado
+    resultado.plano = plano
+    resultado.bonus = plano.bonus
+    resultado.complemento = match.group(2)
+
+    if plano.quantidade_fate == 4:
+        resultado.acao, resultado.complemento, resultado.forcado = extrair_texto_fate(match.group(2), usuario_id)
+        if not resultado.acao:
+            resultado.status = 'sem_acao'
+            return resultado
+
+    if resultado.forcado:
+        valor = 1 if resultado.forcado == 'max' else -1
+        dados = DadosRolados(-1, 1, valores=[valor] * 4)
+        resultado.rolados = [TermoRolado(plano.termos[0], dados)]
+        resultado.total = dados.total() + plano.bonus
+    else:
+        try:
+            resultado.rolados, resultado.total = plano.rolar()
+        except ValueError as erro:
+            resultado.status, resultado.erro = 'erro', str(erro)
+            return resultado
+
+    if plano.fate:
+        # Rolagens grandes não são listadas (e nunca formam ++++/----).
+        dados = resultado.rolados[0].dados
+        rolls_fate = [fate_dice[i] for i in dados.valores] if dados.listavel else None
+        resultado.marcadores = marcadores_fate(rolls_fate, resultado.acao, resultado.forcado)
+
+    if plano.fate:
+        registrar_atividade_fate(guild_id)
+    registrar_rolagem(
+        canal_id, usuario_id, resultado.total, resultado.marcadores,
+        guild_id=guild_id, expressao=resultado.expressao,
+        grupos=[rolado.dados for rolado in resultado.rolados]
+    )
+    return resultado
+
+
+def renderizar_rolagem(resultado, usuario_mention):
+    # Converte um `ResultadoRolagem` nas mensagens enviadas ao Discord.
+    if resultado.status == 'banido':
+        return mensagens_usuario_banido(usuario_mention)
+    if resultado.status == 'sem_acao':
+        return [mensagem_acao_obrigatoria.format(mention=usuario_mention)]
+    if resultado.status == 'erro':
+        return [f'{usuario_mention} não consegui rolar: {resultado.erro}']
+
+    mod_display = resultado.plano.mod_display
+    if not resultado.fate:
+        texto_adicional = resultado.complemento or ''
+        return [f'{usuario_mention} rolled: {formatar_termos_rolados(resultado.rolados)} {mod_display} (**Total: {resultado.total}**) {texto_adicional}']
+
+    dados = resultado.rolados[0].dados
+    if dados.listavel:
+        dados_organizados = ', '.join(fate_dice[i] for i in dados.valores)
+    else:
+        dados_organizados = formatar_histograma(dados, fate_dice)
+    if resultado.black_flash or resultado.menos_quatro:
+        dados_organizados = f'**{dados_organizados}**'
+    escala = escala_adjetivos_jjk(resultado.total)
+    acao = f'| Ação: **{resultado.acao}** ' if resultado.acao else ''
+    texto_adicional = f"→ '{resultado.complemento}'" if resultado.complemento else ''
+    linha = f"{usuario_mention} rolled: [{dados_organizados}]{mod_display} (**Total: {resultado.total}**) | Escala: **{escala}** {acao}{texto_adicional}"
+
+    if resultado.black_flash:
+        return [
+            'Black Flash!',
+            'https://tenor.com/view/jjk-jjk-s2-jjk-season-2-jujutsu-kaisen-jujutsu-kaisen-s2-gif-7964484372484357392',
+            linha
+        ]
+    if resultado.menos_quatro:
+        return [
+            f'{linha} ',
+            'https://cdn.discordapp.com/attachments/1264409229150785609/1451361408028639316/a5z6jq.gif?ex=698f1064&is=698dbee4&hm=a1ecc438a4c2434f9ea70349dd156d6ac2d7c5197ce7dc0b801974d462b55fb5'
+        ]
+    return [f'{linha} ']
+
+
+def processar_rolagem_em_lote(conteudo, repeticoes, usuario_id, usuario_mention, canal_id=None, guild_id=None):
+    # Rola a mesma expressão várias vezes de uma vez e responde numa única mensagem.
+    # Cada repetição vai para a auditoria; com `canal_id`, também para o histórico do canal.
+    match = regex_expressao_dados.match(conteudo)
+    if not match:
+        return None
+
+    if usuario_id in usuarios_banidos:
+        return mensagens_usuario_banido(usuario_mention)
+
+    if not 1 <= repeticoes <= limite_repeticoes:
+        return [f'{usuario_mention} use entre 1 e {limite_repeticoes} repetições.']
+
+    try:
+        plano = compilar_expressao_dados(normalizar_expressao_dados(match.group(1)))
+    except ValueError as erro:
+        return [f'{usuario_mention} não consegui rolar: {erro}']
+
+    acao_fate = forcado = None
+    complemento = match.group(2)
+    if plano.quantidade_fate == 4:
+        acao_fate, complemento, forcado = extrair_texto_fate(match.group(2), usuario_id)
+        if not acao_fate:
+            return [mensagem_acao_obrigatoria.format(mention=usuario_mention)]
+        registrar_atividade_fate(guild_id)
+
+    try:
+        totais, matrizes = plano.rolar_lote(repeticoes)
+    except ValueError as erro:
+        return [f'{usuario_mention} não consegui rolar: {erro}']
+    if forcado:
+        # Modo de teste: todas as repetições saem com os 4 dados no máximo (ou mínimo).
+        matriz = matrizes[0]
+        totais = totais - plano.termos[0].sinal * matriz.sum(axis=1)
+        matriz[:] = 1 if forcado == 'max' else -1
+        totais = totais + plano.termos[0].sinal * matriz.sum(axis=1)
+
+    cabecalho = f'{usuario_mention} rolled {repeticoes}x `{match.group(1)}`'
+    if acao_fate:
+        cabecalho += f' | Ação: **{acao_fate}**'
+    if complemento:
+        cabecalho += f" → '{complemento}'"
+
+    matriz_fate = matrizes[0] if plano.fate else None
+    linhas = [cabecalho]
+    if repeticoes <= limite_linhas_lote:
+        # Poucas repetições: uma linha por rolagem (com os dados, no caso de Fate).
+        for indice, total in enumerate(totais.tolist(), start=1):
+            if matriz_fate is not None:
+                dados_fate = ', '.join(fate_dice[valor] for valor in matriz_fate[indice - 1].tolist())
+                linhas.append(f'`#{indice}` [{dados_fate}] **{total}** ({escala_adjetivos_jjk(total)})')
+            else:
+                linhas.append(f'`#{indice}` **{total}**')
+    else:
+        exibidos = totais[:limite_totais_lote].tolist()
+        resto = f' … (+{repeticoes - len(exibidos)})' if repeticoes > len(exibidos) else ''
+        linhas.append(', '.join(str(total) for total in exibidos) + resto)
+
+    marcadores = np.zeros(repeticoes, dtype=np.uint8)
+    if forcado:
+        # Auditoria: rolagens forçadas ficam marcadas, como na rolagem única.
+        marcadores |= marcador_forcado
+    resumo = f'Mín **{totais.min()}** · Máx **{totais.max()}** · Média **{totais.mean():.2f}**'
+    if matriz_fate is not None and plano.quantidade_fate == 4:
+        linhas_mais_quatro = (matriz_fate == 1).all(axis=1)
+        linhas_menos_quatro = (matriz_fate == -1).all(axis=1)
+        marcadores[linhas_mais_quatro] |= marcador_mais_quatro
+        marcadores[linhas_menos_quatro] |= marcador_menos_quatro
+        if acao_fate == 'Atacar':
+            marcadores[linhas_mais_quatro] |= marcador_black_flash
+        resumo += f' · ++++: **{int(linhas_mais_quatro.sum())}** · ----: **{int(linhas_menos_quatro.sum())}**'
+    linhas.append(resumo)
+
+    matrizes_termos = [(termo, matriz) for termo, matriz in zip(plano.termos, matrizes) if matriz is not None]
+    for indice, (total, marcador) in enumerate(zip(totais.tolist(), marcadores.tolist())):
+        grupos = [
+            DadosRolados(termo.minimo, termo.maximo, valores=matriz[indice].tolist())
+            for termo, matriz in matrizes_termos
+        ]
+        registrar_rolagem(
+            canal_id, usuario_id, total, marcador,
+            guild_id=guild_id, expressao=match.group(1), grupos=grupos
+        )
+
+    # Garante uma única mensagem dentro do limite do Discord, cortando as linhas finais.
+    mensagem = '\n'.join(linhas)
+    while len(mensagem) > limite_caracteres_mensagem and len(linhas) > 2:
+        linhas.pop(-2)
+        mensagem = '\n'.join(linhas[:-1] + ['…', linhas[-1]])
+    return [mensagem]
+
 
 @client.event
 async def on_ready():
     # Evento disparado quando o bot conecta; sincroniza comandos slash uma vez.
-    global comandos_sincronizados
+    global comandos_sincronizados, gravacao_auditoria_iniciada
+    if not gravacao_auditoria_iniciada:
+        # on_ready pode disparar de novo em reconexões; as tasks de gravação são únicas.
+        gravacao_auditoria_iniciada = True
+        client.loop.create_task(gravar_auditoria_periodicamente())
+        client.loop.create_task(gravar_estado_periodicamente())
+        client.loop.create_task(supervisionar_ffmpeg_periodicamente())
+        client.loop.create_task(recolher_conexoes_ociosas_periodicamente())
+        agendar_analises_volume_pendentes()
+        # Deixa a playlist do !luta pronta (do disco ou do yt-dlp) antes do primeiro uso.
+        client.loop.create_task(obter_itens_playlist(luta_playlist_url))
     if not comandos_sincronizados:
         await tree.sync()
         comandos_sincronizados = True
@@ -632,30 +3933,60 @@ async def on_ready():
 
 
 @tree.command(name='roll', description='Rola dados com expressão tipo d20, 2d6+3, 4df atacar')
-@app_commands.describe(expressao='Ex: d20+5, 4df atacar banana, 2d8-1')
-async def roll_slash(interaction: discord.Interaction, expressao: str):
-    # Comando /roll: usa o processador central e dispara áudio no ++++ válido.
-    mensagens = processar_rolagem_dados(expressao, interaction.user.id, interaction.user.mention)
-    if not mensagens:
+@app_commands.describe(
+    expressao='Ex: d20+5, 4df atacar banana, 2d8-1',
+    repeticoes='Quantas vezes rolar a mesma expressão (resposta única)'
+)
+async def roll_slash(
+    interaction: discord.Interaction,
+    expressao: str,
+    repeticoes: app_commands.Range[int, 1, limite_repeticoes] = 1
+):
+    # Comando /roll: mesmo pipeline da rolagem por texto; áudio decidido pelo resultado.
+    if repeticoes > 1:
+        mensagens = processar_rolagem_em_lote(
+            expressao, repeticoes, interaction.user.id, interaction.user.mention,
+            interaction.channel_id, interaction.guild_id
+        )
+        if not mensagens:
+            await interaction.response.send_message('Expressão inválida. Use exemplos: `d20+5`, `2d6`, `4df atacar`')
+            return
+        await interaction.response.send_message(mensagens[0])
+        for msg in mensagens[1:]:
+            await interaction.followup.send(msg)
+        return
+
+    resultado = executar_rolagem(
+        expressao, interaction.user.id, interaction.channel_id, interaction.guild_id
+    )
+    if resultado is None:
         await interaction.response.send_message('Expressão inválida. Use exemplos: `d20+5`, `2d6`, `4df atacar`')
         return
 
+    mensagens = renderizar_rolagem(resultado, interaction.user.mention)
     await interaction.response.send_message(mensagens[0])
     for msg in mensagens[1:]:
         await interaction.followup.send(msg)
 
-    if interaction.channel is not None:
-        conteudo_msgs = ' '.join(mensagens)
-        teve_mais_quatro = '+, +, +, +' in conteudo_msgs
-        num_df_slash = re.match(r'^(\d*)df', expressao.strip(), re.IGNORECASE)
-        acao_slash = None
-        if num_df_slash and (int(num_df_slash.group(1)) if num_df_slash.group(1) else 1) == 4:
-            match_df_completo = re.match(r'^(\d*)df((?:\s*[+-]\s*\d+)*)(?:\s+(.*))?$', expressao.strip(), re.IGNORECASE)
-            if match_df_completo:
-                acao_slash, _comp = extrair_acao_e_complemento_fate(match_df_completo.group(3))
+    if resultado.toca_audio and interaction.channel is not None:
+        await tocar_audio_ao_mais_quatro(interaction.user, interaction.channel, resultado.acao)
+
+
+@tree.command(name='prob', description='Calcula a chance exata de uma rolagem, ex.: 4df+2 com alvo 3')
+@app_commands.describe(expressao='Ex: 4df+2, 3d10-1, 2d6r1', alvo='Total mínimo desejado (opcional)')
+async def prob_slash(interaction: discord.Interaction, expressao: str, alvo: int = None):
+    # Comando /prob: distribuição exata da expressão, P(total >= alvo) e escala Fate.
+    if interaction.user.id in usuarios_banidos:
+        await interaction.response.send_message('Você não pode usar comandos de rolagem.', ephemeral=True)
+        return
 
-        if teve_mais_quatro and acao_slash in ('Atacar', 'Defender', 'Criar Vantagem', 'Superar'):
-            await tocar_audio_ao_mais_quatro(interaction.user, interaction.channel, acao_slash)
+    try:
+        # Em thread: distribuições grandes levam centenas de ms de numpy.
+        texto = await asyncio.to_thread(calcular_probabilidades, expressao, alvo)
+    except ValueError as erro:
+        await interaction.response.send_message(f'Não consegui calcular: {erro}', ephemeral=True)
+        return
+    await interaction.response.send_message(texto)
 
 
 @tree.command(name='tema', description='Define seu tema de ++++ usando link (YouTube, SoundCloud etc.)')
@@ -667,8 +3998,20 @@ async def tema_slash(interaction: discord.Interaction, link: str):
         await interaction.response.send_message('Envie um link válido começando com `http://` ou `https://`.', ephemeral=True)
         return
 
-    temas_usuario[interaction.user.id] = link
-    await interaction.response.send_message('Tema salvo com sucesso! Agora seu ++++ tocará essa música.')
+    definir_tema_usuario(interaction.user.id, link)
+    await interaction.response.send_message('Tema salvo! Estou preparando o áudio, aviso quando estiver pronto.')
+    try:
+        pronto = await preparar_tema(link)
+    except LimiteFfmpegAtingido:
+        await interaction.followup.send(
+            f'{interaction.user.mention} o bot está com áudios demais tocando agora; '
+            'não deu para preparar seu tema, mas ele vai ser baixado no seu próximo ++++.'
+        )
+        return
+    if pronto:
+        await interaction.followup.send(f'{interaction.user.mention} seu tema está pronto! Agora seu ++++ tocará essa música.')
+    else:
+        await interaction.followup.send(f'{interaction.user.mention} não consegui baixar o áudio desse link; vou tentar de novo no seu próximo ++++.')
 
 
 @tree.command(name='ban', description='(Admin) Adiciona usuário na lista de banidos')
@@ -688,7 +4031,7 @@ async def ban_slash(interaction: discord.Interaction, usuario: discord.User = No
         await interaction.response.send_message(f'O usuário `{alvo_id}` já está banido.', ephemeral=True)
         return
 
-    usuarios_banidos.append(alvo_id)
+    definir_papel_usuario('banido', alvo_id, True)
     await interaction.response.send_message(f'Usuário `{alvo_id}` foi adicionado aos banidos.')
 
 
@@ -709,264 +4052,448 @@ async def desbanir_slash(interaction: discord.Interaction, usuario: discord.User
         await interaction.response.send_message(f'O usuário `{alvo_id}` não está banido.', ephemeral=True)
         return
 
-    usuarios_banidos.remove(alvo_id)
+    definir_papel_usuario('banido', alvo_id, False)
     await interaction.response.send_message(f'Usuário `{alvo_id}` foi removido dos banidos.')
 
-@client.event
-async def on_message(message):
-    # Manipulador de mensagens de texto: comandos ! e gatilhos gerais do bot.
-    usuario = message.author
-    if usuario == client.user:
-        return
 
-    # Reconhecimento de comandos de texto.
-    comando_ban = re.match(r'^!ban(?:\s+(.*))?$', message.content, re.IGNORECASE)
-    comando_desbanir = re.match(r'^!desbanir(?:\s+(.*))?$', message.content, re.IGNORECASE)
-    comando_teste = re.match(r'^!teste(?:\s+(.*))?$', message.content, re.IGNORECASE)
-    comando_adm = re.match(r'^!adm(?:\s+(.*))?$', message.content, re.IGNORECASE)
-    comando_luta = re.match(r'^!luta\s*$', message.content, re.IGNORECASE)
-    comando_tema = re.match(r'^!tema(?:\s+(.*))?$', message.content, re.IGNORECASE)
+# -----------------------------------------------------------------------------
+# ROTEAMENTO DE MENSAGENS DE TEXTO
+#
+# - Cada rota é registrada uma única vez no import, já com a regex compilada.
+# - Rotas são indexadas pelo primeiro caractere da mensagem (`!`, `r`, dígito/`d`).
+# - Comandos `!` são indexados pelo nome, então só a regex do comando certo roda.
+# - Mensagem comum (a maioria do tráfego) é descartada por um lookup de
+#   dicionário, antes de qualquer regex; só a que começa com `r`, `d` ou dígito
+#   chega às regex do prefixo, que falham logo no início.
+# -----------------------------------------------------------------------------
+
+# Primeiro caractere -> lista ordenada de (regex compilada, handler).
+rotas_por_prefixo = {}
+
+# Nome do comando `!` (minúsculo) -> (regex compilada, handler).
+comandos_texto = {}
+
+
+def registrar_rota(prefixos, padrao, flags=0):
+    # Registra handler para mensagens que começam com um dos `prefixos`.
+    regex = padrao if isinstance(padrao, re.Pattern) else re.compile(padrao, flags)
+
+    def decorador(handler):
+        for prefixo in prefixos:
+            rotas_por_prefixo.setdefault(prefixo, []).append((regex, handler))
+        return handler
+
+    return decorador
+
+
+def registrar_comando_texto(nome, padrao=None):
+    # Registra comando `!nome`; por padrão aceita argumento livre após espaço.
+    if padrao is None:
+        padrao = rf'^!{nome}(?:\s+(.*))?$'
+    regex = re.compile(padrao, re.IGNORECASE)
+
+    def decorador(handler):
+        comandos_texto[nome] = (regex, handler)
+        return handler
+
+    return decorador
 
+
+def resolver_rota(conteudo):
+    # Encontra (handler, match) para a mensagem ou None se for conversa comum.
+    if not conteudo:
+        return None
+
+    primeiro = conteudo[0]
+    if primeiro == '!':
+        partes = conteudo[1:].split(None, 1)
+        if not partes:
+            return None
+        comando = comandos_texto.get(partes[0].lower())
+        if comando is None:
+            return None
+        regex, handler = comando
+        match = regex.match(conteudo)
+        return (handler, match) if match else None
+
+    rotas = rotas_por_prefixo.get(primeiro)
+    if rotas is None:
+        return None
+
+    for regex, handler in rotas:
+        match = regex.match(conteudo)
+        if match:
+            return handler, match
+    return None
+
+
+async def enviar_aviso_banido(canal, usuario_mention):
+    # Envia a resposta padrão para usuário banido tentando rolar/calcular.
+    for mensagem in mensagens_usuario_banido(usuario_mention):
+        await canal.send(mensagem)
+
+
+@registrar_comando_texto('tema')
+async def comando_tema_texto(message, comando_tema):
     # !tema: salva tema personalizado por usuário.
-    if comando_tema:
-        link_tema = (comando_tema.group(1) or '').strip()
-        if not link_tema or not re.match(r'^https?://', link_tema, re.IGNORECASE):
-            await message.channel.send(f'{usuario.mention} use `!tema <link>` com URL válida.')
-            return
+    usuario = message.author
+    link_tema = (comando_tema.group(1) or '').strip()
+    if not link_tema or not re.match(r'^https?://', link_tema, re.IGNORECASE):
+        await message.channel.send(f'{usuario.mention} use `!tema <link>` com URL válida.')
+        return
 
-        temas_usuario[usuario.id] = link_tema
-        await message.channel.send(f'{usuario.mention} tema salvo! Vou tocar no seu ++++ em 4df.')
+    definir_tema_usuario(usuario.id, link_tema)
+    await message.channel.send(f'{usuario.mention} tema salvo! Estou preparando o áudio, aviso quando estiver pronto.')
+    try:
+        pronto = await preparar_tema(link_tema)
+    except LimiteFfmpegAtingido:
+        await message.channel.send(
+            f'{usuario.mention} o bot está com áudios demais tocando agora; '
+            'não deu para preparar seu tema, mas ele vai ser baixado no seu próximo ++++.'
+        )
         return
+    if pronto:
+        await message.channel.send(f'{usuario.mention} seu tema está pronto! Vou tocar no seu ++++ em 4df.')
+    else:
+        await message.channel.send(f'{usuario.mention} não consegui baixar o áudio desse link; vou tentar de novo no seu próximo ++++.')
+
 
+@registrar_comando_texto('luta', r'^!luta\s*$')
+async def comando_luta_texto(message, _comando_luta):
     # !luta: carrega playlist fixa e inicia fila no canal de voz do usuário.
-    if comando_luta:
-        if not isinstance(usuario, discord.Member):
-            membro = message.guild.get_member(usuario.id) if message.guild else None
-        else:
-            membro = usuario
+    usuario = message.author
+    canal_voz = canal_voz_do_usuario(usuario, message.guild) if message.guild else None
+    if canal_voz is None:
+        await message.channel.send(f'{usuario.mention} entre em um canal de voz para usar `!luta`.')
+        return
 
-        if membro is None or membro.voice is None or membro.voice.channel is None:
-            await message.channel.send(f'{usuario.mention} entre em um canal de voz para usar `!luta`.')
+    try:
+        itens_playlist = await obter_itens_playlist(luta_playlist_url, message.guild.id)
+        if not itens_playlist:
+            await message.channel.send('Não consegui carregar a playlist `!luta`.')
             return
 
-        canal_voz = membro.voice.channel
-        voice_client = message.guild.voice_client if message.guild else None
+        await conectar_voz(message.guild, canal_voz)
+        await ator_audio(message.guild.id).executar(_iniciar_luta, message.guild, message.channel, itens_playlist)
+    except Exception as erro:
+        await message.channel.send(f'Falha no comando `!luta`: `{erro}`')
 
-        try:
-            if voice_client is None:
-                voice_client = await canal_voz.connect()
-            elif voice_client.channel != canal_voz:
-                await voice_client.move_to(canal_voz)
-
-            itens_playlist = await asyncio.to_thread(_extrair_itens_playlist, luta_playlist_url)
-            if not itens_playlist:
-                await message.channel.send('Não consegui carregar a playlist `!luta`.')
-                return
 
-            # Reinicia completamente o estado anterior de luta da guild antes da nova fila.
-            cancelar_playlist_luta(message.guild.id)
-            filas_luta[message.guild.id] = itens_playlist
+@registrar_comando_texto('pular', r'^!pular\s*$')
+async def comando_pular_texto(message, _comando_pular):
+    # !pular: pula a faixa atual do !luta.
+    if message.guild is None:
+        return
+    await ator_audio(message.guild.id).executar(_pular_faixa, message.guild, message.channel)
 
-            if voice_client.is_playing():
-                voice_client.stop()
 
-            await message.channel.send(f'Playlist de luta carregada com **{len(itens_playlist)}** faixas.')
-            await tocar_proxima_da_fila(message.guild.id, message.channel)
-        except Exception as erro:
-            await message.channel.send(f'Falha no comando `!luta`: `{erro}`')
+@registrar_comando_texto('ir', r'^!ir\s+(\d+)\s*$')
+async def comando_ir_texto(message, comando_ir):
+    # !ir N: pula direto para a faixa N do `!fila`.
+    if message.guild is None:
+        return
+    indice = int(comando_ir.group(1))
+    if indice < 1:
+        await message.channel.send('Use `!ir N` com N a partir de 1 (veja `!fila`).')
         return
+    await ator_audio(message.guild.id).executar(_pular_faixa, message.guild, message.channel, indice - 1)
 
-    # !adm: adiciona novo administrador (apenas admins atuais).
-    if comando_adm:
-        if not eh_admin(usuario.id):
-            await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
-            return
 
-        alvo_id = extrair_id_alvo_texto(message, comando_adm.group(1))
-        if not alvo_id:
-            await message.channel.send('Use `!adm @usuario` ou `!adm ID`.')
-            return
+@registrar_comando_texto('embaralhar', r'^!embaralhar\s*$')
+async def comando_embaralhar_texto(message, _comando_embaralhar):
+    # !embaralhar: embaralha as próximas faixas do !luta.
+    if message.guild is None:
+        return
+    await ator_audio(message.guild.id).executar(_embaralhar_fila, message.guild, message.channel)
 
-        if alvo_id in ids_admin:
-            await message.channel.send(f'O usuário `{alvo_id}` já é admin.')
-            return
 
-        ids_admin.append(alvo_id)
-        await message.channel.send(f'Usuário `{alvo_id}` adicionado como admin.')
+@registrar_comando_texto('fila', r'^!fila\s*$')
+async def comando_fila_texto(message, _comando_fila):
+    # !fila: faixa atual, próximas faixas e quantas já tocaram.
+    if message.guild is None:
         return
+    await message.channel.send(formatar_fila_luta(estado_luta(message.guild.id)))
 
-    # !teste: alterna modo de teste para permitir max/min em 4df.
-    if comando_teste:
-        if not eh_admin(usuario.id):
-            await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
-            return
 
-        alvo_id = extrair_id_alvo_texto(message, comando_teste.group(1))
-        if not alvo_id:
-            await message.channel.send('Use `!teste @usuario` ou `!teste ID`.')
-            return
+@registrar_comando_texto('parar', r'^!parar\s*$')
+async def comando_parar_texto(message, _comando_parar):
+    # !parar: para o áudio e limpa a playlist do servidor.
+    if message.guild is None:
+        return
+    await ator_audio(message.guild.id).executar(_parar_audio, message.guild, message.channel)
 
-        if alvo_id in usuarios_teste:
-            usuarios_teste.remove(alvo_id)
-            await message.channel.send(f'Modo de teste removido para `{alvo_id}`.')
-        else:
-            usuarios_teste.add(alvo_id)
-            await message.channel.send(f'Modo de teste ativado para `{alvo_id}`. Em `4df`, a pessoa pode usar `max`/`min` no fim da mensagem.')
+
+@registrar_comando_texto('adm')
+async def comando_adm_texto(message, comando_adm):
+    # !adm: adiciona novo administrador (apenas admins atuais).
+    usuario = message.author
+    if not eh_admin(usuario.id):
+        await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
         return
 
-    # !ban: bloqueia usuário para comandos de rolagem.
-    if comando_ban:
-        if not eh_admin(usuario.id):
-            await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
-            return
+    alvo_id = extrair_id_alvo_texto(message, comando_adm.group(1))
+    if not alvo_id:
+        await message.channel.send('Use `!adm @usuario` ou `!adm ID`.')
+        return
 
-        alvo_id = extrair_id_alvo_texto(message, comando_ban.group(1))
-        if not alvo_id:
-            await message.channel.send('Use `!ban @usuario` ou `!ban ID`.')
-            return
+    if alvo_id in ids_admin:
+        await message.channel.send(f'O usuário `{alvo_id}` já é admin.')
+        return
+
+    definir_papel_usuario('admin', alvo_id, True)
+    await message.channel.send(f'Usuário `{alvo_id}` adicionado como admin.')
+
+
+@registrar_comando_texto('teste')
+async def comando_teste_texto(message, comando_teste):
+    # !teste: alterna modo de teste para permitir max/min em 4df.
+    usuario = message.author
+    if not eh_admin(usuario.id):
+        await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
+        return
+
+    alvo_id = extrair_id_alvo_texto(message, comando_teste.group(1))
+    if not alvo_id:
+        await message.channel.send('Use `!teste @usuario` ou `!teste ID`.')
+        return
+
+    if alvo_id in usuarios_teste:
+        definir_papel_usuario('teste', alvo_id, False)
+        await message.channel.send(f'Modo de teste removido para `{alvo_id}`.')
+    else:
+        definir_papel_usuario('teste', alvo_id, True)
+        await message.channel.send(f'Modo de teste ativado para `{alvo_id}`. Em `4df`, a pessoa pode usar `max`/`min` no fim da mensagem.')
 
-        if alvo_id in usuarios_banidos:
-            await message.channel.send(f'O usuário `{alvo_id}` já está banido.')
-            return
 
-        usuarios_banidos.append(alvo_id)
-        await message.channel.send(f'Usuário `{alvo_id}` foi adicionado aos banidos.')
+@registrar_comando_texto('ban')
+async def comando_ban_texto(message, comando_ban):
+    # !ban: bloqueia usuário para comandos de rolagem.
+    usuario = message.author
+    if not eh_admin(usuario.id):
+        await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
+        return
+
+    alvo_id = extrair_id_alvo_texto(message, comando_ban.group(1))
+    if not alvo_id:
+        await message.channel.send('Use `!ban @usuario` ou `!ban ID`.')
+        return
+
+    if alvo_id in usuarios_banidos:
+        await message.channel.send(f'O usuário `{alvo_id}` já está banido.')
         return
 
+    definir_papel_usuario('banido', alvo_id, True)
+    await message.channel.send(f'Usuário `{alvo_id}` foi adicionado aos banidos.')
+
+
+@registrar_comando_texto('desbanir')
+async def comando_desbanir_texto(message, comando_desbanir):
     # !desbanir: remove bloqueio de usuário.
-    if comando_desbanir:
-        if not eh_admin(usuario.id):
-            await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
-            return
+    usuario = message.author
+    if not eh_admin(usuario.id):
+        await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
+        return
 
-        alvo_id = extrair_id_alvo_texto(message, comando_desbanir.group(1))
-        if not alvo_id:
-            await message.channel.send('Use `!desbanir @usuario` ou `!desbanir ID`.')
-            return
+    alvo_id = extrair_id_alvo_texto(message, comando_desbanir.group(1))
+    if not alvo_id:
+        await message.channel.send('Use `!desbanir @usuario` ou `!desbanir ID`.')
+        return
 
-        if alvo_id not in usuarios_banidos:
-            await message.channel.send(f'O usuário `{alvo_id}` não está banido.')
-            return
+    if alvo_id not in usuarios_banidos:
+        await message.channel.send(f'O usuário `{alvo_id}` não está banido.')
+        return
+
+    definir_papel_usuario('banido', alvo_id, False)
+    await message.channel.send(f'Usuário `{alvo_id}` foi removido dos banidos.')
 
-        usuarios_banidos.remove(alvo_id)
-        await message.channel.send(f'Usuário `{alvo_id}` foi removido dos banidos.')
+
+@registrar_comando_texto('prob')
+async def comando_prob_texto(message, comando_prob):
+    # !prob: distribuição exata da expressão, P(total >= alvo) e escala Fate.
+    usuario = message.author
+    if usuario.id in usuarios_banidos:
+        await enviar_aviso_banido(message.channel, usuario.mention)
         return
 
-    # Matchers gerais para rolagens e gatilho "jandei".
-    match = re.match(r'^(\d*)d(\d+)((?:\s*[+-]\s*\d+)*)(?:\s+(.*))?$', message.content, re.IGNORECASE)
-    match2 = re.match(r'^(\d*)df((?:\s*[+-]\s*\d+)*)(?:\s+(.*))?$', message.content, re.IGNORECASE)
-    # `r` só aceita expressão matemática real (evita capturar palavras aleatórias).
-    match3 = re.match(r'^r\s*((?:\d+(?:\.\d+)?|\.\d+)\s*(?:(?:\*\*|//|[+\-*/%])\s*[-+]?(?:\d+(?:\.\d+)?|\.\d+)\s*)+)$', message.content)
-    match4 = re.search(r'jandei', message.content, re.IGNORECASE)
-    jandei_foi_mencionado = any(mencionado.id == id_jandei for mencionado in message.mentions)
+    expressao = (comando_prob.group(1) or '').strip()
+    if not expressao:
+        await message.channel.send(f'{usuario.mention} use `!prob <expressão> [>= alvo]`, ex.: `!prob 4df+2 >= 3`.')
+        return
 
-    # Fluxo de rolagem de dados comuns (d20, 2d6+3 etc.).
-    if match:
-        if usuario.id in usuarios_banidos:
-            await message.channel.send(f'Desculpe {usuario.mention}, eu não escuto furries')
-            await message.channel.send('mas caso queira falar comigo, resolva esta simples questao de matemática:')
-            await message.channel.send('https://media.discordapp.net/attachments/1190477143763853393/1471694458629128266/image.png?ex=698fddc5&is=698e8c45&hm=f441a1748e0751a108d3d4adf454c036d63e1f650be231bdf31d4db38340f084&=&format=webp&quality=lossless')
-            return
-        num_dice = int(match.group(1)) if match.group(1) else 1
-        sides = int(match.group(2))
-        mods = match.group(3) if match.group(3) else ''
-        bonus = 0
-        mod_display = ''
-        mods_encontrados = re.findall(r'([+-])\s*(\d+)', mods)
-        if mods_encontrados:
-            bonus = sum(int(valor) if sinal == '+' else -int(valor) for sinal, valor in mods_encontrados)
-            mod_display = ''.join(f'{sinal}{valor}' for sinal, valor in mods_encontrados)
-
-        texto_adicional = match.group(4) if match.group(4) else ''
-        rolls = [random.randint(1, sides) for _ in range(num_dice)]
-        await message.channel.send(f'{usuario.mention} rolled: {rolls} {mod_display} (**Total: {sum(rolls) + bonus}**) {texto_adicional}')
-    # Fluxo de rolagem Fate (df), incluindo regras de ação e efeitos especiais.
-    elif match2:
-        if usuario.id in usuarios_banidos:
-            await message.channel.send(f'Desculpe {usuario.mention}, eu não escuto furries')
-            await message.channel.send('mas caso queira falar comigo, resolva esta simples questao de matemática:')
-            await message.channel.send('https://media.discordapp.net/attachments/1190477143763853393/1471694458629128266/image.png?ex=698fddc5&is=698e8c45&hm=f441a1748e0751a108d3d4adf454c036d63e1f650be231bdf31d4db38340f084&=&format=webp&quality=lossless')
-            return
+    try:
+        texto = await asyncio.to_thread(calcular_probabilidades, expressao)
+    except ValueError as erro:
+        await message.channel.send(f'{usuario.mention} não consegui calcular: {erro}')
+        return
+    await message.channel.send(f'{usuario.mention} {texto}')
 
 
-        num_dice = int(match2.group(1)) if match2.group(1) else 1
-        mods = match2.group(2) if match2.group(2) else ''
-        bonus = 0
-        mod_display = ''
-        mods_encontrados = re.findall(r'([+-])\s*(\d+)', mods)
-        if mods_encontrados:
-            bonus = sum(int(valor) if sinal == '+' else -int(valor) for sinal, valor in mods_encontrados)
-            mod_display = ''.join(f'{sinal}{valor}' for sinal, valor in mods_encontrados)
-
-        texto_adicional_bruto = match2.group(3)
-        acao_fate = None
-        complemento_fate = None
-        forcagem_teste = None
-        if num_dice == 4:
-            acao_fate, complemento_fate = extrair_acao_e_complemento_fate(texto_adicional_bruto)
-            if not acao_fate:
-                await message.channel.send(
-                    f"{usuario.mention} em `4df` você precisa escolher uma ação: `Atacar`, `Defender`, `Criar Vantagem` ou `Superar`."
-                )
-                return
-            if usuario.id in usuarios_teste:
-                forcagem_teste, complemento_fate = extrair_forcagem_teste(complemento_fate)
-
-        texto_adicional = None
-        if num_dice == 4:
-            if complemento_fate:
-                texto_adicional = f"→ '{complemento_fate}'"
-        elif texto_adicional_bruto:
-            texto_adicional = f"→ '{texto_adicional_bruto}'"
-
-        if num_dice == 4 and forcagem_teste == 'max':
-            rolls = [1, 1, 1, 1]
-        elif num_dice == 4 and forcagem_teste == 'min':
-            rolls = [-1, -1, -1, -1]
-        else:
-            rolls = [random.randint(-1, 1) for _ in range(num_dice)]
-        rolls_fate = []
-        for i in rolls:
-            rolls_fate.append(fate_dice[i])
-        dados_organizados = ', '.join(rolls_fate)
-        total_fate = sum(rolls) + bonus
-        escala = escala_adjetivos_jjk(total_fate)
-        if rolls_fate == ['+','+','+','+'] and acao_fate == 'Atacar':
-            await message.channel.send('Black Flash!')
-            await message.channel.send('https://tenor.com/view/jjk-jjk-s2-jjk-season-2-jujutsu-kaisen-jujutsu-kaisen-s2-gif-7964484372484357392')
-            await message.channel.send(f"{usuario.mention} rolled: [**{dados_organizados}**]{mod_display} (**Total: {total_fate}**) | Escala: **{escala}** {f'| Ação: **{acao_fate}** ' if acao_fate else ''}{texto_adicional if texto_adicional else ''}")
-            await tocar_audio_ao_mais_quatro(usuario, message.channel, acao_fate)
-        elif rolls_fate == ['-','-','-','-']:
-            await message.channel.send(f"{usuario.mention} rolled: [**{dados_organizados}**]{mod_display} (**Total: {total_fate}**) | Escala: **{escala}** {f'| Ação: **{acao_fate}** ' if acao_fate else ''}{texto_adicional if texto_adicional else ''} ")
-            await message.channel.send('https://cdn.discordapp.com/attachments/1264409229150785609/1451361408028639316/a5z6jq.gif?ex=698f1064&is=698dbee4&hm=a1ecc438a4c2434f9ea70349dd156d6ac2d7c5197ce7dc0b801974d462b55fb5')
-        else:
-            await message.channel.send(f"{usuario.mention} rolled: [{dados_organizados}]{mod_display} (**Total: {total_fate}**) | Escala: **{escala}** {f'| Ação: **{acao_fate}** ' if acao_fate else ''}{texto_adicional if texto_adicional else ''} ")
-            if rolls_fate == ['+','+','+','+'] and acao_fate in ('Defender', 'Criar Vantagem', 'Superar'):
-                await tocar_audio_ao_mais_quatro(usuario, message.channel, acao_fate)
+@registrar_comando_texto('stats')
+async def comando_stats_texto(message, comando_stats):
+    # !stats: agregados de rolagem do usuário (ou do alvo) e do canal, em O(1).
+    usuario = message.author
+    alvo_id = extrair_id_alvo_texto(message, comando_stats.group(1)) or usuario.id
+    historico = historicos_canais.get(message.channel.id)
+    if historico is None:
+        await message.channel.send(f'{usuario.mention} ninguém rolou dados neste canal ainda.')
+        return
+
+    estatisticas_alvo = historico.estatisticas_usuarios.get(alvo_id)
+    linhas = [
+        f'Estatísticas de <@{alvo_id}> neste canal: {formatar_estatisticas(estatisticas_alvo or EstatisticasRolagem())}',
+        f'Canal: {formatar_estatisticas(historico.estatisticas)}',
+    ]
+    await message.channel.send('\n'.join(linhas))
+
+
+@registrar_comando_texto('ffmpeg', r'^!ffmpeg\s*$')
+async def comando_ffmpeg_texto(message, _comando_ffmpeg):
+    # !ffmpeg (admin): processos ffmpeg vivos, por guild, com tempo de execução e CPU.
+    usuario = message.author
+    if not eh_admin(usuario.id):
+        await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
+        return
+
+    linhas = estatisticas_ffmpeg()
+    if not linhas:
+        await message.channel.send('Nenhum processo ffmpeg ativo.')
+        return
+    linhas.insert(0, f'**{len(linhas)}**/{limite_processos_ffmpeg} processos ffmpeg:')
+    mensagem = '\n'.join(linhas)
+    while len(mensagem) > limite_caracteres_mensagem and len(linhas) > 2:
+        linhas.pop()
+        mensagem = '\n'.join(linhas)
+    await message.channel.send(mensagem)
+
+
+@registrar_comando_texto('voz', r'^!voz\s*$')
+async def comando_voz_texto(message, _comando_voz):
+    # !voz (admin): conexões de voz abertas e há quanto tempo cada uma está ociosa.
+    usuario = message.author
+    if not eh_admin(usuario.id):
+        await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
+        return
+
+    linhas = estatisticas_voz()
+    if not linhas:
+        await message.channel.send('Nenhuma conexão de voz aberta.')
+        return
+    linhas.insert(0, f'**{len(linhas)}** conexões de voz abertas (desconecta após {tempo_ocioso_voz:.0f}s ociosa):')
+    mensagem = '\n'.join(linhas)
+    while len(mensagem) > limite_caracteres_mensagem and len(linhas) > 2:
+        linhas.pop()
+        mensagem = '\n'.join(linhas)
+    await message.channel.send(mensagem)
+
+
+@registrar_comando_texto('auditoria')
+async def comando_auditoria_texto(message, comando_auditoria):
+    # !auditoria (admin): consulta o log binário de rolagens por usuário/período/forçadas.
+    usuario = message.author
+    if not eh_admin(usuario.id):
+        await message.channel.send(f'{usuario.mention} você não tem permissão para usar este comando.')
+        return
+
+    argumento = comando_auditoria.group(1) or ''
+    alvo_id = extrair_id_alvo_texto(message, argumento)
+    tokens = argumento.lower().split()
+    apenas_forcadas = 'forcadas' in tokens or 'forçadas' in tokens
+    dias = next((int(token[:-1]) for token in tokens if re.fullmatch(r'\d{1,4}d', token)), 7)
+    desde = time.time() - dias * 86400
+
+    # Grava o que está pendente antes de consultar, para a consulta ver tudo.
+    await descarregar_auditoria_async()
+
+    total, registros = await asyncio.to_thread(
+        consultar_auditoria, alvo_id, message.guild.id if message.guild else None, desde, apenas_forcadas
+    )
+    filtro = f"{'rolagens forçadas' if apenas_forcadas else 'rolagens'}{f' de <@{alvo_id}>' if alvo_id else ''} nos últimos {dias} dias"
+    if not total:
+        await message.channel.send(f'Nenhuma ocorrência de {filtro}.')
+        return
+
+    linhas = [f'**{total}** {filtro} (mostrando as últimas {len(registros)}):']
+    linhas.extend(formatar_registro_auditoria(registro) for registro in registros)
+    mensagem = '\n'.join(linhas)
+    while len(mensagem) > limite_caracteres_mensagem and len(linhas) > 2:
+        linhas.pop(1)
+        mensagem = '\n'.join(linhas)
+    await message.channel.send(mensagem)
+
+
+# Rolagens começam com dígito (quantidade) ou com `d`.
+prefixos_rolagem = tuple('0123456789dD')
+
+
+@registrar_rota(prefixos_rolagem, regex_expressao_dados)
+async def rolagem_texto(message, match):
+    # Fluxo de rolagem de dados comuns (d20, 2d6+3 etc.) e Fate (df).
+    usuario = message.author
+    resultado = executar_rolagem(
+        message.content, usuario.id, message.channel.id,
+        message.guild.id if message.guild else None, match=match
+    )
+    for mensagem in renderizar_rolagem(resultado, usuario.mention):
+        await message.channel.send(mensagem)
+    if resultado.toca_audio:
+        await tocar_audio_ao_mais_quatro(usuario, message.channel, resultado.acao)
+
+
+@registrar_rota(prefixos_rolagem[:10], regex_repeticao_rolagem)
+async def rolagem_em_lote_texto(message, match):
+    # Rolagem repetida (`10x d20+5`): todas as repetições numa só mensagem.
+    mensagens = processar_rolagem_em_lote(
+        match.group(2), int(match.group(1)), message.author.id, message.author.mention,
+        message.channel.id, message.guild.id if message.guild else None
+    )
+    for mensagem in mensagens or ():
+        await message.channel.send(mensagem)
+
+
+# `r` só aceita expressão matemática real (evita capturar palavras aleatórias).
+@registrar_rota(('r',), r'^r\s*((?:\d+(?:\.\d+)?|\.\d+)\s*(?:(?:\*\*|//|[+\-*/%])\s*[-+]?(?:\d+(?:\.\d+)?|\.\d+)\s*)+)$')
+async def calculo_texto(message, match3):
     # Fluxo de cálculo matemático seguro com comando r.
-    elif match3:
-        if usuario.id in usuarios_banidos:
-            await message.channel.send(f'Desculpe {usuario.mention}, eu não escuto furries')
-            await message.channel.send('mas caso queira falar comigo, resolva esta simples questao de matemática:')
-            await message.channel.send('https://media.discordapp.net/attachments/1190477143763853393/1471694458629128266/image.png?ex=698fddc5&is=698e8c45&hm=f441a1748e0751a108d3d4adf454c036d63e1f650be231bdf31d4db38340f084&=&format=webp&quality=lossless')
-            return
+    usuario = message.author
+    if usuario.id in usuarios_banidos:
+        await enviar_aviso_banido(message.channel, usuario.mention)
+        return
 
-        expr = match3.group(1).strip()
-        if not expr:
-            await message.channel.send(f'{usuario.mention} use: `r 2 + 3 * (4 - 1)`')
-            return
+    expr = match3.group(1).strip()
+    if not expr:
+        await message.channel.send(f'{usuario.mention} use: `r 2 + 3 * (4 - 1)`')
+        return
+
+    try:
+        resultado = formatar_resultado_calculo(await calcular_expressao_async(expr))
+        await message.channel.send(f'{usuario.mention} `r {expr}` = **{resultado}**')
+    except ZeroDivisionError:
+        await message.channel.send(f'{usuario.mention} não dá para dividir por zero.')
+    except (CalculoMuitoCaro, OverflowError):
+        await message.channel.send(f'{usuario.mention} esse cálculo é grande demais para mim.')
+    except TimeoutError:
+        await message.channel.send(f'{usuario.mention} o cálculo demorou demais e foi cancelado.')
+    except Exception:
+        await message.channel.send(f'{usuario.mention} expressão inválida. Exemplo: `r (10 + 5) * 2 - 3/4`')
+
+
+@client.event
+async def on_message(message):
+    # Manipulador de mensagens de texto: despacha pelo roteador e trata "jandei".
+    usuario = message.author
+    if usuario == client.user:
+        return
+
+    rota = resolver_rota(message.content)
+    if rota is not None:
+        handler, match = rota
+        await handler(message, match)
+        return
 
-        try:
-            resultado = calcular_expressao(expr)
-            if isinstance(resultado, float) and resultado.is_integer():
-                resultado = int(resultado)
-            await message.channel.send(f'{usuario.mention} `r {expr}` = **{resultado}**')
-        except ZeroDivisionError:
-            await message.channel.send(f'{usuario.mention} não dá para dividir por zero.')
-        except Exception:
-            await message.channel.send(f'{usuario.mention} expressão inválida. Exemplo: `r (10 + 5) * 2 - 3/4`')
     # Gatilho por texto/menção de "jandei", redirecionando para canal específico.
-    elif match4 or jandei_foi_mencionado:
+    # Busca de substring simples: conversa comum não passa por nenhuma regex.
+    jandei_foi_mencionado = any(mencionado.id == id_jandei for mencionado in message.mentions)
+    if 'jandei' in message.content.lower() or jandei_foi_mencionado:
         canal_destino = client.get_channel(1471692261371674676)
         if canal_destino is None:
             try:
@@ -977,9 +4504,17 @@ async def on_message(message):
         await canal_destino.send('https://tenor.com/view/furry-fursuit-lua-excited-discord-gif-25290457')
         await canal_destino.send(f'Jandei foi citado! "{message.content}". lembrando que Jandei é um furry <@332954449918165003>')
 
+
+if __name__ == '__main__':
     # Inicialização do bot com token via variável de ambiente.
-token_bot = os.environ.get('DISCORD_BOT_TOKEN', '').strip()
-if not token_bot:
-    raise RuntimeError('Defina a variável de ambiente DISCORD_BOT_TOKEN antes de iniciar o bot.')
+    # O guard permite importar o módulo (benchmarks, processos auxiliares) sem conectar.
+    token_bot = os.environ.get('DISCORD_BOT_TOKEN', '').strip()
+    if not token_bot:
+        raise RuntimeError('Defina a variável de ambiente DISCORD_BOT_TOKEN antes de iniciar o bot.')
+
+    carregar_estado()
+    carregar_cache_playlists()
+    carregar_cache_audio()
+    carregar_efeitos_sonoros()
 
-client.run(token_bot)
\ No newline at end of file
+    client.run(token_bot)
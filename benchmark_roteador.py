@@ -0,0 +1,118 @@
+# Benchmark de throughput do roteador de mensagens (`resolver_rota`) contra a
+# cascata de regex que o `on_message` rodava antes (6 comandos `!` + 4 gatilhos).
+#
+# Uso:
+#     python benchmark_roteador.py
+#     python benchmark_roteador.py --mensagens 500000 --fracao-conversa 0.98
+
+import argparse
+import random
+import re
+import time
+
+import Bot
+
+
+# Amostras de tráfego real: a maior parte é conversa comum.
+amostras_conversa = [
+    'bom dia pessoal',
+    'alguém vai jogar hoje?',
+    'kkkkkkkkk',
+    'o mestre sumiu de novo',
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'rodrigo entrou na call',
+    'depois eu vejo isso',
+    '10 minutos e eu chego',
+    'dá pra rolar iniciativa?',
+    'Essa sessão foi muito boa, valeu a todos!',
+]
+amostras_comandos = [
+    'd20+5',
+    '2d6+3 ataque pesado',
+    '4df atacar',
+    '4df criar vantagem distração',
+    'df+2',
+    'r 2 + 3 * 4',
+    '!tema https://youtu.be/xyz',
+    '!ban 190954369917779968',
+    '!luta',
+    '!banana',
+]
+
+
+def resolver_cascata_antiga(conteudo):
+    # Reproduz a sequência de `re.match`/`re.search` do on_message original.
+    comando_ban = re.match(r'^!ban(?:\s+(.*))?$', conteudo, re.IGNORECASE)
+    comando_desbanir = re.match(r'^!desbanir(?:\s+(.*))?$', conteudo, re.IGNORECASE)
+    comando_teste = re.match(r'^!teste(?:\s+(.*))?$', conteudo, re.IGNORECASE)
+    comando_adm = re.match(r'^!adm(?:\s+(.*))?$', conteudo, re.IGNORECASE)
+    comando_luta = re.match(r'^!luta\s*$', conteudo, re.IGNORECASE)
+    comando_tema = re.match(r'^!tema(?:\s+(.*))?$', conteudo, re.IGNORECASE)
+    if comando_tema or comando_luta or comando_adm or comando_teste or comando_ban or comando_desbanir:
+        return True
+
+    match = re.match(r'^(\d*)d(\d+)((?:\s*[+-]\s*\d+)*)(?:\s+(.*))?$', conteudo, re.IGNORECASE)
+    match2 = re.match(r'^(\d*)df((?:\s*[+-]\s*\d+)*)(?:\s+(.*))?$', conteudo, re.IGNORECASE)
+    match3 = re.match(r'^r\s*((?:\d+(?:\.\d+)?|\.\d+)\s*(?:(?:\*\*|//|[+\-*/%])\s*[-+]?(?:\d+(?:\.\d+)?|\.\d+)\s*)+)$', conteudo)
+    match4 = re.search(r'jandei', conteudo, re.IGNORECASE)
+    return bool(match or match2 or match3 or match4)
+
+
+def resolver_roteador(conteudo):
+    # Mesmo trabalho feito pelo on_message atual antes de chamar um handler.
+    if Bot.resolver_rota(conteudo) is not None:
+        return True
+    return 'jandei' in conteudo.lower()
+
+
+def gerar_mensagens(quantidade, fracao_conversa, semente):
+    # Gera um fluxo de mensagens com a proporção pedida de conversa comum.
+    gerador = random.Random(semente)
+    mensagens = []
+    for _ in range(quantidade):
+        if gerador.random() < fracao_conversa:
+            mensagens.append(gerador.choice(amostras_conversa))
+        else:
+            mensagens.append(gerador.choice(amostras_comandos))
+    return mensagens
+
+
+def medir(resolver, mensagens, repeticoes):
+    # Retorna o melhor throughput (mensagens/s) entre as repetições.
+    melhor = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        for conteudo in mensagens:
+            resolver(conteudo)
+        duracao = time.perf_counter() - inicio
+        if melhor is None or duracao < melhor:
+            melhor = duracao
+    return len(mensagens) / melhor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do roteador de mensagens do bot.')
+    parser.add_argument('--mensagens', type=int, default=200_000)
+    parser.add_argument('--fracao-conversa', type=float, default=0.95)
+    parser.add_argument('--repeticoes', type=int, default=5)
+    parser.add_argument('--semente', type=int, default=1234)
+    args = parser.parse_args()
+
+    mensagens = gerar_mensagens(args.mensagens, args.fracao_conversa, args.semente)
+
+    # Os dois caminhos precisam concordar sobre o que é tratado.
+    divergencias = [m for m in set(mensagens) if resolver_cascata_antiga(m) != resolver_roteador(m)]
+    if divergencias:
+        raise SystemExit(f'Roteador diverge da cascata antiga em: {divergencias}')
+
+    cascata = medir(resolver_cascata_antiga, mensagens, args.repeticoes)
+    roteador = medir(resolver_roteador, mensagens, args.repeticoes)
+
+    print(f'Mensagens: {len(mensagens)} ({args.fracao_conversa:.0%} conversa comum)')
+    print(f'Cascata de regex: {cascata:>14,.0f} msg/s')
+    print(f'Roteador:         {roteador:>14,.0f} msg/s')
+    print(f'Ganho:            {roteador / cascata:>14.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import pytest
+
+import Bot
+
+
+@pytest.mark.parametrize('expr, esperado', [
+    ('2**0.5', 2 ** 0.5),
+    ('9**0.5', 3.0),
+    ('16**0.25', 2.0),
+    ('2**1.5', 2 ** 1.5),
+    ('1**999999999999', 1),
+    ('(-1)**999999999999', -1),
+    ('0**999999999999', 0),
+])
+def test_potencias_baratas_sao_calculadas(expr, esperado):
+    assert Bot.calcular_expressao(expr) == pytest.approx(esperado)
+
+
+@pytest.mark.parametrize('expr', ['9**9**9', '2**64**2', '(9**9**9)**0.5'])
+def test_potencias_absurdas_sao_recusadas(expr):
+    with pytest.raises(Bot.CalculoMuitoCaro):
+        Bot.compilar_calculo(expr)